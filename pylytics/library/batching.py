@@ -0,0 +1,186 @@
+from __future__ import unicode_literals
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+import logging
+
+from column import DimensionKey, HashKey
+from settings import settings
+from warehouse import Warehouse
+
+
+log = logging.getLogger("pylytics")
+
+
+# The most bytes the SQL literal for a value of each type can take (apart
+# from strings, whose size depends on their length). Anything else, like a
+# SQL expression, is assumed to take OTHER_BYTES.
+_sizes = {
+    type(None): 4,
+    bool: 1,
+    int: 20,
+    long: 20,
+    float: 24,
+    Decimal: 40,
+    date: 12,
+    datetime: 28,
+    time: 17,
+    timedelta: 17,
+}
+
+# The size of the literal for any value not covered by `_sizes`.
+OTHER_BYTES = 64
+
+# The size of the literal for a hash key (a hex digest, quoted).
+HASH_KEY_BYTES = 42
+
+# The size of the value of a dimension key - the primary key of the
+# dimension row, or a subquery to find it if it isn't known yet.
+DIMENSION_KEY_BYTES = 64
+
+
+class BatchSizer(object):
+    """ Chooses how many rows of a table to insert at once, so that each
+    batch is as large as possible without its statement exceeding a byte
+    budget, or taking longer than a target time to execute.
+
+    The budget is BATCH_TARGET_BYTES, capped at a fraction of the server's
+    `max_allowed_packet`. After each batch is executed, the average size of
+    a row is updated from the bytes actually sent, and the number of rows
+    is scaled towards both targets (growing by at most double each time).
+
+    """
+
+    # The fraction of max_allowed_packet a batch may use, allowing for
+    # the estimate of its size being out.
+    PACKET_FRACTION = 0.75
+
+    # Weight given to the latest measurement of the size of a row.
+    SMOOTHING = 0.5
+
+    # Sizers which have been created so far, keyed by table class.
+    __sizers = {}
+
+    def __init__(self, table, max_bytes, target_seconds, initial_rows,
+                 max_rows):
+        self.table = table
+        self.max_bytes = max_bytes
+        self.target_seconds = target_seconds
+        self.max_rows = max_rows
+        self.rows = max(1, min(initial_rows, max_rows))
+        self.bytes_per_row = None
+
+        # The name of each column inserted, along with the fixed size of its
+        # values if it has one.
+        self._columns = []
+        for column in table.__insertcolumns__:
+            if isinstance(column, HashKey):
+                fixed = HASH_KEY_BYTES
+            elif isinstance(column, DimensionKey):
+                fixed = DIMENSION_KEY_BYTES
+            else:
+                fixed = None
+            self._columns.append((column.name, fixed))
+
+    @classmethod
+    def get(cls, table):
+        """ Return the sizer for a table, creating it the first time it is
+        requested.
+        """
+        try:
+            return cls.__sizers[table]
+        except KeyError:
+            max_bytes = min(
+                settings.BATCH_TARGET_BYTES,
+                int(Warehouse.max_allowed_packet * cls.PACKET_FRACTION))
+            sizer = cls.__sizers[table] = cls(
+                table, max_bytes, settings.BATCH_TARGET_SECONDS,
+                settings.BATCH_SIZE, settings.BATCH_MAX_SIZE)
+            return sizer
+
+    @classmethod
+    def invalidate(cls, table=None):
+        """ Discard the sizer for a table (or all sizers if no table is
+        given), so the batch size is learnt again.
+        """
+        if table is None:
+            cls.__sizers.clear()
+        else:
+            cls.__sizers.pop(table, None)
+
+    def _estimate(self, instance):
+        """ Estimate the size of a row from the raw values of its columns.
+
+        Rows aren't serialized to estimate their size, as that would do the
+        work of serializing each row twice (including working out its hash
+        key, and looking up its dimension keys). The sizes of the hash key
+        and dimension keys are fixed, and the other values are sized by
+        type, so the estimate is only rough - `record` corrects the average
+        size of a row from the size of each batch sent.
+        """
+        size = 4
+        for name, fixed in self._columns:
+            if fixed:
+                size += fixed + 4
+                continue
+            value = instance[name]
+            if isinstance(value, basestring):
+                size += len(value) + 6
+            else:
+                size += _sizes.get(type(value), OTHER_BYTES) + 4
+        return size
+
+    def batches(self, instances):
+        """ Subdivide instances into batches of the current size, which is
+        reread for each batch as it adapts.
+
+        The size of each row is also estimated as it's added, and a batch
+        is ended early if the next row would take it over the byte budget,
+        so a run of rows wider than average can't exceed it. (A row which
+        is over the budget by itself is put in a batch of its own.)
+        """
+        batch = []
+        size = 0
+        for instance in instances:
+            row_size = self._estimate(instance)
+            if self.bytes_per_row is None:
+                self.bytes_per_row = row_size
+                self.rows = self._limit(self.rows)
+            if batch and size + row_size > self.max_bytes:
+                yield batch
+                batch = []
+                size = 0
+            batch.append(instance)
+            size += row_size
+            if len(batch) >= self.rows:
+                yield batch
+                batch = []
+                size = 0
+        if batch:
+            yield batch
+
+    def _limit(self, rows):
+        if self.bytes_per_row:
+            rows = min(rows, self.max_bytes // self.bytes_per_row)
+        return int(max(1, min(rows, self.max_rows)))
+
+    def record(self, rows, size, seconds):
+        """ Adapt the batch size after a batch of `rows` rows was sent as
+        `size` bytes and took `seconds` to execute.
+        """
+        if not rows:
+            return
+        if size:
+            measured = float(size) / rows
+            if self.bytes_per_row is None:
+                self.bytes_per_row = measured
+            else:
+                self.bytes_per_row += self.SMOOTHING * (
+                    measured - self.bytes_per_row)
+
+        target = max(rows, self.rows) * 2
+        if seconds > 0:
+            target = min(target, rows * self.target_seconds / seconds)
+        self.rows = self._limit(target)
+        log.debug("Batch of %s rows (%s bytes) took %.2fs - next batch %s "
+                  "rows", rows, size, seconds, self.rows,
+                  extra={"table": self.table.__tablename__})
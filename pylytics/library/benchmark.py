@@ -0,0 +1,333 @@
+from __future__ import unicode_literals
+from contextlib import closing
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+import logging
+import math
+import random
+import resource
+import string
+import timeit
+
+from column import (ApplicableFrom, AutoColumn, Column, DimensionKey,
+                    HashKey)
+from insert import ENGINES
+from settings import settings
+from source import Source
+from utils import escaped
+from warehouse import Warehouse
+
+
+log = logging.getLogger("pylytics")
+
+
+# Generated dates and times are no earlier than this, which is also when
+# generated dimension rows become applicable, so every fact can be matched
+# to a dimension row whatever its dimension selector.
+EPOCH = datetime(2000, 1, 1)
+
+# The fraction of values left NULL in optional columns.
+NULL_FRACTION = 0.05
+
+_letters = string.ascii_letters + string.digits + " "
+
+
+def _size(column, default):
+    size = column.size
+    if size is None:
+        size = Column.default_size.get(column.type, default)
+    return size
+
+
+def key_value(column, index):
+    """ Return the `index`th distinct value of a natural key column.
+    """
+    kind = column.type
+    if isinstance(kind, tuple):
+        return kind[index % len(kind)]
+    elif kind in (int, long):
+        return index + 1
+    elif kind is float:
+        return float(index + 1)
+    elif kind is Decimal:
+        return Decimal(index + 1)
+    elif kind is bool:
+        return bool(index % 2)
+    elif kind is date:
+        return EPOCH.date() + timedelta(days=index)
+    elif kind is datetime:
+        return EPOCH + timedelta(seconds=index)
+    elif kind in (time, timedelta):
+        return timedelta(seconds=index % 86400)
+    elif kind is bytearray:
+        return bytearray(b"%d" % index)
+    # Strings
+    return ("%s %s" % (column.name, index))[-_size(column, 40):]
+
+
+def random_value(column, rng):
+    """ Return a random value which fits in a column.
+    """
+    if column.optional and rng.random() < NULL_FRACTION:
+        return None
+
+    kind = column.type
+    if isinstance(kind, tuple):
+        return rng.choice(kind)
+    elif kind in (int, long):
+        return rng.randint(0, 10 ** 6)
+    elif kind is float:
+        return rng.uniform(0, 1000)
+    elif kind is Decimal:
+        precision, scale = _size(column, (6, 2))
+        return Decimal(rng.randint(0, 10 ** precision - 1)).scaleb(-scale)
+    elif kind is bool:
+        return rng.random() < 0.5
+    elif kind is date:
+        return EPOCH.date() + timedelta(days=rng.randint(0, 3650))
+    elif kind is datetime:
+        return EPOCH + timedelta(seconds=rng.randint(0, 3650 * 86400))
+    elif kind is time:
+        return time(rng.randint(0, 23), rng.randint(0, 59),
+                    rng.randint(0, 59))
+    elif kind is timedelta:
+        return timedelta(seconds=rng.randint(0, 86399))
+    elif kind is bytearray:
+        return bytearray(rng.getrandbits(8)
+                         for _ in xrange(rng.randint(1, _size(column, 20))))
+    # Strings
+    length = rng.randint(1, min(_size(column, 40), 40))
+    return "".join(rng.choice(_letters) for _ in xrange(length))
+
+
+def generated_columns(table):
+    """ The columns of a table which synthetic rows have values for - the
+    rest are filled in by pylytics or MySQL.
+    """
+    return [column for column in table.__columns__
+            if not isinstance(column, (AutoColumn, HashKey))]
+
+
+def dimension_row(dimension, index, rng):
+    """ Generate the `index`th row of a dimension. Its natural keys are
+    distinct from those of every other row, and the rest of its values are
+    random.
+    """
+    natural_keys = set(key.name for key in dimension.__naturalkeys__)
+    row = {}
+    for column in generated_columns(dimension):
+        if isinstance(column, ApplicableFrom):
+            row[column.name] = EPOCH
+        elif column.name in natural_keys:
+            row[column.name] = key_value(column, index)
+        else:
+            row[column.name] = random_value(column, rng)
+    return row
+
+
+def fact_row(fact, dimension_rows, rng):
+    """ Generate a fact row referring to a random one of the first
+    `dimension_rows` rows of each of its dimensions.
+    """
+    row = {}
+    for column in generated_columns(fact):
+        if isinstance(column, DimensionKey):
+            if column.optional and rng.random() < NULL_FRACTION:
+                row[column.name] = None
+            else:
+                natural_key = column.dimension.__naturalkeys__[0]
+                row[column.name] = key_value(
+                    natural_key, rng.randrange(dimension_rows))
+        else:
+            row[column.name] = random_value(column, rng)
+    return row
+
+
+class SyntheticSource(Source):
+    """ Generates rows for a table from its columns, rather than reading
+    them from anywhere. The same rows are generated each time for a given
+    seed.
+    """
+
+    table = None
+    rows = 0
+    dimension_rows = 1
+    seed = 1
+
+    @classmethod
+    def execute(cls, since=None):
+        rng = random.Random(cls.seed)
+        table = cls.table
+        for index in xrange(cls.rows):
+            if hasattr(table, "__dimensionkeys__"):
+                yield fact_row(table, cls.dimension_rows, rng)
+            else:
+                yield dimension_row(table, index, rng)
+
+
+def percentile(values, fraction):
+    """ Return the value below which a fraction of the (sorted) values fall,
+    using the nearest rank.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(fraction * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def current_rss():
+    """ Return the resident set size of this process now, in MB, or None if
+    it can't be read on this platform (it's read from /proc).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / 1024.0 ** 2
+
+
+def _count(table):
+    connection = Warehouse.get()
+    with closing(connection.cursor()) as cursor:
+        cursor.execute("SELECT COUNT(*) FROM %s" %
+                       escaped(table.__tablename__))
+        return cursor.fetchall()[0][0]
+
+
+class Benchmark(object):
+    """ Loads synthetic data into a fact and its dimensions using each insert
+    engine in turn, going through the same fetch, hydrate and insert steps
+    as an update, and measures how quickly the fact rows are inserted.
+
+    The fact table is dropped and built again for each engine, so this
+    should only ever be run against a scratch data warehouse - which is
+    why it refuses to run unless the ALLOW_BENCHMARK setting is True.
+
+    """
+
+    def __init__(self, fact, rows, dimension_rows, seed=1):
+        self.fact = fact
+        self.rows = rows
+        self.dimension_rows = dimension_rows
+        self.seed = seed
+
+    def _source(self, table, rows):
+        return SyntheticSource.define(table=table, rows=rows,
+                                      dimension_rows=self.dimension_rows,
+                                      seed=self.seed)
+
+    def _load_dimensions(self):
+        """ Build the dimensions of the fact and insert the rows it refers
+        to. These are the same each time, so are ignored if they exist.
+        """
+        for dimension in self.fact.__dimensions__:
+            dimension.build()
+            source = self._source(dimension, self.dimension_rows)
+            dimension.insert(*source.select(dimension))
+
+    def _run_engine(self, engine):
+        fact = self.fact
+        fact.drop_table(if_exists=True)
+        fact.build()
+
+        source = self._source(fact, self.rows)
+        original = fact.__dict__.get("__source__")
+        original_engine = fact.__dict__.get("INSERT_ENGINE")
+        fact.__source__ = source
+        fact.INSERT_ENGINE = engine
+        latencies = []
+        # The peak RSS of the process can't be used, as it includes the
+        # runs of earlier engines, so the RSS is sampled after each batch
+        # and the largest increase over the run is reported instead.
+        rss = [current_rss()]
+        try:
+            started = timeit.default_timer()
+            for batch in fact.batch(fact.fetch()):
+                batch_started = timeit.default_timer()
+                fact.insert(*batch)
+                latencies.append(timeit.default_timer() - batch_started)
+                rss.append(current_rss())
+            seconds = timeit.default_timer() - started
+        finally:
+            _restore(fact, "__source__", original)
+            _restore(fact, "INSERT_ENGINE", original_engine)
+
+        latencies.sort()
+        inserted = _count(fact)
+        return {
+            "engine": engine,
+            "rows": self.rows,
+            "inserted": inserted,
+            "seconds": seconds,
+            "rows_per_second": self.rows / seconds if seconds else None,
+            "batches": len(latencies),
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "rss_growth_mb": (max(rss) - rss[0]
+                              if rss[0] is not None else None),
+        }
+
+    def run(self, engines=None):
+        """ Benchmark each of the insert engines named (or all of them),
+        returning a dictionary of measurements for each.
+        """
+        if not settings.ALLOW_BENCHMARK:
+            raise RuntimeError("Benchmarking drops and rebuilds tables, so "
+                               "ALLOW_BENCHMARK must be set to True first")
+
+        fact = self.fact
+        self._load_dimensions()
+
+        results = []
+        for engine in engines or sorted(ENGINES):
+            log.info("Inserting %s rows using the %s engine", self.rows,
+                     engine, extra={"table": fact.__tablename__})
+            result = self._run_engine(engine)
+            results.append(result)
+            log.info("%.0f rows/s, batch latency p50 %.3fs p90 %.3fs p99 "
+                     "%.3fs, RSS growth %s", result["rows_per_second"],
+                     result["p50"], result["p90"], result["p99"],
+                     _megabytes(result["rss_growth_mb"]),
+                     extra={"table": fact.__tablename__})
+            if result["inserted"] != self.rows:
+                log.warning("Only %s of %s rows were inserted",
+                            result["inserted"], self.rows,
+                            extra={"table": fact.__tablename__})
+        return results
+
+
+def _restore(table, name, value):
+    if value is None:
+        delattr(table, name)
+    else:
+        setattr(table, name, value)
+
+
+def _megabytes(value):
+    return "n/a" if value is None else "%.0fMB" % value
+
+
+def report(results):
+    """ Format benchmark results as a table.
+    """
+    lines = ["%-12s %10s %10s %12s %8s %8s %8s %10s" % (
+        "engine", "rows", "inserted", "rows/s", "p50 (s)", "p90 (s)",
+        "p99 (s)", "RSS growth")]
+    for result in results:
+        lines.append(
+            "%(engine)-12s %(rows)10d %(inserted)10d %(rows_per_second)12.0f "
+            "%(p50)8.3f %(p90)8.3f %(p99)8.3f" % result +
+            " %10s" % _megabytes(result["rss_growth_mb"]))
+    return "\n".join(lines)
+
+
+def benchmark(fact, rows=100000, dimension_rows=1000, engines=None):
+    """ Insert synthetic rows into a fact with each insert engine named (or
+    all of them), and log a report of how quickly they were inserted.
+    """
+    results = Benchmark(fact, rows, dimension_rows).run(engines)
+    log.info("Benchmark results:\n%s", report(results),
+             extra={"table": fact.__tablename__})
+    return results
@@ -53,6 +53,17 @@ class Column(object):
     def __repr__(self):
         return self.expression
 
+    def __get__(self, instance, owner):
+        # Columns are descriptors, so that the value of a column can be read
+        # and written as an attribute of a record (see `Table`), as well as
+        # by column name.
+        if instance is None:
+            return self
+        return instance[self.name]
+
+    def __set__(self, instance, value):
+        instance[self.name] = value
+
     @property
     def expression(self):
         s = [escaped(self.name), self.type_expression]
@@ -2,13 +2,19 @@
 Utilities for making database connections easier.
 """
 
+import logging
 import os
+import threading
+import time
 
 from mysql import connector
 
 from settings import settings
 
 
+log = logging.getLogger("pylytics")
+
+
 def get_named_connection(connection_name):
     if connection_name not in (settings.DATABASES.keys()):
         raise ValueError("The database {} isn't recognised - check your "
@@ -27,6 +33,142 @@ def get_named_connection(connection_name):
             )
 
 
+class ConnectionPool(object):
+    """
+    Keeps connections to a database open once they've been finished with,
+    so they can be reused instead of making a new connection (and repeating
+    the TCP and authentication handshakes) for every query.
+
+    There's one pool per database name in `settings.DATABASES` (and per
+    process, as connections can't be shared with forked processes). Up to
+    `CONNECTION_POOL_SIZE` idle connections are kept; any number can be in
+    use at once. Connections are closed rather than reused once they're
+    older than `CONNECTION_RECYCLE` seconds, and connections which have
+    been idle for more than PING_AFTER seconds are checked before reuse.
+
+    Example usage:
+        pool = ConnectionPool.get('platform')
+        connection = pool.acquire()
+        ...
+        pool.release(connection)
+
+    """
+
+    PING_AFTER = 60
+
+    # Pools which have been created so far, keyed by connection name.
+    __pools = {}
+    __pid = None
+    __lock = threading.Lock()
+
+    def __init__(self, connection_name, size, recycle):
+        self.connection_name = connection_name
+        self.size = size
+        self.recycle = recycle
+        self.__idle = []
+        self.__created = {}
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def get(cls, connection_name):
+        """ Return the pool for a database, creating it the first time it
+        is requested.
+        """
+        with cls.__lock:
+            if cls.__pid != os.getpid():
+                # This is a new (forked) process, so any connections in the
+                # pools belong to the parent.
+                cls.__pools = {}
+                cls.__pid = os.getpid()
+            try:
+                return cls.__pools[connection_name]
+            except KeyError:
+                pool = cls.__pools[connection_name] = cls(
+                    connection_name, settings.CONNECTION_POOL_SIZE,
+                    settings.CONNECTION_RECYCLE)
+                return pool
+
+    @classmethod
+    def close_all(cls):
+        """ Close the idle connections in every pool.
+        """
+        with cls.__lock:
+            pools = cls.__pools.values() if cls.__pid == os.getpid() else []
+        for pool in pools:
+            pool.clear()
+
+    def acquire(self):
+        """ Return an idle connection, or a new one if there aren't any.
+        """
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                connection, created, released = self.__idle.pop()
+            now = time.time()
+            if now - created > self.recycle:
+                self._close(connection)
+            elif (now - released > self.PING_AFTER and
+                    not connection.is_connected()):
+                self._close(connection)
+            else:
+                with self.__lock:
+                    self.__created[connection] = created
+                return connection
+
+        connection = get_named_connection(self.connection_name)
+        with self.__lock:
+            self.__created[connection] = time.time()
+        return connection
+
+    def release(self, connection):
+        """ Return a connection to the pool once it's been finished with,
+        closing it if the pool is full or the connection can't be reused.
+        """
+        with self.__lock:
+            created = self.__created.pop(connection, None)
+        if created is None or time.time() - created > self.recycle:
+            self._close(connection)
+            return
+
+        try:
+            # End any open transaction, so it isn't seen by the next user.
+            connection.rollback()
+        except Exception as exception:
+            log.debug("Not reusing connection to %s: %s",
+                      self.connection_name, exception)
+            self._close(connection)
+            return
+
+        with self.__lock:
+            if len(self.__idle) < self.size:
+                self.__idle.append((connection, created, time.time()))
+                return
+        self._close(connection)
+
+    def discard(self, connection):
+        """ Close a connection which was acquired from the pool, instead of
+        returning it.
+        """
+        with self.__lock:
+            self.__created.pop(connection, None)
+        self._close(connection)
+
+    def clear(self):
+        """ Close all the idle connections.
+        """
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for connection, _, _ in idle:
+            self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
 class NamedConnection(object):
     """
     Returns a connection, using database parameters defined in the settings
@@ -40,15 +182,18 @@ class NamedConnection(object):
 
     """
 
-    # Having use_connection_pool would be interesting here too.
-    # But we don't need connection pools for now. Unless it would allow us to
-    # pull and push data in parallel.
+    # Connections are taken from, and returned to, a ConnectionPool.
     def __init__(self, connection_name, *args, **kwargs):
         self.connection_name = connection_name
 
     def __enter__(self):
-        self.connection = get_named_connection(self.connection_name)
+        self.pool = ConnectionPool.get(self.connection_name)
+        self.connection = self.pool.acquire()
         return self.connection
 
     def __exit__(self, type, value, traceback):
-        self.connection.close()
+        if type is None:
+            self.pool.release(self.connection)
+        else:
+            # The connection may be in a bad state, so don't reuse it.
+            self.pool.discard(self.connection)
@@ -0,0 +1,46 @@
+from __future__ import unicode_literals
+import threading
+
+
+class RunContext(object):
+    """ Remembers the work done during a single run of a command, so that
+    it isn't repeated. Commands run by `Commander` are run within a
+    context, e.g.
+
+        with RunContext():
+            for fact in facts:
+                fact.update()
+
+    Outside of a context nothing is remembered.
+
+    """
+
+    __current = None
+
+    def __init__(self):
+        self.__updated = set()
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def current(cls):
+        """ Return the active context, or None if there isn't one.
+        """
+        return cls.__current
+
+    def __enter__(self):
+        RunContext.__current = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        RunContext.__current = None
+
+    def updated(self, table, since=None, historical=False):
+        """ Return True if the table has already been updated successfully
+        with the same arguments during this run.
+        """
+        with self.__lock:
+            return (table, since, historical) in self.__updated
+
+    def mark_updated(self, table, since=None, historical=False):
+        with self.__lock:
+            self.__updated.add((table, since, historical))
@@ -0,0 +1,222 @@
+from __future__ import unicode_literals
+import base64
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+import io
+import json
+import logging
+import os
+import threading
+
+from settings import settings
+
+
+log = logging.getLogger("pylytics")
+
+
+def _datetime(value):
+    for format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid timestamp '%s'" % value)
+
+
+def _time(value):
+    for format in ("%H:%M:%S.%f", "%H:%M:%S"):
+        try:
+            return datetime.strptime(value, format).time()
+        except ValueError:
+            pass
+    raise ValueError("Invalid time '%s'" % value)
+
+
+# Functions for converting values which JSON can't represent back from
+# their encoded form, keyed by type name.
+_decoders = {
+    "bytearray": lambda value: bytearray(base64.b64decode(value)),
+    "bytes": base64.b64decode,
+    "date": lambda value: datetime.strptime(value, "%Y-%m-%d").date(),
+    "datetime": _datetime,
+    "decimal": Decimal,
+    "time": _time,
+    "timedelta": lambda value: timedelta(seconds=value),
+}
+
+
+def _encode(value):
+    """ Convert a value to something which can be written as JSON.
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        return {"__type__": "datetime", "value": value.isoformat()}
+    elif isinstance(value, date):
+        return {"__type__": "date", "value": value.isoformat()}
+    elif isinstance(value, time):
+        return {"__type__": "time", "value": value.isoformat()}
+    elif isinstance(value, timedelta):
+        return {"__type__": "timedelta", "value": value.total_seconds()}
+    elif isinstance(value, Decimal):
+        return {"__type__": "decimal", "value": unicode(value)}
+    elif isinstance(value, bytearray):
+        return {"__type__": "bytearray",
+                "value": base64.b64encode(bytes(value))}
+    elif isinstance(value, str):
+        try:
+            return value.decode("utf-8")
+        except UnicodeDecodeError:
+            return {"__type__": "bytes", "value": base64.b64encode(value)}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and "__type__" in value:
+        return _decoders[value["__type__"]](value["value"])
+    return value
+
+
+class DeadLetters(object):
+    """ Records which couldn't be inserted, written to a file per table in
+    DEAD_LETTER_DIRECTORY so that they can be replayed once the problem
+    has been fixed.
+
+    Each line of a file is a JSON object holding the values of a record
+    (as they were before being converted for insert), the error raised
+    and when it happened.
+
+    """
+
+    __lock = threading.Lock()
+
+    @classmethod
+    def path(cls, table):
+        return os.path.join(settings.DEAD_LETTER_DIRECTORY,
+                            "%s.jsonl" % table.__tablename__)
+
+    @classmethod
+    def write(cls, table, instances, error):
+        """ Append records which failed with the same error to the dead
+        letter file of their table.
+        """
+        cls.write_rejected(table,
+                           [(instance, error) for instance in instances])
+
+    @classmethod
+    def write_rejected(cls, table, rejected):
+        """ Append records to the dead letter file of their table, given as
+        a list of each record along with the error it failed with. The file
+        is opened (and the records logged) once, however many there are.
+        """
+        if not rejected:
+            return
+        timestamp = datetime.now().isoformat()
+        lines = []
+        errors = set()
+        for instance, error in rejected:
+            description = "%s: %s" % (error.__class__.__name__, error)
+            errors.add(description)
+            values = {column.name: _encode(instance[column.name])
+                      for column in table.__insertcolumns__}
+            lines.append(json.dumps({
+                "values": values,
+                "error": description,
+                "time": timestamp,
+            }, sort_keys=True))
+
+        path = cls.path(table)
+        with cls.__lock:
+            if not os.path.isdir(settings.DEAD_LETTER_DIRECTORY):
+                os.makedirs(settings.DEAD_LETTER_DIRECTORY)
+            with io.open(path, "a", encoding="utf-8") as f:
+                for line in lines:
+                    f.write(unicode(line) + "\n")
+
+        errors = sorted(errors)
+        log.error("%s record%s written to %s (%s%s)", len(lines),
+                  "" if len(lines) == 1 else "s", path, errors[0],
+                  " and %s other errors" % (len(errors) - 1)
+                  if len(errors) > 1 else "",
+                  extra={"table": table.__tablename__})
+
+    @classmethod
+    def read(cls, path, table):
+        """ Yield the records in a dead letter file as table instances.
+        """
+        with io.open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                instance = table()
+                for name, value in json.loads(line)["values"].items():
+                    instance[name] = _decode(value)
+                yield instance
+
+    @classmethod
+    def replay(cls, table):
+        """ Insert the records in the dead letter file of a table again. Any
+        which fail again are written to a new dead letter file.
+
+        If the insert raises, or some of the records couldn't be written to
+        the new file, the records are put back in the dead letter file
+        (along with any written since), so they can be replayed once more.
+        A file left over from a replay which was interrupted is picked up by
+        the next one.
+
+        Returns:
+            The number of records replayed.
+
+        """
+        path = cls.path(table)
+        replaying = path + ".replaying"
+        with cls.__lock:
+            if os.path.exists(replaying):
+                log.warning("Resuming an interrupted replay",
+                            extra={"table": table.__tablename__})
+                if os.path.exists(path):
+                    _append(path, replaying)
+            elif os.path.exists(path):
+                os.rename(path, replaying)
+            else:
+                log.info("No dead letters to replay",
+                         extra={"table": table.__tablename__})
+                return 0
+
+        try:
+            instances = list(cls.read(replaying, table))
+            log.info("Replaying %s dead letter%s", len(instances),
+                     "" if len(instances) == 1 else "s",
+                     extra={"table": table.__tablename__})
+            complete = table.insert(*instances)
+        except Exception:
+            cls._restore(path, replaying)
+            raise
+        if not complete:
+            # Some of the records failed again and couldn't be written back,
+            # so keep them all to be replayed once more.
+            cls._restore(path, replaying)
+            return 0
+        os.remove(replaying)
+        return len(instances)
+
+    @classmethod
+    def _restore(cls, path, replaying):
+        """ Put the records being replayed back in the dead letter file.
+        """
+        with cls.__lock:
+            if os.path.exists(path):
+                _append(path, replaying)
+            os.rename(replaying, path)
+
+
+def _append(source, destination):
+    """ Move the lines of one dead letter file to the end of another.
+    """
+    with io.open(source, encoding="utf-8") as f:
+        lines = f.read()
+    with io.open(destination, "a", encoding="utf-8") as f:
+        if lines and not lines.endswith("\n"):
+            lines += "\n"
+        f.write(lines)
+    os.remove(source)
@@ -0,0 +1,183 @@
+from __future__ import unicode_literals
+from binascii import hexlify
+from contextlib import closing
+import logging
+import math
+import struct
+
+from column import HashKey
+from settings import settings
+from utils import escaped
+from warehouse import Warehouse
+
+
+log = logging.getLogger("pylytics")
+
+
+class BloomFilter(object):
+    """ A fixed size set of hash keys which can report false positives, but
+    never false negatives.
+
+    Hash keys are SHA1 digests, so their bits are already uniformly
+    distributed and are used directly to find the bits to set, rather than
+    hashing them again.
+
+    """
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        size = -capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = max(int(math.ceil(size)), 8)
+        self.hashes = max(int(round(self.size * math.log(2) / capacity)), 1)
+        self.__bits = bytearray((self.size + 7) // 8)
+
+    def __positions(self, digest):
+        first, second = struct.unpack(b">QQ", digest[:16])
+        for i in xrange(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, digest):
+        for position in self.__positions(digest):
+            self.__bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest):
+        return all(self.__bits[position >> 3] & (1 << (position & 7))
+                   for position in self.__positions(digest))
+
+
+class Deduplicator(object):
+    """ Drops records before they're inserted if a record with the same hash
+    key has already been inserted during this run, appears earlier in the
+    same batch, or already exists in the table.
+
+    The hash keys already in the table are read in ranges of primary keys
+    into a Bloom filter the first time it's needed. Records the filter
+    reports as possibly existing are then checked against the table with
+    a single query per batch, so a false positive never causes a new
+    record to be dropped.
+
+    """
+
+    # Deduplicators which have been created so far, keyed by table class.
+    __deduplicators = {}
+
+    def __init__(self, table):
+        self.table = table
+        self.skipped = 0
+        self.__inserted = set()
+        self.__existing = None
+
+    @classmethod
+    def get(cls, table):
+        """ Return the deduplicator for a table, creating it the first time
+        it is requested.
+        """
+        try:
+            return cls.__deduplicators[table]
+        except KeyError:
+            deduplicator = cls.__deduplicators[table] = cls(table)
+            return deduplicator
+
+    @classmethod
+    def invalidate(cls, table=None):
+        """ Discard the deduplicator for a table (or all deduplicators if no
+        table is given), so the hash keys in the table are read again the
+        next time they're needed.
+        """
+        if table is None:
+            cls.__deduplicators.clear()
+        else:
+            cls.__deduplicators.pop(table, None)
+
+    @classmethod
+    def applies_to(cls, table):
+        """ Only tables with a hash key which ignore duplicate records can be
+        deduplicated - replacing a record isn't the same as skipping it.
+        """
+        return (settings.DEDUPLICATE and table.INSERT == "INSERT IGNORE" and
+                any(isinstance(column, HashKey)
+                    for column in table.__columns__))
+
+    @property
+    def existing(self):
+        """ A Bloom filter of the hash keys already in the table.
+        """
+        if self.__existing is None:
+            self.__existing = self.load()
+        return self.__existing
+
+    def load(self):
+        table = self.table
+        primary_key = escaped(table.__primarykey__.name)
+        tablename = escaped(table.__tablename__)
+        range_size = settings.DEDUPLICATE_RANGE_SIZE
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute("SELECT MIN(%s), MAX(%s) FROM %s" % (
+                primary_key, primary_key, tablename))
+            [(first, last)] = cursor.fetchall()
+            if first is None:
+                first, last = 1, 0
+
+            existing = BloomFilter(last - first + 1,
+                                   settings.DEDUPLICATE_ERROR_RATE)
+            sql = "SELECT `hash_key` FROM %s WHERE %s BETWEEN %%s AND %%s" % (
+                tablename, primary_key)
+            count = 0
+            for start in xrange(first, last + 1, range_size):
+                cursor.execute(sql, (start, start + range_size - 1))
+                for (digest,) in cursor.fetchall():
+                    if digest is not None:
+                        existing.add(bytes(digest))
+                        count += 1
+
+        log.debug("Loaded %s hash keys into memory", count,
+                  extra={"table": table.__tablename__})
+        return existing
+
+    def _confirm(self, digests):
+        """ Return those digests which are actually in the table.
+        """
+        if not digests:
+            return set()
+        sql = "SELECT `hash_key` FROM %s WHERE `hash_key` IN (%s)" % (
+            escaped(self.table.__tablename__),
+            ", ".join(["UNHEX(%s)"] * len(digests)))
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql, [hexlify(digest) for digest in digests])
+            return {bytes(digest) for (digest,) in cursor.fetchall()}
+
+    def filter(self, batch):
+        """ Return the records in the batch which need inserting. Records
+        whose hash key can't be calculated on the client are always kept.
+        """
+        records, digests, candidates = [], [], set()
+        seen = set()
+        for record in batch:
+            digest = record.digest()
+            if digest is not None:
+                if digest in seen or digest in self.__inserted:
+                    continue
+                seen.add(digest)
+                if digest in self.existing:
+                    candidates.add(digest)
+            records.append(record)
+            digests.append(digest)
+
+        existing = self._confirm(candidates)
+        kept = [record for record, digest in zip(records, digests)
+                if digest not in existing]
+        self.skipped += len(batch) - len(kept)
+        return kept
+
+    def inserted(self, batch):
+        """ Remember the hash keys of records which have been committed, so
+        they're skipped if they're fetched again during this run.
+        """
+        for record in batch:
+            digest = record.digest()
+            if digest is not None:
+                self.__inserted.add(digest)
@@ -1,10 +1,16 @@
 from __future__ import unicode_literals
+import logging
 
 from column import *
+from context import RunContext
+from resolver import DimensionIndex
 from table import Table
 from utils import dump, escaped
 
 
+log = logging.getLogger("pylytics")
+
+
 class Dimension(Table):
     """ Base class for all dimensions. Note that a Dimension should
     always contain at least one NaturalKey column.
@@ -22,9 +28,9 @@ class Dimension(Table):
     applicable_from = ApplicableFrom()
 
     @classmethod
-    def __subquery__(cls, value, timestamp):
-        """ Return a SQL SELECT query to use as a subquery within a
-        fact INSERT. Does not append parentheses or a LIMIT clause.
+    def natural_keys_for(cls, value):
+        """ Return the natural keys which a value of this type could be
+        matched against.
         """
         value_type = type(value)
         # We also check for subclasses for situations like basestring, which
@@ -36,21 +42,67 @@ class Dimension(Table):
             raise ValueError("Value type '%s' does not match type of any "
                              "natural key for dimension "
                              "'%s'" % (value_type.__name__, cls.__name__))
+        return natural_keys
 
+    @classmethod
+    def __subquery_template__(cls, natural_keys):
+        """ Return the SQL for `__subquery__` with a %s placeholder for each
+        occurrence of the value being matched (one per natural key, in each
+        of the two SELECTs) followed by one for the timestamp.
+        """
         sql_template = (
             'SELECT {primary_key} FROM {table_name} '
             'WHERE {selector} '
             'AND `applicable_from` = (SELECT max(`applicable_from`) '
             'FROM {table_name} '
-            'WHERE {selector} AND `applicable_from` <= "{timestamp}")'
+            'WHERE {selector} AND `applicable_from` <= %s)'
             )
-        sql = sql_template.format(
+        return sql_template.format(
             primary_key=escaped(cls.__primarykey__.name),
             table_name=escaped(cls.__tablename__),
-            selector=" OR ".join("%s = %s" % (escaped(key.name), dump(value)) for key in natural_keys),
-            timestamp=timestamp
+            selector=" OR ".join("%s = %%s" % escaped(key.name)
+                                 for key in natural_keys),
             )
-        return sql
+
+    @classmethod
+    def __subquery__(cls, value, timestamp, bound=False):
+        """ Return a SQL SELECT query to use as a subquery within a
+        fact INSERT. Does not append parentheses or a LIMIT clause.
+
+        If `bound` is True, the query is returned with %s placeholders,
+        along with a tuple of the parameters to bind to them.
+        """
+        natural_keys = cls.natural_keys_for(value)
+        template = cls.__subquery_template__(natural_keys)
+        if bound:
+            return template, (value,) * (2 * len(natural_keys)) + (timestamp,)
+        values = ((dump(value),) * (2 * len(natural_keys)) +
+                  ('"%s"' % timestamp,))
+        return template % values
+
+    @classmethod
+    def update(cls, since=None, historical=False):
+        """ Update this dimension, unless it has already been updated with
+        the same arguments during the current run (as it's shared by more
+        than one fact).
+        """
+        context = RunContext.current()
+        if context and context.updated(cls, since, historical):
+            log.info("Already updated during this run - skipping",
+                     extra={"table": cls.__tablename__})
+            return
+        super(Dimension, cls).update(since=since, historical=historical)
+        if context:
+            context.mark_updated(cls, since, historical)
+
+    @classmethod
+    def insert(cls, *instances):
+        """ Insert dimension instances, discarding any in-memory index of
+        this dimension as it will now be out of date.
+        """
+        complete = super(Dimension, cls).insert(*instances)
+        DimensionIndex.invalidate(cls)
+        return complete
 
     def __repr__(self):
         return unicode(self[self.__naturalkeys__[0].name])
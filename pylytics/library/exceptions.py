@@ -1,4 +1,6 @@
-from mysql.connector.errors import OperationalError, ProgrammingError
+from mysql.connector.errors import (DataError, Error, IntegrityError,
+                                    InterfaceError, OperationalError,
+                                    ProgrammingError)
 
 
 class CantCreateTableError(OperationalError):
@@ -46,6 +48,16 @@ class DatabaseGoneAwayError(OperationalError):
     code = 2006
 
 
+class LostConnectionError(InterfaceError):
+    """ Raised when the connection to the server is lost part way through
+    a query, for example while reading the rows of a large result.
+
+    See: https://dev.mysql.com/doc/refman/5.5/en/error-messages-client.html#error_cr_server_lost
+
+    """
+    code = 2013
+
+
 class BrokenPipeError(OperationalError):
     """ Raised when the connection dies, usually from a stale connection being
     used.
@@ -69,6 +81,17 @@ class ExistingTriggerError(ProgrammingError):
     code = 1235
 
 
+class SubqueryRowsError(DataError):
+    """ Raised when a subquery returns more than one row where only one is
+    expected, such as when several rows of a dimension are applicable to a
+    fact.
+
+    See: https://dev.mysql.com/doc/refman/5.5/en/error-messages-server.html#error_er_subquery_no_1_row
+
+    """
+    code = 1242
+
+
 def classify_error(error):
     """ Alter the class of an error to something specific instead of the
     generic error raised. This enables errors to be caught more cleanly
@@ -80,8 +103,47 @@ def classify_error(error):
             if error.args[0] == error_class.code:
                 error.__class__ = error_class
 
+    if isinstance(error, InterfaceError):
+        for error_class in [LostConnectionError]:
+            if error.args[0] == error_class.code:
+                error.__class__ = error_class
+
+    if isinstance(error, DataError):
+        for error_class in [SubqueryRowsError]:
+            if error.args[0] == error_class.code:
+                error.__class__ = error_class
+
     if isinstance(error, ProgrammingError):
         for error_class in [NoSuchTableError, TableExistsError,
                             ExistingTriggerError]:
             if error.args[0] == error_class.code:
                 error.__class__ = error_class
+
+
+# Errors meaning the connection to the server was lost, rather than that
+# there was something wrong with the statement being executed.
+CONNECTION_ERRORS = (DatabaseGoneAwayError, LostConnectionError,
+                     BrokenPipeError)
+
+
+# Error codes caused by the values of particular rows rather than by the
+# statement as a whole - bad NULLs, duplicate or missing keys, values out
+# of range, truncated or in the wrong character set, and dimension lookups
+# matching several rows.
+ROW_ERROR_CODES = frozenset([1048, 1062, 1216, 1242, 1264, 1265, 1292, 1366,
+                             1406, 1451, 1452])
+
+
+def is_row_error(error):
+    """ Return whether an error raised when inserting a batch was caused by
+    the values of some of its rows, so the rest could still be inserted.
+    Errors raised by pylytics itself (rather than MySQL) happen while the
+    values are converted, so are also caused by particular rows.
+    """
+    if isinstance(error, CONNECTION_ERRORS):
+        return False
+    if isinstance(error, (IntegrityError, DataError)):
+        return True
+    if isinstance(error, Error):
+        return error.errno in ROW_ERROR_CODES
+    return True
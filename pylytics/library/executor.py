@@ -0,0 +1,165 @@
+from __future__ import unicode_literals
+import logging
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+import connection
+from metrics import Metrics
+from settings import settings
+from warehouse import Warehouse
+
+
+log = logging.getLogger("pylytics")
+
+
+# The methods called on dimensions and facts for each command which can be
+# run in parallel, along with their keyword arguments. Facts are told not
+# to run the command on their dimensions, as that's done separately.
+COMMANDS = {
+    "build": (("build", {}),
+              ("build", {"dimensions": False})),
+    "update": (("update", {}),
+               ("update", {"dimensions": False})),
+    "historical": (("update", {"historical": True}),
+                   ("update", {"historical": True, "dimensions": False})),
+}
+
+
+def run_task(table, method, kwargs):
+    """ Call a method of a table using a warehouse connection of its own,
+    taken from the connection pool.
+
+    Returns:
+        None if the method succeeded, otherwise a description of the error
+        (exceptions aren't returned, as they can't always be pickled).
+
+    """
+    # Everything, including getting the connection, happens inside the
+    # `try`, as the pool only calls back with the result if the task
+    # returns - so an exception would leave the executor waiting forever.
+    pool = _connection = None
+    try:
+        pool = connection.ConnectionPool.get(settings.pylytics_db)
+        _connection = pool.acquire()
+        Warehouse.use(_connection, thread_local=True)
+        getattr(table, method)(**kwargs)
+    except Exception as exception:
+        log.error("%s.%s failed: %s, %s", table, method,
+                  exception.__class__, exception)
+        if _connection is not None:
+            pool.discard(_connection)
+        return "%s: %s" % (exception.__class__.__name__, exception)
+    else:
+        pool.release(_connection)
+    finally:
+        Warehouse.use(None, thread_local=True)
+
+
+def run_process_task(table, method, kwargs):
+    """ Run a task in a worker process, returning the metrics it collected
+    along with its result, as the parent process writes them out.
+    """
+    error = run_task(table, method, kwargs)
+    return error, Metrics.collect()
+
+
+class ParallelExecutor(object):
+    """ Runs a command for several facts at the same time.
+
+    The facts and the dimensions they reference form a dependency graph.
+    Each dimension is built or updated once, and each fact is started as
+    soon as all of its own dimensions have finished, so independent facts
+    (and dimensions) run concurrently in a pool of threads or processes.
+    If a dimension fails, the facts which depend on it aren't run.
+
+    """
+
+    def __init__(self, command, facts, workers, pool="thread"):
+        if command not in COMMANDS:
+            raise ValueError("The %s command can't be run in parallel" %
+                             command)
+        if pool not in ("thread", "process"):
+            raise ValueError("Unknown pool type '%s'" % pool)
+        self.command = command
+        self.facts = list(facts)
+        self.workers = workers
+        self.pool = pool
+
+    @property
+    def dimensions(self):
+        """ The unique dimensions referenced by the facts, in order.
+        """
+        dimensions = []
+        for fact in self.facts:
+            for dimension in fact.__dimensions__:
+                if dimension not in dimensions:
+                    dimensions.append(dimension)
+        return dimensions
+
+    def run(self):
+        """ Run the command for every dimension and fact.
+
+        Returns:
+            A dictionary of error descriptions, keyed by the name of each
+            dimension or fact which failed.
+
+        """
+        dimension_method, fact_method = COMMANDS[self.command]
+        waiting = {fact: set(fact.__dimensions__) for fact in self.facts}
+        errors = {}
+        finished = Queue()
+
+        pool = (ThreadPool if self.pool == "thread" else Pool)(self.workers)
+
+        def start(table, task):
+            method, kwargs = task
+            if self.pool == "thread":
+                pool.apply_async(
+                    run_task, (table, method, kwargs),
+                    callback=lambda error: finished.put((table, error)))
+            else:
+                pool.apply_async(
+                    run_process_task, (table, method, kwargs),
+                    callback=lambda result: finished.put(
+                        (table, merged(result))))
+
+        def merged(result):
+            error, metrics = result
+            Metrics.merge(metrics)
+            return error
+
+        try:
+            for dimension in self.dimensions:
+                start(dimension, dimension_method)
+            for fact, dimensions in waiting.items():
+                if not dimensions:
+                    del waiting[fact]
+                    start(fact, fact_method)
+
+            running = len(self.dimensions) + len(self.facts)
+            while running:
+                table, error = finished.get()
+                running -= 1
+                if error:
+                    errors[table.__name__] = error
+                for fact, dimensions in waiting.items():
+                    if table not in dimensions:
+                        continue
+                    if error:
+                        # The fact can't be run without the dimension.
+                        del waiting[fact]
+                        running -= 1
+                        errors[fact.__name__] = "%s failed" % table.__name__
+                        log.error("%s.%s not run as %s failed", fact,
+                                  fact_method[0], table.__name__)
+                        continue
+                    dimensions.remove(table)
+                    if not dimensions:
+                        del waiting[fact]
+                        start(fact, fact_method)
+        finally:
+            pool.close()
+            pool.join()
+
+        return errors
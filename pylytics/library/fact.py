@@ -1,14 +1,13 @@
 from __future__ import unicode_literals
-from contextlib import closing
 import logging
 
 from column import *
-from exceptions import classify_error
+from resolver import DimensionIndex
 from schedule import Schedule
 from selector import DimensionSelector
+from settings import settings
 from table import Table
-from utils import dump, escaped
-from warehouse import Warehouse
+from utils import bound_sql, classproperty
 
 
 log = logging.getLogger("pylytics")
@@ -53,28 +52,39 @@ class Fact(Table):
     created = CreatedTimestamp()
 
     @classmethod
-    def build(cls):
-        for dimension_key in cls.__dimensionkeys__:
-            dimension_key.dimension.build()
+    def build(cls, dimensions=True):
+        """ Create this table, first building its dimensions unless
+        `dimensions` is False (if they've been built already).
+        """
+        if dimensions:
+            for dimension_key in cls.__dimensionkeys__:
+                dimension_key.dimension.build()
         super(Fact, cls).build()
 
     @classmethod
-    def update(cls, since=None, historical=False):
+    def update(cls, since=None, historical=False, dimensions=True):
+        """ Update this table, first updating its dimensions unless
+        `dimensions` is False (if they've been updated already).
+        """
         if not (cls.__historical_source__ if historical and
                 cls.__historical_source__ else cls.__source__):
             # Bail early before building dimensions.
             raise NotImplementedError("No data source defined")
 
-        # Remove any duplicate dimensions.
-        unique_dimensions = []
-        for dimension_key in cls.__dimensionkeys__:
-            if dimension_key.dimension not in unique_dimensions:
-                unique_dimensions.append(dimension_key.dimension)
-
-        for dimension in unique_dimensions:
-            dimension.update(since=since, historical=historical)
+        if dimensions:
+            for dimension in cls.__dimensions__:
+                dimension.update(since=since, historical=historical)
         return super(Fact, cls).update(since=since, historical=historical)
 
+    @classmethod
+    def replay_dead_letters(cls):
+        """ Replay the dead letters of this table, after those of its
+        dimensions, so the dimension rows facts refer to exist first.
+        """
+        for dimension in cls.__dimensions__:
+            dimension.replay_dead_letters()
+        super(Fact, cls).replay_dead_letters()
+
     # TODO Consider adding historical to dimensions.
     @classmethod
     def historical(cls):
@@ -88,52 +98,74 @@ class Fact(Table):
         """
         cls.update(historical=True)
 
+    @classproperty
+    def __dimensions__(cls):
+        """ The unique dimensions referenced by this fact's dimension keys.
+        """
+        unique_dimensions = []
+        for dimension_key in cls.__dimensionkeys__:
+            if dimension_key.dimension not in unique_dimensions:
+                unique_dimensions.append(dimension_key.dimension)
+        return unique_dimensions
+
+    @classmethod
+    def _dimension_key_id(cls, column, value, timestamp):
+        """ Look up the primary key of the dimension row referenced by a
+        dimension key value in memory, returning None if it can't be found
+        (in which case a subquery should be used to find it).
+        """
+        if settings.RESOLVE_DIMENSION_KEYS:
+            index = DimensionIndex.get(column.dimension)
+            return index.lookup(value, timestamp)
+        return None
+
     @classmethod
-    def insert(cls, *instances):
-        """ Insert fact instances (overridden to handle Dimensions correctly)
+    def _reader(cls, column):
+        """ Dimension keys are converted to the primary key of the dimension
+        row, or a subquery to find it when the row is inserted. The subquery
+        template for each type of natural key value is only built once.
         """
-        if instances:
-            columns = [column for column in cls.__columns__
-                       if not isinstance(column, AutoColumn)]
-            sql = "%s INTO %s (\n  %s\n)\n" % (
-                cls.INSERT, escaped(cls.__tablename__),
-                ",\n  ".join(escaped(column.name) for column in columns))
-
-            batches = cls.batch(instances)
-            for iteration, batch in enumerate(batches, start=1):
-                log.debug('Inserting batch %s' % (iteration),
-                          extra={"table": cls.__tablename__})
-
-                insert_statement = sql
-                link = "VALUES"
-
-                for instance in batch:
-                    values = []
-                    for column in columns:
-                        value = instance[column.name]
-                        if isinstance(column, DimensionKey):
-                            if not value and column.optional:
-                                values.append(dump(value))
-                            else:
-                                values.append(
-                                    "(%s)" % column.dimension.__subquery__(
-                                        value,
-                                        instance.__dimension_selector__.timestamp(instance) # TODO This is a bit messy - shouldn't have to pass the instance back in.
-                                        )
-                                    )
-                        else:
-                            values.append(dump(value))
-                    insert_statement += link + (" (\n  %s\n)" % ",\n  ".join(values))
-                    link = ","
-
-                connection = Warehouse.get()
-                try:
-                    with closing(connection.cursor()) as cursor:
-                        cursor.execute(insert_statement)
-                except Exception as e:
-                    classify_error(e)
-                    log.error(e)
-                    log.error(insert_statement)
-                    connection.rollback()
-                else:
-                    connection.commit()
+        read = super(Fact, cls)._reader(column)
+        if not isinstance(column, DimensionKey):
+            return read
+
+        dimension = column.dimension
+        templates = {}
+
+        def reader(instance):
+            value = read(instance)
+            if not value and column.optional:
+                return value
+
+            # TODO This is a bit messy - shouldn't have to pass the instance
+            # back in.
+            timestamp = instance.__dimension_selector__.timestamp(instance)
+            primary_key = cls._dimension_key_id(column, value, timestamp)
+            if primary_key is not None:
+                return primary_key
+
+            try:
+                template, count = templates[type(value)]
+            except KeyError:
+                natural_keys = dimension.natural_keys_for(value)
+                template = "(%s)" % dimension.__subquery_template__(
+                    natural_keys)
+                count = 2 * len(natural_keys)
+                templates[type(value)] = template, count
+            return bound_sql(template, (value,) * count + (timestamp,))
+
+        return reader
+
+    @classmethod
+    def _log_insert_error(cls, engine, error):
+        super(Fact, cls)._log_insert_error(engine, error)
+        log.error(engine.statement)
+
+    @classmethod
+    def _log_insert_summary(cls):
+        if settings.RESOLVE_DIMENSION_KEYS:
+            for dimension in cls.__dimensions__:
+                index = DimensionIndex.get(dimension)
+                log.debug("%s keys resolved in memory, %s by subquery",
+                          index.hits, index.misses,
+                          extra={"table": dimension.__tablename__})
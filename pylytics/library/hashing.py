@@ -0,0 +1,188 @@
+""" Client-side calculation of hash keys.
+
+The hash key of a record is `UNHEX(SHA1(CONCAT_WS(',', IFNULL(col,'NULL'),
+...)))` over its composite key columns, as evaluated by MySQL once the
+values have been stored in their columns. Calculating it here means the
+identity of a record is known before it's sent to the database.
+
+Each encoder below returns a value formatted exactly as MySQL would format
+the stored value of a column, or None where that can't be guaranteed (in
+which case MySQL is left to calculate the hash key on insert).
+
+"""
+
+from __future__ import unicode_literals
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+from hashlib import sha1
+
+from utils import bound_sql, raw_sql
+
+
+# The range of values which fit in an INT column.
+INT_RANGE = (-2 ** 31, 2 ** 31 - 1)
+
+# The range of values which fit in a TIMESTAMP column.
+TIMESTAMP_RANGE = (datetime(1970, 1, 1, 0, 0, 1),
+                   datetime(2038, 1, 19, 3, 14, 7))
+
+# The range of values (in seconds) which fit in a TIME column.
+TIME_RANGE = (-838 * 3600 - 59 * 60 - 59, 838 * 3600 + 59 * 60 + 59)
+
+
+def _integer(column, value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, long)) and (
+            INT_RANGE[0] <= value <= INT_RANGE[1]):
+        return unicode(value)
+    return None
+
+
+def _boolean(column, value):
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, long)) and -128 <= value <= 127:
+        return unicode(value)
+    return None
+
+
+def _decimal(column, value):
+    if isinstance(value, bool) or not isinstance(value, (Decimal, int, long)):
+        return None
+    precision, scale = column.size or column.default_size[Decimal]
+    value = Decimal(value).quantize(Decimal(1).scaleb(-scale),
+                                    rounding=ROUND_HALF_UP)
+    if value.adjusted() >= precision - scale:
+        # Out of range, so MySQL would store the closest value instead.
+        return None
+    if value == 0:
+        value = abs(value)
+    return "{:f}".format(value)
+
+
+def _string(column, value):
+    if isinstance(value, str):
+        try:
+            value = value.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+    if not isinstance(value, unicode):
+        return None
+    size = column.size or column.default_size[column.type]
+    # MySQL's utf8 character set only covers the Basic Multilingual Plane.
+    if len(value) > size or any(ord(char) > 0xFFFF for char in value):
+        return None
+    return value
+
+
+def _enum(column, value):
+    if isinstance(value, basestring) and value in column.type:
+        return _string(column, value) if isinstance(value, str) else value
+    return None
+
+
+def _date(column, value):
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return "%04d-%02d-%02d" % (value.year, value.month, value.day)
+    return None
+
+
+def _timestamp(column, value):
+    # Fractional seconds are truncated by some MySQL versions and rounded
+    # by others, and time zones are dropped or converted.
+    if (not isinstance(value, datetime) or value.microsecond or
+            value.tzinfo is not None or
+            not TIMESTAMP_RANGE[0] <= value <= TIMESTAMP_RANGE[1]):
+        return None
+    return "%04d-%02d-%02d %02d:%02d:%02d" % (
+        value.year, value.month, value.day,
+        value.hour, value.minute, value.second)
+
+
+def _time(column, value):
+    if isinstance(value, time):
+        if value.microsecond or value.tzinfo is not None:
+            return None
+        return "%02d:%02d:%02d" % (value.hour, value.minute, value.second)
+    if isinstance(value, timedelta):
+        if value.microseconds:
+            return None
+        seconds = value.days * 86400 + value.seconds
+        if not TIME_RANGE[0] <= seconds <= TIME_RANGE[1]:
+            return None
+        sign = "-" if seconds < 0 else ""
+        minutes, seconds = divmod(abs(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return "%s%02d:%02d:%02d" % (sign, hours, minutes, seconds)
+    return None
+
+
+def _binary(column, value):
+    if not isinstance(value, (bytearray, str)):
+        return None
+    value = bytes(value)
+    if len(value) > (column.size or column.default_size[bytearray]):
+        return None
+    return value
+
+
+_encoders = {
+    bool: _boolean,
+    date: _date,
+    datetime: _timestamp,
+    Decimal: _decimal,
+    int: _integer,
+    long: _integer,
+    timedelta: _time,
+    time: _time,
+    basestring: _string,
+    str: _string,
+    unicode: _string,
+    bytearray: _binary,
+}
+
+
+def encoder_for(column):
+    """ Return the function used to encode values of a column for the hash
+    key, or None if the column's values can't be encoded on the client (for
+    example, MySQL's formatting of DOUBLE values).
+    """
+    if isinstance(column.type, tuple):
+        return _enum
+    return _encoders.get(column.type)
+
+
+def encode(column, value):
+    """ Return the value of a column as a byte string, formatted as MySQL
+    would format it within the hash key expression, or None if this can't
+    be done on the client.
+    """
+    if value is None:
+        # MySQL stores NULL in a NOT NULL column as the implicit default of
+        # its type in non-strict mode (and rejects it in strict mode), so
+        # only optional columns are known to hash as 'NULL'.
+        return b"NULL" if column.optional else None
+    if isinstance(value, (raw_sql, bound_sql)):
+        return None
+    encoder = encoder_for(column)
+    if encoder is None:
+        return None
+    value = encoder(column, value)
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return value
+
+
+def digest(columns, values):
+    """ Return the SHA1 digest of the values of the columns provided, exactly
+    matching MySQL's `UNHEX(SHA1(CONCAT_WS(',', IFNULL(...,'NULL'), ...)))`,
+    or None if this can't be calculated on the client.
+    """
+    parts = []
+    for column, value in zip(columns, values):
+        part = encode(column, value)
+        if part is None:
+            return None
+        parts.append(part)
+    return sha1(b",".join(parts)).digest()
@@ -0,0 +1,505 @@
+""" Engines for writing batches of table instances to the data warehouse.
+
+The engine used for a table is chosen by its `INSERT_ENGINE` attribute,
+falling back to the `INSERT_ENGINE` setting.
+
+"""
+
+from __future__ import unicode_literals
+from contextlib import closing
+from itertools import groupby
+from tempfile import NamedTemporaryFile
+
+from column import DimensionKey, HashKey
+from exceptions import SubqueryRowsError
+from settings import settings
+from timing import Timings
+from utils import bound_sql, dump, escaped, raw_sql
+
+
+# The most placeholders MySQL allows in a single prepared statement.
+MAX_PREPARED_PARAMETERS = 65535
+
+
+def _parameter_size(value):
+    """ Roughly estimate the number of bytes a bound parameter adds to a
+    statement, without converting it to SQL.
+    """
+    if isinstance(value, (basestring, bytearray)):
+        return len(value) + 2
+    return 8
+
+
+class InsertEngine(object):
+    """ Base class for insert engines. An engine is created for each call to
+    `Table.insert` and its `execute` method is called for each batch.
+    Committing, rolling back and retrying are left to the table.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.columns = table.__insertcolumns__
+        self.header = "%s INTO %s (\n  %s\n)\n" % (
+            table.INSERT, escaped(table.__tablename__),
+            ",\n  ".join(escaped(column.name) for column in self.columns))
+        # The last statement executed, which is useful for logging errors.
+        self.statement = None
+        # The approximate number of bytes sent by the last call to execute.
+        self.size = 0
+        # Time spent executing statements is recorded separately from the
+        # time spent building them.
+        self.timings = Timings.get(table)
+
+    def execute(self, connection, batch):
+        """ Write a batch of instances using the connection provided.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """ Release any resources held by the engine once all batches have
+        been executed.
+        """
+        pass
+
+
+class StatementInsert(InsertEngine):
+    """ Writes each batch as a single multi-row INSERT statement, with every
+    value converted to a SQL literal.
+    """
+
+    def execute(self, connection, batch):
+        rows = self.table.__serializer__.rows(batch)
+        self.statement = self.header + "VALUES" + ",".join(rows)
+        self.size = len(self.statement)
+
+        with closing(connection.cursor()) as cursor:
+            with self.timings.stage("execute"):
+                cursor.execute(self.statement)
+
+
+class ExecuteManyInsert(InsertEngine):
+    """ Writes each batch as a multi-row INSERT statement with the values
+    bound as parameters by mysql-connector, rather than being converted to
+    SQL literals by pylytics.
+
+    This is how `cursor.executemany` handles INSERT statements, but it
+    doesn't recognise `INSERT IGNORE` or `REPLACE`, so the statement is
+    built here. Values which are SQL expressions (such as the hash key or a
+    dimension subquery) are written into the statement, so consecutive
+    rows which need the same statement are grouped together.
+
+    """
+
+    # The most statements kept by `_statement` before it starts again.
+    MAX_STATEMENTS = 1000
+
+    def __init__(self, table):
+        super(ExecuteManyInsert, self).__init__(table)
+        self._statements = {}
+
+    def _statement(self, placeholders, count):
+        """ Return the statement for `count` rows with the same placeholders.
+        The same string object is returned each time, as prepared cursors
+        only reuse a statement if they're given the identical object.
+        """
+        key = (placeholders, count)
+        try:
+            return self._statements[key]
+        except KeyError:
+            if len(self._statements) >= self.MAX_STATEMENTS:
+                self._statements.clear()
+            template = "(%s)" % ", ".join(placeholders)
+            statement = self._statements[key] = (
+                self.header + "VALUES " + ",\n".join([template] * count))
+            return statement
+
+    def _rows(self, batch):
+        """ Yield a tuple of the placeholders for each instance, along with
+        the list of parameters to bind to them.
+        """
+        table = self.table
+        for instance in batch:
+            placeholders = []
+            parameters = []
+            for value in table._values(instance):
+                if isinstance(value, raw_sql):
+                    # mysql-connector only substitutes `%s`, and doesn't
+                    # unescape `%%`, so the expression is used as it is.
+                    placeholders.append(value)
+                elif isinstance(value, bound_sql):
+                    placeholders.append(value.template)
+                    parameters.extend(value.parameters)
+                else:
+                    placeholders.append("%s")
+                    parameters.append(value)
+            yield tuple(placeholders), parameters
+
+    def _groups(self, batch):
+        """ Yield each run of consecutive rows with the same placeholders, as
+        the placeholders and a list of parameter lists.
+        """
+        for placeholders, rows in groupby(self._rows(batch),
+                                          lambda row: row[0]):
+            yield placeholders, [parameters for _, parameters in rows]
+
+    def _execute(self, cursor, placeholders, rows):
+        self.statement = self._statement(placeholders, len(rows))
+        parameters = [value for row in rows for value in row]
+        self.size += len(self.statement) + sum(map(_parameter_size,
+                                                   parameters))
+        with self.timings.stage("execute"):
+            cursor.execute(self.statement, parameters)
+
+    def execute(self, connection, batch):
+        self.size = 0
+        with closing(connection.cursor()) as cursor:
+            for placeholders, rows in self._groups(batch):
+                self._execute(cursor, placeholders, rows)
+
+
+class PreparedInsert(ExecuteManyInsert):
+    """ Writes batches using server-side prepared statements, so values are
+    sent using the binary protocol. The cursor is kept open between batches,
+    and given the same statement object for the same placeholders and
+    number of rows, so it's only prepared again when either changes.
+    """
+
+    def __init__(self, table):
+        super(PreparedInsert, self).__init__(table)
+        self._cursor = None
+        self._session = None
+
+    def execute(self, connection, batch):
+        # Prepared statements belong to a session, so a new cursor is needed
+        # if the connection has been re-established.
+        session = (connection, connection.connection_id)
+        if self._session != session:
+            self.close()
+            self._cursor = connection.cursor(prepared=True)
+            self._session = session
+
+        self.size = 0
+        for placeholders, rows in self._groups(batch):
+            size = max(1, MAX_PREPARED_PARAMETERS // max(1, len(rows[0])))
+            for start in xrange(0, len(rows), size):
+                self._execute(self._cursor, placeholders,
+                              rows[start:start + size])
+
+    def close(self):
+        if self._cursor is not None:
+            try:
+                self._cursor.close()
+            except Exception:
+                # The connection has probably gone, taking the prepared
+                # statement with it.
+                pass
+            self._cursor = None
+            self._session = None
+
+
+def _tsv_field(value):
+    """ Convert a value to a field in a file read by LOAD DATA, using the
+    default escaping rules.
+    """
+    if value is None:
+        return "\\N"
+    elif value is True:
+        return "1"
+    elif value is False:
+        return "0"
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, str):
+        value = value.decode("utf-8")
+    elif isinstance(value, bytearray):
+        value = value.decode("utf-8")
+    elif not isinstance(value, unicode):
+        return unicode(value)
+    return (value.replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r")
+            .replace("\0", "\\0"))
+
+
+class LoadDataInsert(ExecuteManyInsert):
+    """ Writes each batch to a temporary tab separated file, which is then
+    sent to MySQL using `LOAD DATA LOCAL INFILE`. This is much faster than
+    INSERT statements for large volumes of data, but requires `local_infile`
+    to be enabled on the server.
+
+    Values which are SQL expressions (such as the hash key or a dimension
+    subquery) are computed using the SET clause, with any parameters they
+    need read from the file into user variables.
+
+    """
+
+    modifiers = {
+        "INSERT IGNORE": "IGNORE ",
+        "INSERT": "",
+        "REPLACE": "REPLACE ",
+    }
+
+    def __init__(self, table):
+        super(LoadDataInsert, self).__init__(table)
+        try:
+            self.modifier = self.modifiers[table.INSERT.upper()]
+        except KeyError:
+            raise ValueError("%s isn't supported by LOAD DATA" % table.INSERT)
+
+    def _load_statement(self, path, placeholders):
+        """ Build the LOAD DATA statement for rows with the placeholders
+        provided.
+        """
+        fields = []
+        assignments = []
+        for position, (column, placeholder) in enumerate(
+                zip(self.columns, placeholders)):
+            if placeholder == "%s":
+                fields.append(escaped(column.name))
+                continue
+            parts = placeholder.split("%s")
+            expression = parts[0]
+            for number, part in enumerate(parts[1:]):
+                variable = "@v%s_%s" % (position, number)
+                fields.append(variable)
+                expression += variable + part
+            assignments.append("%s = %s" % (escaped(column.name),
+                                            expression))
+
+        statement = (
+            "LOAD DATA LOCAL INFILE %s %sINTO TABLE %s CHARACTER SET utf8 "
+            "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' "
+            "(%s)" % (dump(path), self.modifier,
+                      escaped(self.table.__tablename__), ", ".join(fields)))
+        if assignments:
+            statement += " SET " + ", ".join(assignments)
+        return statement
+
+    def _execute(self, cursor, placeholders, rows):
+        with NamedTemporaryFile(prefix="pylytics_", suffix=".tsv") as tsv:
+            for parameters in rows:
+                line = "\t".join(map(_tsv_field, parameters)) + "\n"
+                tsv.write(line.encode("utf-8"))
+            tsv.flush()
+            self.statement = self._load_statement(tsv.name, placeholders)
+            self.size += len(self.statement) + tsv.tell()
+            with self.timings.stage("execute"):
+                cursor.execute(self.statement)
+
+
+class StagingInsert(InsertEngine):
+    """ Writes each batch of fact instances to a temporary staging table,
+    holding the raw natural key values of the dimension keys along with the
+    timestamp used to select each dimension row. A single
+    `INSERT ... SELECT` then resolves every dimension key by joining each
+    dimension on its natural keys and `applicable_from`, so MySQL can use
+    joins over the whole batch rather than a subquery for every value.
+
+    Rows which can't be staged (because a dimension key value doesn't
+    match the type of the dimension's first natural key, or a value is a
+    SQL expression) are written with a normal INSERT instead.
+
+    """
+
+    def __init__(self, table):
+        super(StagingInsert, self).__init__(table)
+        if getattr(table, "__dimensionkeys__", None) is None:
+            raise ValueError("The staging insert engine can only be used "
+                             "with facts")
+        self.staging_table = escaped("staging_" + table.__tablename__)
+        self.fallback = StatementInsert(table)
+
+        # The staging table holds every column apart from the hash key,
+        # which is calculated once the dimension keys have been resolved.
+        self.staged_columns = [column for column in self.columns
+                               if not isinstance(column, HashKey)]
+        self.natural_keys = {}
+        for column in self.staged_columns:
+            if isinstance(column, DimensionKey):
+                first_key = column.dimension.__naturalkeys__[0]
+                self.natural_keys[column.name] = [
+                    key for key in column.dimension.__naturalkeys__
+                    if key.type is first_key.type]
+
+        self.create_statement = self._create_statement()
+        self.select_statement = self._select_statement()
+        self.ambiguous_statement = self._ambiguous_statement()
+
+    def _create_statement(self):
+        """ Build the DDL for the staging table from the columns of the fact.
+        """
+        definitions = ["`_position` INT NOT NULL"]
+        for column in self.staged_columns:
+            name = column.name
+            if isinstance(column, DimensionKey):
+                natural_key = self.natural_keys[name][0]
+                definitions.append("%s %s NULL" % (
+                    escaped(name), natural_key.type_expression))
+                definitions.append("%s DATETIME NULL" % escaped(name + "__at"))
+            else:
+                definitions.append("%s %s NULL" % (
+                    escaped(name), column.type_expression))
+
+        sql = "CREATE TEMPORARY TABLE IF NOT EXISTS %s (\n  %s\n)" % (
+            self.staging_table, ",\n  ".join(definitions))
+        for key, value in self.table.__tableargs__.items():
+            sql += " %s=%s" % (key, value)
+        return sql
+
+    def _select_statement(self):
+        """ Build the INSERT ... SELECT which copies the staged rows into the
+        fact table. Each dimension is joined twice - once to find rows with
+        a matching natural key which were applicable at the time, and again
+        to exclude any of those rows which have been superseded.
+        """
+        references, joins, where = self._joins()
+
+        expressions = []
+        for column in self.columns:
+            if isinstance(column, HashKey):
+                expressions.append(self.table.hash_key_expression(
+                    lambda c: references[c.name]))
+            else:
+                expressions.append(references[column.name])
+
+        sql = self.header + "SELECT\n  %s\nFROM %s AS s\n" % (
+            ",\n  ".join(expressions), self.staging_table)
+        sql += joins + where
+        sql += "ORDER BY s.`_position`"
+        return sql
+
+    def _ambiguous_statement(self):
+        """ Build a query for the position of any staged row which the joins
+        match to more than one row of a dimension (when several rows have
+        the same `applicable_from`). The subquery used by other engines
+        fails in that case, rather than inserting duplicate facts.
+        """
+        _, joins, where = self._joins()
+        return ("SELECT s.`_position`\nFROM %s AS s\n%s%sGROUP BY "
+                "s.`_position`\nHAVING COUNT(*) > 1\nLIMIT 1" % (
+                    self.staging_table, joins, where))
+
+    def _joins(self):
+        """ Return the SQL expression for each staged column (by name), the
+        joins which resolve dimension keys, and the WHERE clause excluding
+        superseded dimension rows.
+        """
+        references = {}
+        joins = []
+        for number, column in enumerate(self.staged_columns):
+            name = column.name
+            if not isinstance(column, DimensionKey):
+                references[name] = "s.%s" % escaped(name)
+                continue
+
+            dimension = column.dimension
+            table_name = escaped(dimension.__tablename__)
+            primary_key = escaped(dimension.__primarykey__.name)
+            found, newer = "d%s" % number, "n%s" % number
+
+            def condition(alias):
+                selector = " OR ".join(
+                    "%s.%s = s.%s" % (alias, escaped(key.name), escaped(name))
+                    for key in self.natural_keys[name])
+                return "(%s) AND %s.`applicable_from` <= s.%s" % (
+                    selector, alias, escaped(name + "__at"))
+
+            joins.append("LEFT JOIN %s AS %s ON %s" % (
+                table_name, found, condition(found)))
+            joins.append(
+                "LEFT JOIN %s AS %s ON %s AND %s.`applicable_from` > "
+                "%s.`applicable_from`" % (table_name, newer, condition(newer),
+                                          newer, found))
+            references[name] = "%s.%s" % (found, primary_key)
+            references[name + "__newer"] = "%s.%s" % (newer, primary_key)
+
+        superseded = ["%s IS NULL" % references[column.name + "__newer"]
+                      for column in self.staged_columns
+                      if isinstance(column, DimensionKey)]
+        where = ("WHERE %s\n" % " AND ".join(superseded)
+                 if superseded else "")
+        return references, "".join(join + "\n" for join in joins), where
+
+    def _staged_row(self, position, instance):
+        """ Return the values to write to the staging table for an instance,
+        or None if it can't be staged.
+        """
+        row = [position]
+        for column in self.staged_columns:
+            value = instance[column.name]
+            if isinstance(value, raw_sql):
+                return None
+            if isinstance(column, DimensionKey):
+                if not value and column.optional:
+                    row.extend([None, None])
+                    continue
+                natural_keys = column.dimension.natural_keys_for(value)
+                if natural_keys != self.natural_keys[column.name]:
+                    return None
+                timestamp = instance.__dimension_selector__.timestamp(instance)
+                row.extend([value, timestamp])
+            else:
+                row.append(value)
+        return row
+
+    def execute(self, connection, batch):
+        self.size = 0
+        staged = []
+        unstaged = []
+        for position, instance in enumerate(batch):
+            row = self._staged_row(position, instance)
+            if row is None:
+                unstaged.append(instance)
+            else:
+                staged.append(row)
+
+        if staged:
+            with closing(connection.cursor()) as cursor:
+                with self.timings.stage("execute"):
+                    cursor.execute(self.create_statement)
+                    cursor.execute("DELETE FROM %s" % self.staging_table)
+                template = "(%s)" % ", ".join(["%s"] * len(staged[0]))
+                self.statement = "INSERT INTO %s VALUES %s" % (
+                    self.staging_table, ", ".join([template] * len(staged)))
+                parameters = [value for row in staged for value in row]
+                self.size = len(self.statement) + sum(map(_parameter_size,
+                                                          parameters))
+                with self.timings.stage("execute"):
+                    cursor.execute(self.statement, parameters)
+                    self.statement = self.ambiguous_statement
+                    cursor.execute(self.statement)
+                    ambiguous = cursor.fetchall()
+                    if ambiguous:
+                        raise SubqueryRowsError(
+                            msg="Subquery returns more than 1 row (more "
+                                "than one dimension row is applicable to "
+                                "row %s of the batch)" % ambiguous[0][0],
+                            errno=SubqueryRowsError.code, sqlstate="21000")
+                    self.statement = self.select_statement
+                    cursor.execute(self.statement)
+
+        if unstaged:
+            self.fallback.execute(connection, unstaged)
+            self.statement = self.fallback.statement
+            self.size += self.fallback.size
+
+
+ENGINES = {
+    "statement": StatementInsert,
+    "executemany": ExecuteManyInsert,
+    "prepared": PreparedInsert,
+    "load_data": LoadDataInsert,
+    "staging": StagingInsert,
+}
+
+
+def get_engine(table):
+    """ Return a new instance of the insert engine configured for a table.
+    """
+    name = table.INSERT_ENGINE or settings.INSERT_ENGINE or "statement"
+    try:
+        engine_class = ENGINES[name]
+    except KeyError:
+        raise ValueError("Unknown insert engine '%s' for %s - choose from "
+                         "%s" % (name, table.__name__,
+                                 ", ".join(sorted(ENGINES))))
+    return engine_class(table)
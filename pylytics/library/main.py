@@ -1,14 +1,25 @@
 import argparse
 import datetime
+from functools import partial
 import inspect
 import logging
 from logging.handlers import TimedRotatingFileHandler
 import sys
 
+from batching import BatchSizer
+from benchmark import benchmark
 import connection
+from context import RunContext
 from log import ColourFormatter, bright_white
+from dedupe import Deduplicator
+from executor import COMMANDS, ParallelExecutor
 from fact import Fact
+from metrics import Metrics
+from resolver import DimensionIndex
+from schema import SchemaRegistry
+from timing import Timings
 from warehouse import Warehouse
+from watermark import Watermark
 from settings import Settings, settings
 
 
@@ -74,10 +85,18 @@ def find_scheduled(all_fact_classes):
     return facts_to_update
 
 
+# Commands which aren't methods of the fact classes, but functions called
+# with each fact.
+FUNCTIONS = {
+    "benchmark": benchmark,
+}
+
+
 class Commander(object):
 
-    def run(self, command, *facts):
-        """ Run command for each fact in facts.
+    def run(self, command, *facts, **kwargs):
+        """ Run command for each fact in facts, passing it any keyword
+        arguments given.
         """
         all_fact_classes = get_all_fact_classes()
 
@@ -102,30 +121,54 @@ class Commander(object):
             facts_to_run = list(set(facts_to_run))
 
         if command != 'template':
-            _connection = connection.get_named_connection(settings.pylytics_db)
-            Warehouse.use(_connection)
-
-        # Execute the command on each fact class.
-        for fact_class in facts_to_run:
-            try:
-                command_function = getattr(fact_class, command)
-            except AttributeError:
-                log.error("Cannot find command %s for fact class %s",
-                          command, fact_class)
-                continue
-
-            try:
-                command_function()
-            except Exception as exception:
-                # Catch all exceptions so one failed command doesn't bring
-                # down all facts.
-                log.error("%s.%s failed: %s, %s", fact_class, command,
-                    exception.__class__, exception.message)
+            pool = connection.ConnectionPool.get(settings.pylytics_db)
+            Warehouse.use(pool.acquire())
+            DimensionIndex.invalidate()
+            Deduplicator.invalidate()
+            SchemaRegistry.invalidate()
+            BatchSizer.invalidate()
+            Timings.invalidate()
+            Metrics.invalidate()
+            Watermark.invalidate()
+
+        # Dimensions shared by several facts are only updated once per run.
+        with RunContext():
+            workers = settings.PARALLEL_WORKERS
+            if workers > 1 and command in COMMANDS and len(facts_to_run) > 1:
+                executor = ParallelExecutor(command, facts_to_run, workers,
+                                            pool=settings.PARALLEL_POOL)
+                errors = executor.run()
+                if errors:
+                    log.error("%s commands not executed: %s", len(errors),
+                              ", ".join(sorted(errors)))
+                facts_to_run = []
+
+            # Execute the command on each fact class.
+            for fact_class in facts_to_run:
+                try:
+                    if command in FUNCTIONS:
+                        command_function = partial(FUNCTIONS[command],
+                                                   fact_class)
+                    else:
+                        command_function = getattr(fact_class, command)
+                except AttributeError:
+                    log.error("Cannot find command %s for fact class %s",
+                              command, fact_class)
+                    continue
+
+                try:
+                    command_function(**kwargs)
+                except Exception as exception:
+                    # Catch all exceptions so one failed command doesn't bring
+                    # down all facts.
+                    log.error("%s.%s failed: %s, %s", fact_class, command,
+                        exception.__class__, exception.message)
 
         if command != 'template':
-            # Close the Warehouse connection.
-            log.info('Closing Warehouse connection.')
-            Warehouse.get().close()
+            # Return the Warehouse connection to the pool.
+            log.info('Releasing Warehouse connection.')
+            pool.release(Warehouse.get())
+            Metrics.flush()
 
 
 # TODO Make this configurable via settings.py.
@@ -161,6 +204,25 @@ def main():
         nargs = 1,
         type = str,
         )
+    parser.add_argument(
+        '--rows',
+        help = 'The number of fact rows the benchmark command generates.',
+        type = int,
+        default = 100000,
+        )
+    parser.add_argument(
+        '--dims',
+        help = 'The number of rows the benchmark command generates for '
+               'each dimension.',
+        type = int,
+        default = 1000,
+        )
+    parser.add_argument(
+        '--engines',
+        help = 'The insert engines the benchmark command compares e.g. '
+               'statement,executemany (all of them by default).',
+        type = str,
+        )
     parser.add_argument(
         'fact',
         help = 'The name(s) of the fact(s) to run e.g. fact_example.',
@@ -195,10 +257,17 @@ def main():
     if command in ('update', 'historical'):
         commander.run('build', *args['fact'])
         commander.run(command, *args['fact'])
-    elif command in ('build', 'template'):
+    elif command in ('build', 'template', 'reset_watermark',
+                     'replay_dead_letters'):
         commander.run(command, *args['fact'])
+    elif command == 'benchmark':
+        engines = args['engines'].split(',') if args['engines'] else None
+        commander.run(command, *args['fact'], rows=args['rows'],
+                      dimension_rows=args['dims'], engines=engines)
     else:
         log.error("Unknown command: %s", command)
 
+    connection.ConnectionPool.close_all()
+
     sys.stdout.write(bright_white("\nCompleted at {}\n\n".format(
         datetime.datetime.now())))
@@ -0,0 +1,198 @@
+from __future__ import unicode_literals
+from collections import defaultdict
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+from settings import settings
+
+
+log = logging.getLogger("pylytics")
+
+
+def _name(name):
+    """ Convert a name to one which can be used in metric names.
+    """
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace(
+        "\n", "\\n")
+
+
+class Metrics(object):
+    """ Counters and durations for each table, collected during a run and
+    written to the sink chosen by METRICS_SINK at the end of it, since
+    pylytics isn't running long enough to be scraped.
+
+    Counters are named after what they count (such as 'rows_fetched'), and
+    durations after what was timed (such as 'batch'), in seconds. Nothing
+    is recorded unless METRICS_SINK is set.
+
+    """
+
+    # The largest UDP packet sent to StatsD.
+    PACKET_SIZE = 512
+
+    # Counts and durations collected so far, keyed by table name and
+    # metric name.
+    __counters = defaultdict(int)
+    __durations = defaultdict(list)
+    __lock = threading.Lock()
+
+    @classmethod
+    def increment(cls, table, name, value=1):
+        """ Add to a counter for a table.
+        """
+        if value and settings.METRICS_SINK:
+            with cls.__lock:
+                cls.__counters[(table.__tablename__, name)] += value
+
+    @classmethod
+    def observe(cls, table, name, seconds):
+        """ Record a duration for a table.
+        """
+        if settings.METRICS_SINK:
+            with cls.__lock:
+                cls.__durations[(table.__tablename__, name)].append(seconds)
+
+    @classmethod
+    def invalidate(cls):
+        """ Discard everything collected so far.
+        """
+        with cls.__lock:
+            cls.__counters.clear()
+            cls.__durations.clear()
+
+    @classmethod
+    def collect(cls):
+        """ Return everything collected so far and start again. This is used
+        to pass metrics back from processes running tables in parallel.
+        """
+        with cls.__lock:
+            collected = (dict(cls.__counters), dict(cls.__durations))
+            cls.__counters.clear()
+            cls.__durations.clear()
+        return collected
+
+    @classmethod
+    def merge(cls, collected):
+        """ Add metrics returned by `collect` (in another process).
+        """
+        counters, durations = collected
+        with cls.__lock:
+            for key, value in counters.items():
+                cls.__counters[key] += value
+            for key, values in durations.items():
+                cls.__durations[key].extend(values)
+
+    @classmethod
+    def flush(cls):
+        """ Write everything collected to the configured sink, then discard
+        it. Errors are logged rather than raised, so a broken sink doesn't
+        fail the run.
+        """
+        sink = settings.METRICS_SINK
+        if not sink:
+            return
+        counters, durations = cls.collect()
+        try:
+            if sink == "prometheus":
+                cls._write_textfile(counters, durations,
+                                    settings.METRICS_TEXTFILE)
+            elif sink == "statsd":
+                cls._send_statsd(counters, durations, settings.STATSD_HOST,
+                                 settings.STATSD_PORT)
+            else:
+                log.error("Unknown METRICS_SINK '%s' - choose from "
+                          "prometheus, statsd", sink)
+        except Exception as error:
+            log.error("Unable to write metrics to %s: %s", sink, error)
+
+    @classmethod
+    def _prefix(cls):
+        return _name(settings.METRICS_PREFIX or "pylytics")
+
+    @classmethod
+    def textfile(cls, counters, durations, now=None):
+        """ Format metrics in the Prometheus text exposition format.
+
+        The file is written afresh by each run, so everything in it is a
+        gauge holding the value for the last run - counters or histograms
+        would go back to zero each run, making `rate()` meaningless.
+        """
+        prefix = cls._prefix()
+        gauges = defaultdict(list)
+        for (table, name), value in counters.items():
+            gauges["%s_last_run_%s" % (prefix, _name(name))].append(
+                (table, value))
+        for (table, name), values in durations.items():
+            metric = "%s_last_run_%s" % (prefix, _name(name))
+            gauges[metric + "_seconds_sum"].append((table, repr(sum(values))))
+            gauges[metric + "_seconds_max"].append((table, repr(max(values))))
+            gauges[metric + "_count"].append((table, len(values)))
+
+        lines = []
+        for metric, values in sorted(gauges.items()):
+            lines.append("# TYPE %s gauge" % metric)
+            for table, value in sorted(values):
+                lines.append('%s{table="%s"} %s' % (metric, _label(table),
+                                                    value))
+
+        metric = "%s_last_run_timestamp_seconds" % prefix
+        lines.append("# TYPE %s gauge" % metric)
+        lines.append("%s %s" % (metric, int(now or time.time())))
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def _write_textfile(cls, counters, durations, path):
+        """ Write the metrics to a file for the node exporter's textfile
+        collector. The file is replaced atomically, so it's never read half
+        written.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "w") as f:
+            f.write(cls.textfile(counters, durations).encode("utf-8"))
+        os.chmod(temporary, 0o644)
+        os.rename(temporary, path)
+        log.info("Metrics written to %s", path)
+
+    @classmethod
+    def statsd_lines(cls, counters, durations):
+        """ Format metrics as StatsD counters and timers (in milliseconds).
+        """
+        prefix = cls._prefix()
+        lines = []
+        for (table, name), value in sorted(counters.items()):
+            lines.append("%s.%s.%s:%s|c" % (prefix, _name(table),
+                                             _name(name), value))
+        for (table, name), values in sorted(durations.items()):
+            for value in values:
+                lines.append("%s.%s.%s:%.3f|ms" % (
+                    prefix, _name(table), _name(name), value * 1000))
+        return lines
+
+    @classmethod
+    def _send_statsd(cls, counters, durations, host, port):
+        """ Send the metrics to StatsD over UDP, packing as many as fit in
+        each packet.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            packet = ""
+            for line in cls.statsd_lines(counters, durations):
+                if packet and len(packet) + len(line) + 1 > cls.PACKET_SIZE:
+                    sock.sendto(packet.encode("utf-8"), (host, port))
+                    packet = ""
+                packet = packet + "\n" + line if packet else line
+            if packet:
+                sock.sendto(packet.encode("utf-8"), (host, port))
+        finally:
+            sock.close()
+        log.info("Metrics sent to StatsD at %s:%s", host, port)
@@ -0,0 +1,142 @@
+from __future__ import unicode_literals
+from bisect import bisect_right
+from contextlib import closing
+import logging
+
+from utils import escaped
+from warehouse import Warehouse
+
+
+log = logging.getLogger("pylytics")
+
+
+def _hashable(value):
+    """ Natural key values are used as dictionary keys, so mutable types
+    such as bytearray need converting first.
+    """
+    if isinstance(value, bytearray):
+        return bytes(value)
+    return value
+
+
+class DimensionIndex(object):
+    """ An in-memory, point-in-time index of the rows in a dimension table.
+
+    Each natural key value maps to the `applicable_from` timestamps and
+    primary keys of the rows containing it, sorted by timestamp. The row
+    which was valid at a given point in time can then be found with a
+    bisect, rather than MySQL running a correlated subquery for every
+    dimension key of every fact row.
+
+    """
+
+    # Indexes which have been loaded so far, keyed by dimension class.
+    __indexes = {}
+
+    def __init__(self, dimension, rows):
+        """
+        Args:
+            dimension - a Dimension class.
+            rows - an iterable of tuples, each containing the values of the
+                natural keys (in `__naturalkeys__` order) followed by the
+                `applicable_from` timestamp and primary key of a row.
+        """
+        self.dimension = dimension
+        self.hits = 0
+        self.misses = 0
+
+        natural_keys = dimension.__naturalkeys__
+        position = len(natural_keys)
+        self.__entries = {key.name: {} for key in natural_keys}
+
+        for row in sorted(rows, key=lambda row: row[position]):
+            applicable_from, primary_key = row[position], row[position + 1]
+            for key, value in zip(natural_keys, row):
+                if value is None:
+                    continue
+                entries = self.__entries[key.name]
+                timestamps, ids = entries.setdefault(_hashable(value),
+                                                     ([], []))
+                timestamps.append(applicable_from)
+                ids.append(primary_key)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.__entries.values())
+
+    @classmethod
+    def load(cls, dimension):
+        """ Read the natural keys, `applicable_from` and primary key of
+        every row in the dimension table into a new index.
+        """
+        columns = [key.name for key in dimension.__naturalkeys__]
+        columns += ["applicable_from", dimension.__primarykey__.name]
+        sql = "SELECT %s FROM %s" % (", ".join(map(escaped, columns)),
+                                     escaped(dimension.__tablename__))
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql)
+            index = cls(dimension, cursor.fetchall())
+
+        log.debug("Loaded %s natural key values into memory", len(index),
+                  extra={"table": dimension.__tablename__})
+        return index
+
+    @classmethod
+    def get(cls, dimension):
+        """ Return the index for a dimension, loading it the first time it
+        is requested.
+        """
+        try:
+            return cls.__indexes[dimension]
+        except KeyError:
+            index = cls.__indexes[dimension] = cls.load(dimension)
+            return index
+
+    @classmethod
+    def invalidate(cls, dimension=None):
+        """ Discard the index for a dimension (or all indexes if no dimension
+        is given) so that it's reloaded the next time it's needed. This
+        should be called whenever rows are added to the dimension table.
+        """
+        if dimension is None:
+            cls.__indexes.clear()
+        else:
+            cls.__indexes.pop(dimension, None)
+
+    def lookup(self, value, timestamp):
+        """ Find the primary key of the dimension row matching the natural key
+        value which was applicable at the timestamp provided. This follows
+        the same rules as `Dimension.__subquery__`.
+
+        Returns:
+            The primary key, or None if no single row could be found (in
+            which case the subquery should be used instead).
+
+        """
+        candidates = set()
+        value = _hashable(value)
+        for key in self.dimension.natural_keys_for(value):
+            try:
+                timestamps, ids = self.__entries[key.name][value]
+            except KeyError:
+                continue
+            position = bisect_right(timestamps, timestamp)
+            if position:
+                latest = timestamps[position - 1]
+                while position and timestamps[position - 1] == latest:
+                    position -= 1
+                    candidates.add((latest, ids[position]))
+
+        if candidates:
+            latest = max(applicable_from for applicable_from, _ in candidates)
+            ids = {id_ for applicable_from, id_ in candidates
+                   if applicable_from == latest}
+            # The subquery would return more than one row in this case, so
+            # let MySQL decide what to do with it.
+            if len(ids) == 1:
+                self.hits += 1
+                return ids.pop()
+
+        self.misses += 1
+        return None
@@ -0,0 +1,92 @@
+from __future__ import unicode_literals
+from contextlib import closing
+import logging
+import threading
+
+from utils import escaped
+from warehouse import Warehouse
+
+
+log = logging.getLogger("pylytics")
+
+
+class SchemaRegistry(object):
+    """ Records the `schema_fingerprint` of each table when it's built, in a
+    table in the data warehouse, so that tables which haven't changed
+    since they were last built don't need building again.
+
+    The fingerprints are read once per run (see `invalidate`).
+
+    """
+
+    __tablename__ = "pylytics_schema"
+
+    __fingerprints = None
+    __lock = threading.Lock()
+
+    @classmethod
+    def create_table(cls):
+        sql = """\
+        CREATE TABLE IF NOT EXISTS %s (
+          `table_name` VARCHAR(64) NOT NULL PRIMARY KEY,
+          `fingerprint` CHAR(40) NOT NULL,
+          `built` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB CHARSET=utf8 COLLATE=utf8_bin
+        """ % escaped(cls.__tablename__)
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql)
+
+    @classmethod
+    def fingerprints(cls):
+        """ Return the fingerprints of every table built, keyed by table
+        name, reading them the first time they're needed.
+        """
+        with cls.__lock:
+            if cls.__fingerprints is None:
+                cls.create_table()
+                sql = "SELECT `table_name`, `fingerprint` FROM %s" % (
+                    escaped(cls.__tablename__))
+                connection = Warehouse.get()
+                with closing(connection.cursor()) as cursor:
+                    cursor.execute(sql)
+                    cls.__fingerprints = dict(cursor.fetchall())
+            return cls.__fingerprints
+
+    @classmethod
+    def invalidate(cls):
+        """ Discard the fingerprints read, so they're read again the next
+        time they're needed.
+        """
+        with cls.__lock:
+            cls.__fingerprints = None
+
+    @classmethod
+    def is_current(cls, table):
+        """ Return True if the table exists and was last built with its
+        current fingerprint.
+        """
+        fingerprint = cls.fingerprints().get(table.__tablename__)
+        return (fingerprint == table.schema_fingerprint and
+                table.table_exists)
+
+    @classmethod
+    def record(cls, table):
+        """ Record the current fingerprint of a table which has been built.
+        """
+        fingerprints = cls.fingerprints()
+        # The registry is only created when first read, so make sure it
+        # still exists.
+        cls.create_table()
+        sql = "REPLACE INTO %s (`table_name`, `fingerprint`) " \
+              "VALUES (%%s, %%s)" % escaped(cls.__tablename__)
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql, (table.__tablename__,
+                                 table.schema_fingerprint))
+        connection.commit()
+        with cls.__lock:
+            fingerprints[table.__tablename__] = table.schema_fingerprint
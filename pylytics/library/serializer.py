@@ -0,0 +1,124 @@
+""" Conversion of table instances to the values inserted for them.
+
+A `RowSerializer` is created for each table class by `TableMetaclass`. The
+work of finding each column's attribute and choosing how to convert its
+values is done once, when the serializer is created, so converting a row
+is a single pass over a list of functions.
+
+"""
+
+from __future__ import unicode_literals
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from column import HashKey
+from utils import dump
+
+
+def _quoted(value):
+    return "'%s'" % value.replace("'", "''")
+
+
+def _boolean(value):
+    return "1" if value else "0"
+
+
+def _temporal(value):
+    return "'%s'" % value
+
+
+# SQL literal encoders for the values expected in columns of each type,
+# along with the exact types of value they handle. Anything else (such as
+# NULL, or a SQL expression) is converted by `utils.dump`.
+_encoders = {
+    bool: ((bool,), _boolean),
+    int: ((int, long), unicode),
+    long: ((int, long), unicode),
+    float: ((float,), unicode),
+    Decimal: ((Decimal,), unicode),
+    date: ((date,), _temporal),
+    datetime: ((datetime,), _temporal),
+    time: ((time,), _temporal),
+    timedelta: ((timedelta,), _temporal),
+    basestring: ((unicode,), _quoted),
+    unicode: ((unicode,), _quoted),
+    str: ((unicode,), _quoted),
+}
+
+
+def literal_encoder(column):
+    """ Return a function which converts values of a column to SQL literals,
+    exactly as `utils.dump` would, but checking for the type expected in the
+    column first.
+    """
+    kind = column.type
+    if isinstance(kind, tuple):
+        # Enum values are strings.
+        kind = unicode
+    try:
+        types, encode = _encoders[kind]
+    except KeyError:
+        return dump
+
+    def encoder(value):
+        if type(value) in types:
+            return encode(value)
+        return dump(value)
+
+    return encoder
+
+
+class RowSerializer(object):
+    """ Converts instances of a table to the values inserted for them, in
+    the order of `__insertcolumns__`.
+
+    The value of each column is read by the function returned by the
+    table's `_reader` classmethod for it, and converted to a SQL literal by
+    an encoder chosen for the type of the column.
+
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.columns = table.__insertcolumns__
+        self.names = [column.name for column in self.columns]
+        self.__readers = {column.name: table._reader(column)
+                          for column in self.columns}
+        self.readers = [self.__readers[name] for name in self.names]
+        self.encoders = [literal_encoder(column) for column in self.columns]
+        self.hash_key = next((position for position, column
+                              in enumerate(self.columns)
+                              if isinstance(column, HashKey)), None)
+
+    def value(self, instance, column):
+        """ Return the value to insert for one column of an instance.
+        """
+        try:
+            reader = self.__readers[column.name]
+        except KeyError:
+            reader = self.__readers[column.name] = self.table._reader(column)
+        return reader(instance)
+
+    def values(self, instance):
+        """ Return the values to insert for an instance. These can be
+        `raw_sql` or `bound_sql` expressions to be evaluated by MySQL.
+        """
+        values = [read(instance) for read in self.readers]
+        position = self.hash_key
+        if position is not None and values[position] is None:
+            values[position] = self.table._hash_key_value(
+                dict(zip(self.names, values)))
+        return values
+
+    def literals(self, instance):
+        """ Return the values to insert for an instance as SQL literals.
+        """
+        return [encode(value) for encode, value
+                in zip(self.encoders, self.values(instance))]
+
+    def rows(self, instances):
+        """ Return the VALUES tuple of each instance, as SQL.
+        """
+        literals = self.literals
+        return [" (\n  %s\n)" % ",\n  ".join(literals(instance))
+                for instance in instances]
@@ -1,15 +1,23 @@
+from collections import OrderedDict
 from contextlib import closing
+from itertools import islice
 import json
 import logging
+import threading
+import time
 
 from column import *
 from connection import NamedConnection
+from exceptions import (classify_error, BrokenPipeError,
+                        DatabaseGoneAwayError, LostConnectionError)
 from table import Table
-from utils import dump
+from timing import Timings
+from resolver import _hashable
+from utils import dump, escaped
 from warehouse import Warehouse
 
 
-__all__ = ['Source', 'DatabaseSource']
+__all__ = ['Source', 'DatabaseSource', 'CachedExpansion']
 log = logging.getLogger("pylytics")
 
 
@@ -30,8 +38,19 @@ def hydrated(cls, data):
 
 class Source(object):
     """ Base class for data sources used by `fetch`.
+
+    If `watermark` names a column of the table, the highest value of that
+    column fetched by each update is recorded, and passed to the next
+    update as `since` (see `Watermark`).
+
     """
 
+    watermark = None
+
+    # The maximum number of rows passed through the expansions together,
+    # when any of them are batched (see `DatabaseSource.expand`).
+    expansion_batch_size = 1000
+
     @classmethod
     def define(cls, **attributes):
         return type(cls.__name__, (cls,), attributes)
@@ -53,15 +72,48 @@ class Source(object):
 
     @classmethod
     def select(cls, for_class, since=None):
+        # Rows are only expanded together if an expansion can make use of
+        # it, so otherwise each row is yielded as soon as it's expanded.
+        batched = any(isinstance(exp, type) and
+                      issubclass(exp, DatabaseSource) and exp.batch_query
+                      for exp in getattr(cls, "expansions", []))
+        batch_size = cls.expansion_batch_size if batched else 1
+        timings = Timings.get(for_class)
+
         for source in (cls.execute(since=since),
                        getattr(cls, 'extra_rows', [])):
-            for record in source:
-                dict_record = dict(record)
-                cls._apply_expansions(dict_record)
-                yield hydrated(for_class, dict_record.items())
+            records = iter(source)
+            while True:
+                with timings.stage("source"):
+                    dict_records = [dict(record) for record in
+                                    islice(records, batch_size)]
+                if not dict_records:
+                    break
+                with timings.stage("expansions"):
+                    cls._apply_expansions(*dict_records)
+                with timings.stage("hydrate"):
+                    instances = [hydrated(for_class, dict_record.items())
+                                 for dict_record in dict_records]
+                for instance in instances:
+                    yield instance
+
+    @classmethod
+    def log_statistics(cls, for_class):
+        """ Log the hit rates of any cached expansions, then reset them.
+        """
+        for exp in getattr(cls, "expansions", []):
+            if isinstance(exp, CachedExpansion) and exp.lookups:
+                log.info("%s: %s cache hits from %s lookups (%.1f%%)",
+                         exp, exp.hits, exp.lookups,
+                         100.0 * exp.hits / exp.lookups,
+                         extra={"table": for_class.__tablename__})
+                exp.reset_statistics()
 
     @classmethod
-    def _apply_expansions(cls, data):
+    def _apply_expansions(cls, *rows):
+        """ Pass each row of data through the expansions in turn. Batched
+        DatabaseSource expansions run one query for all the rows.
+        """
         try:
             expansions = getattr(cls, "expansions")
         except AttributeError:
@@ -69,10 +121,15 @@ class Source(object):
         else:
             for exp in expansions:
                 if isinstance(exp, type) and issubclass(exp, DatabaseSource):
-                    for record in exp.execute(**data):
-                        data.update(record)
+                    if exp.batch_query:
+                        exp.expand(rows)
+                        continue
+                    for data in rows:
+                        for record in exp.execute(**data):
+                            data.update(record)
                 elif hasattr(exp, "__call__"):
-                    exp(data)
+                    for data in rows:
+                        exp(data)
                 else:
                     log.debug("Unexpected expansion type: %s",
                               exp.__class__.__name__)
@@ -83,15 +140,80 @@ class DatabaseSource(Source):
     data. This class is intended to be overridden with the `database`
     and `query` attributes populated with appropriate values.
 
+    By default the whole result is read into memory before any rows are
+    yielded. Setting `stream` to True reads the rows from the server
+    `chunk_size` at a time instead, as they're needed. If `stream_key`
+    names a unique column in the results, then `ORDER BY stream_key` is
+    appended to the query (which mustn't have an ORDER BY or LIMIT of its
+    own), and if the connection drops the query is run again, skipping
+    the rows already received (up to `stream_reconnects` times).
+
+    When used as an expansion, `query` is run once per row, with the
+    values of the row available as parameters. Setting `batch_query` and
+    `batch_key` runs one query for many rows instead (see `expand`).
+
     (See unit tests for example of usage)
 
     """
 
+    stream = False
+    stream_key = None
+    stream_reconnects = 3
+    chunk_size = 1000
+
+    batch_query = None
+    batch_key = None
+
     @classmethod
     def execute(cls, **params):
-        database = getattr(cls, "database")
         query = getattr(cls, "query").format(
             **{key: dump(value) for key, value in params.items()})
+        return cls._execute(query)
+
+    @classmethod
+    def expand(cls, rows):
+        """ Expand many rows of data with a single query, rather than
+        running `query` for each row.
+
+        The distinct, non-null values of `batch_key` in the rows are
+        substituted into `batch_query` as a parenthesised list, e.g.
+
+            batch_query = ("SELECT id AS product_id, name AS product_name "
+                           "FROM product WHERE id IN {product_id}")
+            batch_key = "product_id"
+
+        Each record returned must include `batch_key`, and is merged into
+        every row with the same value, as if `query` had been run for it.
+
+        """
+        key = cls.batch_key
+        values, seen = [], set()
+        for data in rows:
+            value = _hashable(data.get(key))
+            if value is not None and value not in seen:
+                seen.add(value)
+                values.append(value)
+        if not values:
+            return
+
+        query = cls.batch_query.format(
+            **{key: "(%s)" % ", ".join(map(dump, values))})
+        records = {}
+        for record in cls._execute(query):
+            records.setdefault(_hashable(record[key]), []).append(record)
+
+        for data in rows:
+            for record in records.get(_hashable(data.get(key)), []):
+                data.update(record)
+
+    @classmethod
+    def _execute(cls, query):
+        database = getattr(cls, "database")
+
+        if cls.stream:
+            for row in cls._stream(database, query):
+                yield row
+            return
 
         with NamedConnection(database) as connection:
             with closing(connection.cursor(dictionary=True)) as cursor:
@@ -105,6 +227,56 @@ class DatabaseSource(Source):
         for row in rows:
             yield row
 
+    @classmethod
+    def _stream(cls, database, query):
+        """ Yield the rows of the query as they're read from an unbuffered
+        cursor, reconnecting and resuming after `stream_key` if the
+        connection is lost.
+        """
+        key = cls.stream_key
+        last_value = NotImplemented
+        reconnects = 0
+
+        if key is None:
+            statement = query
+        else:
+            # The ORDER BY is appended to the query itself, as wrapping it
+            # in a derived table makes MySQL read and sort the whole result
+            # before returning the first row. The same statement is run
+            # again when resuming, skipping the rows already received.
+            statement = "%s ORDER BY %s" % (query.rstrip().rstrip(";"),
+                                            escaped(key))
+
+        while True:
+            try:
+                with NamedConnection(database) as connection:
+                    # The cursor isn't closed explicitly, as that fails if
+                    # the result hasn't been read to the end. Closing the
+                    # connection is enough.
+                    cursor = connection.cursor(dictionary=True)
+                    cursor.execute(statement)
+                    while True:
+                        rows = cursor.fetchmany(cls.chunk_size)
+                        if not rows:
+                            return
+                        for row in rows:
+                            if key is not None:
+                                if (last_value is not NotImplemented and
+                                        row[key] <= last_value):
+                                    continue
+                                last_value = row[key]
+                            yield row
+            except Exception as error:
+                classify_error(error)
+                if (key is None or reconnects >= cls.stream_reconnects or
+                        not isinstance(error, (BrokenPipeError,
+                                               DatabaseGoneAwayError,
+                                               LostConnectionError))):
+                    raise
+                reconnects += 1
+                log.warning("Connection lost while streaming from %s (%s), "
+                            "resuming after %s", database, error, last_value)
+
 
 class CallableSource(Source):
     """ A data source which is generated from a callable object
@@ -123,3 +295,125 @@ class CallableSource(Source):
         kwargs = getattr(cls, "kwargs", {})
         for row in _callable(*args, **kwargs):
             yield row
+
+
+class _RecordingDict(dict):
+    """ A dictionary which records the keys set in it, including those set
+    to the value they already had.
+    """
+
+    def __init__(self, data):
+        super(_RecordingDict, self).__init__(data)
+        self.keys_set = set()
+
+    def __setitem__(self, key, value):
+        self.keys_set.add(key)
+        super(_RecordingDict, self).__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        values = dict(*args, **kwargs)
+        self.keys_set.update(values)
+        super(_RecordingDict, self).update(values)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.keys_set.add(key)
+        return super(_RecordingDict, self).setdefault(key, default)
+
+
+class CachedExpansion(object):
+    """ Wraps an expansion (a function or a DatabaseSource) which is a pure
+    lookup, caching the values it sets (and the keys it removes) for each
+    row of data so they can be reapplied to any later row with the same
+    key, without running the expansion again.
+
+    e.g. expansions=[CachedExpansion(CurrencyLookup, key=['currency'])]
+
+    Args:
+        expansion - the expansion to cache.
+        key - the names of the values in each row which determine the
+            changes the expansion makes, or a function returning a
+            hashable key for a row.
+        size - the maximum number of keys cached, after which the least
+            recently used are discarded.
+        ttl - if given, the number of seconds after which a cached key is
+            looked up again.
+
+    """
+
+    def __init__(self, expansion, key, size=1000, ttl=None):
+        self.expansion = expansion
+        if callable(key):
+            self.key = key
+        else:
+            names = list(key)
+            self.key = lambda data: tuple(_hashable(data.get(name))
+                                          for name in names)
+        self.size = size
+        self.ttl = ttl
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+        self.reset_statistics()
+
+    def __repr__(self):
+        return "CachedExpansion(%s)" % getattr(
+            self.expansion, "__name__", self.expansion)
+
+    def reset_statistics(self):
+        self.hits = 0
+        self.lookups = 0
+
+    def _expand(self, data):
+        """ Run the expansion on a copy of the data, returning the values
+        it sets and the keys it removes.
+
+        Every value set is returned, even if the data already had it, as a
+        later row with the same key may not.
+        """
+        expanded = _RecordingDict(data)
+        expansion = self.expansion
+        if isinstance(expansion, type) and issubclass(expansion,
+                                                      DatabaseSource):
+            for record in expansion.execute(**expanded):
+                expanded.update(record)
+        else:
+            expansion(expanded)
+        updates = {key: value for key, value in expanded.items()
+                   if key in expanded.keys_set or key not in data or
+                   data[key] != value}
+        removed = [key for key in data if key not in expanded]
+        return updates, removed
+
+    def __call__(self, data):
+        key = self.key(data)
+        now = time.time()
+        # The cache may be shared by sources fetched in several threads.
+        # The expansion itself is run without the lock held, so two threads
+        # can occasionally look up the same key at once.
+        with self.__lock:
+            self.lookups += 1
+            try:
+                expires, (updates, removed) = self.__cache.pop(key)
+            except KeyError:
+                cached = False
+            else:
+                cached = expires is None or expires > now
+                if cached:
+                    self.hits += 1
+                    self.__cache[key] = (expires, (updates, removed))
+        if cached:
+            self.__apply(data, updates, removed)
+            return
+
+        updates, removed = self._expand(data)
+        expires = None if self.ttl is None else now + self.ttl
+        with self.__lock:
+            self.__cache[key] = (expires, (updates, removed))
+            while len(self.__cache) > self.size:
+                self.__cache.popitem(last=False)
+        self.__apply(data, updates, removed)
+
+    def __apply(self, data, updates, removed):
+        data.update(updates)
+        for key in removed:
+            data.pop(key, None)
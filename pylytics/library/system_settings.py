@@ -1,4 +1,87 @@
-# For now the batch size is hardcoded (i.e. the number of rows inserted per
-# insert statement). Eventually this will be dynamically sized based on the 
-# max packet size.
+# The number of rows inserted per insert statement (or the initial number,
+# if ADAPTIVE_BATCHING is enabled).
 BATCH_SIZE = 1000
+
+# Size batches dynamically for each table, so that statements get as close
+# as possible to BATCH_TARGET_BYTES (limited by the server's
+# max_allowed_packet) and take no more than BATCH_TARGET_SECONDS to
+# execute, with at most BATCH_MAX_SIZE rows.
+ADAPTIVE_BATCHING = False
+BATCH_TARGET_BYTES = 4 * 1024 * 1024
+BATCH_TARGET_SECONDS = 2.0
+BATCH_MAX_SIZE = 50000
+
+# Look up the primary keys of dimension rows from an in-memory index of each
+# dimension when inserting facts, instead of using a subquery per value.
+RESOLVE_DIMENSION_KEYS = True
+
+# The engine used to write batches of records to the data warehouse, unless
+# a table specifies its own INSERT_ENGINE. One of 'statement' (SQL literals),
+# 'executemany' (parameters bound by the client) or 'prepared' (server-side
+# prepared statements).
+INSERT_ENGINE = "statement"
+
+# Drop records before inserting them if a record with the same hash key has
+# already been inserted during this run or already exists in the table.
+# Only applies to tables using INSERT IGNORE.
+DEDUPLICATE = False
+
+# The number of primary keys read at once when loading the hash keys which
+# already exist in a table.
+DEDUPLICATE_RANGE_SIZE = 100000
+
+# The false positive rate of the Bloom filter holding existing hash keys.
+# False positives are checked against the table, so this only affects the
+# number of lookups made.
+DEDUPLICATE_ERROR_RATE = 0.01
+
+# The number of facts which are built or updated at the same time by
+# manage.py. The dimensions they share are built and updated once, before
+# any of the facts which depend on them. Set to 1 to run facts one at a time.
+PARALLEL_WORKERS = 1
+
+# Whether parallel facts are run in separate 'thread's or 'process'es. Each
+# worker uses its own connection to the data warehouse either way.
+PARALLEL_POOL = "thread"
+
+# The number of idle connections kept open to each database, so they can be
+# reused rather than reconnecting for each query. Set to 0 to disable.
+CONNECTION_POOL_SIZE = 5
+
+# The age (in seconds) after which pooled connections are closed rather
+# than reused. This should be less than the server's wait_timeout.
+CONNECTION_RECYCLE = 3600
+
+# Fetch records from the source in a separate thread while earlier batches
+# are being inserted, rather than alternating between the two.
+PIPELINE = False
+
+# The number of fetched batches which can be waiting to be inserted when
+# PIPELINE is enabled. Fetching pauses while this many are waiting.
+PIPELINE_QUEUE_SIZE = 4
+
+# Where records which couldn't be inserted are written, one file per table.
+# Failed batches are split up until the records causing the failure are
+# found, and those are written here so they can be replayed with the
+# replay_dead_letters command.
+DEAD_LETTER_DIRECTORY = "dead_letters"
+
+# The benchmark command drops and rebuilds the tables it inserts synthetic
+# data into, so it only runs if this is True. Only enable it for a scratch
+# data warehouse.
+ALLOW_BENCHMARK = False
+
+# Record the time spent in each stage of updating a table (running the
+# source query, expansions, hydrating records, building SQL, executing it
+# and committing), and log a summary once each table has been updated.
+STAGE_TIMINGS = False
+
+# Where to write metrics (rows fetched, inserted, ignored and rejected,
+# batches, retries, reconnects and durations for each table) at the end of
+# each run - 'prometheus' for a file read by the node exporter's textfile
+# collector, 'statsd' to send them over UDP, or None to not collect them.
+METRICS_SINK = None
+METRICS_PREFIX = "pylytics"
+METRICS_TEXTFILE = "/var/lib/node_exporter/textfile_collector/pylytics.prom"
+STATSD_HOST = "localhost"
+STATSD_PORT = 8125
@@ -1,15 +1,29 @@
 from __future__ import unicode_literals
+from binascii import hexlify
 from contextlib import closing
+from hashlib import sha1
+from itertools import islice
 import logging
-import math
+import time
 
+from batching import BatchSizer
 from column import *
-from exceptions import classify_error, BrokenPipeError
+from dedupe import Deduplicator
+from deadletter import DeadLetters
+from exceptions import (classify_error, is_row_error, BrokenPipeError,
+                        CONNECTION_ERRORS)
+import hashing
+from insert import get_engine
+from metrics import Metrics
+from schema import SchemaRegistry
+from serializer import RowSerializer
 from settings import settings
 from template import TemplateConstructor
-from utils import (_camel_to_snake, _camel_to_title_case, dump, escaped,
-                   classproperty, raw_sql)
+from timing import Timings
+from utils import (_camel_to_snake, _camel_to_title_case, escaped,
+                   bound_sql, classproperty, pipelined, raw_sql)
 from warehouse import Warehouse
+from watermark import Watermark
 
 
 log = logging.getLogger("pylytics")
@@ -69,6 +83,9 @@ class TableMetaclass(type):
     of magic attributes which are used chiefly for reflection.
     """
 
+    # Serializers which have been created so far, keyed by table class.
+    __serializers = {}
+
     def __new__(mcs, name, bases, attributes):
         tablename = _camel_to_snake(name)
         if 'dimension' in [i.__name__.lower() for i in bases]:
@@ -82,10 +99,34 @@ class TableMetaclass(type):
         column_set.update(attributes)
 
         attributes["__columns__"] = column_set.columns
+        attributes["__insertcolumns__"] = [
+            column for column in column_set.columns
+            if not isinstance(column, AutoColumn)]
         attributes["__primarykey__"] = column_set.primary_key
 
+        # The values of a record are held in the `__values__` slot of
+        # `Table`, so records of its subclasses need no instance dictionary.
+        attributes.setdefault("__slots__", ())
+
         cls = super(TableMetaclass, mcs).__new__(mcs, name, bases, attributes)
 
+        # The position of the value of each column in `__values__`, by
+        # column name, so values can be looked up by name without searching
+        # the class. Class dictionaries are read directly, rather than using
+        # `getattr`, so class properties aren't evaluated before the class
+        # is ready. Columns added to a class after it's created can't be
+        # looked up.
+        namespace = {}
+        for klass in reversed(cls.__mro__):
+            namespace.update(klass.__dict__)
+        column_positions = {}
+        for key in sorted(namespace):
+            column = namespace[key]
+            if isinstance(column, Column) and not key.startswith("_"):
+                column_positions.setdefault(column.name,
+                                            len(column_positions))
+        cls.__columnpositions__ = column_positions
+
         # These attributes apply to subclasses so should only be populated
         # if an attribute exists with that name. We do this after class
         # creation as the attribute keys will probably only exist in a
@@ -101,6 +142,18 @@ class TableMetaclass(type):
 
         return cls
 
+    @property
+    def __serializer__(cls):
+        """ The `RowSerializer` for this table class. It's created the first
+        time it's needed rather than in `__new__`, as the class has to be
+        complete (and bound to its name) first.
+        """
+        try:
+            return cls.__serializers[cls]
+        except KeyError:
+            serializer = cls.__serializers[cls] = RowSerializer(cls)
+            return serializer
+
 
 class Table(object):
     """ Base class for all Table classes. The class represents the table
@@ -108,11 +161,20 @@ class Table(object):
 
     This class has two main subclasses: Fact and Dimension.
 
+    The values of a record are kept in a list, in the order of
+    `__columnpositions__`, rather than in an instance dictionary, as
+    millions of records can be held at once during a large load. Values are
+    read and written by column name, or as attributes (see
+    `Column.__get__`), and are None until they're set. Records have no
+    other attributes.
+
     """
     __metaclass__ = TableMetaclass
+    __slots__ = ("__values__",)
 
     # All these attributes should get populated by the metaclass.
     __columns__ = NotImplemented
+    __insertcolumns__ = NotImplemented
     __primarykey__ = NotImplemented
     __tablename__ = NotImplemented
 
@@ -127,17 +189,65 @@ class Table(object):
 
     INSERT = "INSERT IGNORE"
 
+    # The name of the engine used to write records (see `insert.ENGINES`).
+    # If None, the INSERT_ENGINE setting is used.
+    INSERT_ENGINE = None
+
+    def __new__(cls, *args, **kwargs):
+        record = super(Table, cls).__new__(cls)
+        record.__values__ = [None] * len(cls.__columnpositions__)
+        return record
+
     def __init__(self, *args, **kwargs):
+        # The hash key is left unset, so it's calculated on insert.
+        pass
+
+    def digest(self):
+        """ Return the hash key of this record, calculated on the client in
+        exactly the same way as MySQL calculates `hash_key_expression`. This
+        allows records to be deduplicated before they're inserted.
+
+        Returns:
+            A 20 byte SHA1 digest, or None if it can't be calculated on the
+            client (in which case MySQL calculates it on insert).
+
+        """
+        return hashing.digest(
+            self.__compositekey__,
+            [self._value(self, column) for column in self.__compositekey__])
+
+    @classmethod
+    def hash_key_expression(cls, reference=None):
+        """ Return the SQL expression used to calculate the hash key from
+        the composite key columns.
+
+        Args:
+            reference - a function returning the SQL used to refer to the
+                value of a column, which defaults to the column name.
+        """
+        reference = reference or (lambda column: escaped(column.name))
         values = ', '.join(
-            ["IFNULL(%s,'NULL')" % escaped(c.name) for c in
-            self.__compositekey__]
+            ["IFNULL(%s,'NULL')" % reference(c) for c in
+            cls.__compositekey__]
             )
-        self['hash_key'] = raw_sql("UNHEX(SHA1(CONCAT_WS(',', %s)))" % values)
+        return raw_sql("UNHEX(SHA1(CONCAT_WS(',', %s)))" % values)
 
     @classproperty
     def trigger_name(cls):
         return 'created_timestamp_' + cls.__tablename__
 
+    @classproperty
+    def trigger_statement(cls):
+        return """\
+        CREATE TRIGGER %s
+        BEFORE INSERT ON %s
+        FOR EACH ROW BEGIN
+            IF NEW.created = '0000-00-00 00:00:00' THEN
+                SET NEW.created = NOW();
+            END IF;
+        END
+        """ % (cls.trigger_name, cls.__tablename__)
+
     @classmethod
     def create_trigger(cls):
         """ There's a constraint in earlier versions of MySQL where only one
@@ -154,24 +264,15 @@ class Table(object):
             log.info('%s already exists - skipping.' % cls.trigger_name)
             return False
 
-        trigger = """\
-        CREATE TRIGGER %s
-        BEFORE INSERT ON %s
-        FOR EACH ROW BEGIN
-            IF NEW.created = '0000-00-00 00:00:00' THEN
-                SET NEW.created = NOW();
-            END IF;
-        END
-        """ % (cls.trigger_name, cls.__tablename__)
-
         connection = Warehouse.get()
         with closing(connection.cursor()) as cursor:
             try:
-                cursor.execute(trigger)
+                cursor.execute(cls.trigger_statement)
             except Exception as exception:
                 classify_error(exception)
                 raise exception
             else:
+                Warehouse.trigger_created(cls.trigger_name, cls.__tablename__)
                 log.info('%s created.' % cls.trigger_name)
                 return True
 
@@ -179,9 +280,50 @@ class Table(object):
     def build(cls):
         """ Create this table. Override this method to also create
         dependent tables and any related views that do not already exist.
+
+        Nothing is done if the table was last built with the same
+        `schema_fingerprint` and still exists. If the fingerprint has
+        changed but the table exists, a warning is logged, and the new
+        fingerprint isn't recorded until the table is created again. An
+        existing table without a fingerprint (built before they were
+        recorded) has its current fingerprint recorded as a baseline.
         """
-        cls.create_table()
+        if SchemaRegistry.is_current(cls):
+            log.debug("Schema unchanged since last build - skipping.",
+                      extra={"table": cls.__tablename__})
+            return
+        created = cls.create_table()
         cls.create_trigger()
+        if created:
+            SchemaRegistry.record(cls)
+        elif cls.__tablename__ not in SchemaRegistry.fingerprints():
+            log.debug("Recording the schema of the existing table.",
+                      extra={"table": cls.__tablename__})
+            SchemaRegistry.record(cls)
+        else:
+            # Existing tables aren't altered, so recording the fingerprint
+            # would hide the difference from now on.
+            log.warning("Schema has changed since the table was built, but "
+                        "the existing table hasn't been altered.",
+                        extra={"table": cls.__tablename__})
+
+    @classproperty
+    def schema_fingerprint(cls):
+        """ A hash of the definition of this table - its columns, indexes,
+        table options and trigger.
+        """
+        parts = [column.expression for column in cls.__columns__]
+        parts += cls.index_expressions
+        parts += ["%s=%s" % item for item in sorted(cls.__tableargs__.items())]
+        parts.append(cls.trigger_statement)
+        return sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+    @classproperty
+    def index_expressions(cls):
+        if hasattr(cls, '__naturalkeys__'):
+            return [col.index_expression for col in cls.__naturalkeys__]
+        else:
+            return []
 
     @classmethod
     def create_table(cls):
@@ -198,11 +340,7 @@ class Table(object):
 
         verb = "CREATE TABLE"
         columns = [col.expression for col in cls.__columns__]
-
-        if hasattr(cls, '__naturalkeys__'):
-            indexes = [col.index_expression for col in cls.__naturalkeys__]
-        else:
-            indexes = []
+        indexes = cls.index_expressions
 
         body = ",\n  ".join(columns + indexes)
 
@@ -219,6 +357,7 @@ class Table(object):
                 classify_error(exception)
                 raise exception
             else:
+                Warehouse.table_created(cls.__tablename__)
                 return True
 
     @classmethod
@@ -239,6 +378,7 @@ class Table(object):
                 connection.rollback()
             else:
                 connection.commit()
+                Warehouse.table_dropped(cls.__tablename__)
 
     @classproperty
     def table_exists(cls):
@@ -264,80 +404,309 @@ class Table(object):
                 raise
             else:
                 # Only mark as finished if we've not had errors.
-                source.finish(cls)
+                with Timings.get(cls).stage("finish"):
+                    source.finish(cls)
+                source.log_statistics(cls)
         else:
             raise NotImplementedError("No data source defined")
 
     @classmethod
-    def batch(cls, instances):
-        """ Subdivides instances into smaller batches ready for insertion."""
-        batch_size = settings.BATCH_SIZE
-        batch_number = int(math.ceil(len(instances) / float(batch_size)))
-        batches = [instances[i * batch_size:(i + 1) * batch_size] for i in xrange(batch_number)]
-        return batches
+    def batch(cls, instances, sizer=None):
+        """ Subdivides instances into smaller batches ready for insertion.
+
+        Any iterable can be supplied, and each batch is yielded as soon as
+        it is full, so a generator is never read further ahead than the
+        batch currently being built. If a BatchSizer is given, the size of
+        each batch is taken from it.
+
+        """
+        iterator = iter(instances)
+        while True:
+            batch_size = sizer.rows if sizer else settings.BATCH_SIZE
+            batch = list(islice(iterator, batch_size))
+            if not batch:
+                return
+            yield batch
 
     @classmethod
-    def insert(cls, *instances):
-        """ Insert one or more instances into the table as records.
+    def _reader(cls, column):
+        """ Return a function which reads the value to insert for a column
+        from an instance. This is called once per column when the class is
+        created (see `RowSerializer`), so anything which doesn't depend on
+        the instance should be worked out here rather than per value.
         """
-        if instances:
-            columns = [column for column in cls.__columns__
-                       if not isinstance(column, AutoColumn)]
+        position = cls.__columnpositions__[column.name]
 
-            sql = "%s INTO %s (\n  %s\n)\n" % (
-                cls.INSERT, escaped(cls.__tablename__),
-                ",\n  ".join(escaped(column.name) for column in columns))
+        def reader(instance):
+            return instance.__values__[position]
 
-            batches = cls.batch(instances)
-            for iteration, batch in enumerate(batches, start=1):
-                log.debug('Inserting batch %s' % (iteration),
-                          extra={"table": cls.__tablename__})
+        return reader
+
+    @classmethod
+    def _value(cls, instance, column):
+        """ Return the value to insert for a column of an instance. This can
+        also be a `raw_sql` or `bound_sql` expression to be evaluated by
+        MySQL.
+        """
+        return cls.__serializer__.value(instance, column)
+
+    @classmethod
+    def _values(cls, instance):
+        """ Return the values to insert for each of `__insertcolumns__`.
+
+        Unless it has been set explicitly, the hash key is calculated from
+        the values being inserted, falling back to `hash_key_expression`
+        if it can't be calculated on the client.
+
+        """
+        return cls.__serializer__.values(instance)
+
+    @classmethod
+    def _hash_key_value(cls, values):
+        """ Return the hash key to insert for a record, given a dictionary of
+        its values keyed by column name.
+        """
+        digest = hashing.digest(
+            cls.__compositekey__,
+            [values[column.name] for column in cls.__compositekey__])
+        if digest is None:
+            return cls.hash_key_expression()
+        return bound_sql("UNHEX(%s)", [hexlify(digest)])
 
-                insert_statement = sql
-                link = "VALUES"
-
-                for instance in batch:
-                    values = []
-                    for column in columns:
-                        value = instance[column.name]
-                        values.append(dump(value))
-                    insert_statement += link + (" (\n  %s\n)" % ",\n  ".join(values))
-                    link = ","
-
-                for i in range(1, 3):
-                    connection = Warehouse.get()
-                    try:
-                        cursor = connection.cursor()
-                        cursor.execute(insert_statement)
-                        cursor.close()
-
-                    except Exception as e:
-                        classify_error(e)
-                        if e.__class__ == BrokenPipeError and i == 1:
-                            log.info(
-                                'Trying once more with a fresh connection',
-                                extra={"table": cls.__tablename__}
-                                )
-                            connection.close()
+    @classmethod
+    def insert(cls, *instances):
+        """ Insert one or more instances into the table as records.
+
+        Returns:
+            True if every record was either inserted, or written to the dead
+            letter file of the table because it couldn't be.
+
+        """
+        complete = True
+        if instances:
+            engine = get_engine(cls)
+            deduplicator = (Deduplicator.get(cls)
+                            if Deduplicator.applies_to(cls) else None)
+            sizer = (BatchSizer.get(cls) if settings.ADAPTIVE_BATCHING
+                     else None)
+            timings = Timings.get(cls)
+            try:
+                batches = (sizer.batches(instances) if sizer else
+                           cls.batch(instances))
+                for iteration, batch in enumerate(batches, start=1):
+                    if deduplicator:
+                        count = len(batch)
+                        with timings.stage("deduplicate"):
+                            batch = deduplicator.filter(batch)
+                        Metrics.increment(cls, "rows_ignored",
+                                          count - len(batch))
+                        if not batch:
+                            continue
+
+                    log.debug('Inserting batch %s' % (iteration),
+                              extra={"table": cls.__tablename__})
+
+                    for i in range(1, 3):
+                        connection = Warehouse.get()
+                        try:
+                            started = time.time()
+                            with timings.stage("build"):
+                                engine.execute(connection, batch)
+                            if sizer:
+                                sizer.record(len(batch), engine.size,
+                                             time.time() - started)
+                        except Exception as e:
+                            classify_error(e)
+                            if e.__class__ == BrokenPipeError and i == 1:
+                                log.info(
+                                    'Trying once more with a fresh connection',
+                                    extra={"table": cls.__tablename__}
+                                    )
+                                Metrics.increment(cls, "reconnects")
+                                connection.close()
+                            else:
+                                cls._log_insert_error(engine, e)
+                                # Discard anything the engine did insert
+                                # before failing, or bisecting would insert
+                                # it again.
+                                if not isinstance(e, CONNECTION_ERRORS):
+                                    connection.rollback()
+                                with timings.stage("bisect"):
+                                    failures = cls._bisect(engine, batch, e)
+                                try:
+                                    DeadLetters.write_rejected(cls, failures)
+                                except Exception as error:
+                                    log.error(
+                                        "Unable to write %s dead letters: %s",
+                                        len(failures), error,
+                                        extra={"table": cls.__tablename__})
+                                    complete = False
+                                rejected = set(id(instance)
+                                               for instance, _ in failures)
+                                cls._record_batch(batch, rejected, started)
+                                if deduplicator:
+                                    deduplicator.inserted(
+                                        [inst for inst in batch
+                                         if id(inst) not in rejected])
+                                break
                         else:
-                            log.error(e)
-                            return
-                    else:
-                        connection.commit()
-                        break
+                            with timings.stage("commit"):
+                                connection.commit()
+                            cls._record_batch(batch, (), started)
+                            if deduplicator:
+                                deduplicator.inserted(batch)
+                            break
+            finally:
+                engine.close()
+            cls._log_insert_summary()
 
         log.debug('Finished updating %s' % cls.__tablename__,
                   extra={"table": cls.__tablename__})
+        return complete
+
+    @classmethod
+    def _log_insert_error(cls, engine, error):
+        """ Log an error raised when inserting a batch, before the records
+        which can be inserted are picked out of it.
+        """
+        log.error(error)
+
+    @classmethod
+    def _log_insert_summary(cls):
+        """ Log anything worth knowing once all the batches passed to
+        `insert` have been written.
+        """
+        pass
+
+    @classmethod
+    def _record_batch(cls, batch, rejected, started):
+        """ Update the metrics for a batch which has been inserted, apart
+        from any rejected records.
+        """
+        Metrics.increment(cls, "batches")
+        Metrics.increment(cls, "rows_inserted", len(batch) - len(rejected))
+        Metrics.increment(cls, "rows_rejected", len(rejected))
+        Metrics.observe(cls, "batch", time.time() - started)
+
+    @classmethod
+    def _bisect(cls, engine, batch, error):
+        """ Insert what can be inserted of a batch which failed with `error`.
+
+        If the error was caused by the values of some of the records (see
+        `is_row_error`), the batch is split in half and each half inserted
+        separately, splitting again any half which fails, until the records
+        which can't be inserted are isolated. Otherwise - for example if the
+        table doesn't exist, or the connection was lost - every record would
+        fail in the same way, so none of the batch is inserted.
+
+        Returns:
+            A list of each record which couldn't be inserted, along with the
+            error it failed with.
+
+        """
+        if len(batch) == 1 or not is_row_error(error):
+            return [(instance, error) for instance in batch]
+
+        rejected = []
+        middle = len(batch) // 2
+        for half in (batch[:middle], batch[middle:]):
+            Metrics.increment(cls, "retries")
+            connection = Warehouse.get()
+            try:
+                engine.execute(connection, half)
+            except Exception as e:
+                classify_error(e)
+                if not isinstance(e, CONNECTION_ERRORS):
+                    connection.rollback()
+                rejected.extend(cls._bisect(engine, half, e))
+            else:
+                connection.commit()
+        return rejected
 
     @classmethod
     def update(cls, since=None, historical=False):
         """ Fetch some data from source and insert it directly into the table.
+
+        Records are inserted a batch at a time as they are fetched, so only
+        one batch is held in memory at once. If the PIPELINE setting is
+        enabled, records are fetched in a separate thread while earlier
+        batches are inserted, up to PIPELINE_QUEUE_SIZE batches ahead.
+
+        If the source has a `watermark` column, then unless `since` is given
+        it defaults to the highest value of that column fetched by the last
+        update, and the new highest value is recorded once all the records
+        have been inserted (or written to the dead letter file, to be
+        replayed). If any were lost, the watermark is left where it was so
+        they're fetched again. Historical updates ignore watermarks.
         """
-        instances = list(cls.fetch(since=since, historical=historical))
-        count = len(instances)
+        started = time.time()
+        watermark = (None if historical else
+                     getattr(cls.__source__, "watermark", None))
+        if watermark and since is None:
+            since = Watermark.get(cls)
+            if since is not None:
+                log.info("Fetching records since %s", since,
+                         extra={"table": cls.__tablename__})
+        high_water_mark = None
+
+        deduplicator = (Deduplicator.get(cls)
+                        if Deduplicator.applies_to(cls) else None)
+        skipped = deduplicator.skipped if deduplicator else 0
+
+        sizer = BatchSizer.get(cls) if settings.ADAPTIVE_BATCHING else None
+        batches = cls.batch(cls.fetch(since=since, historical=historical),
+                            sizer=sizer)
+        if settings.PIPELINE:
+            batches = pipelined(batches, settings.PIPELINE_QUEUE_SIZE)
+
+        count = 0
+        complete = True
+        for batch in batches:
+            count += len(batch)
+            log.debug("Fetched %s records so far", count,
+                      extra={"table": cls.__tablename__})
+            if watermark:
+                for inst in batch:
+                    value = inst[watermark]
+                    if value is not None and (high_water_mark is None or
+                                              value > high_water_mark):
+                        high_water_mark = value
+            if not cls.insert(*batch):
+                complete = False
         log.info("Fetched %s record%s", count, "" if count == 1 else "s",
                  extra={"table": cls.__tablename__})
-        cls.insert(*instances)
+        Metrics.increment(cls, "rows_fetched", count)
+
+        if deduplicator:
+            skipped = deduplicator.skipped - skipped
+            log.info("Skipped %s duplicate record%s", skipped,
+                     "" if skipped == 1 else "s",
+                     extra={"table": cls.__tablename__})
+
+        if high_water_mark is not None and (since is None or
+                                            high_water_mark > since):
+            if complete:
+                Watermark.set(cls, high_water_mark)
+            else:
+                log.warning("Watermark not advanced, as some records were "
+                            "lost", extra={"table": cls.__tablename__})
+
+        Metrics.observe(cls, "update", time.time() - started)
+        Timings.log_summary(cls)
+
+    @classmethod
+    def reset_watermark(cls):
+        """ Discard the watermark of this table, so that the next update
+        fetches all of its records again.
+        """
+        Watermark.reset(cls)
+
+    @classmethod
+    def replay_dead_letters(cls):
+        """ Insert the records which were written to the dead letter file of
+        this table because they couldn't be inserted.
+        """
+        DeadLetters.replay(cls)
 
     @classmethod
     def template(cls):
@@ -346,21 +715,29 @@ class Table(object):
     def __getitem__(self, column_name):
         """ Get a value by table column name.
         """
-        for key in dir(self):
-            if not key.startswith("_"):
-                column = getattr(self.__class__, key, None)
-                if isinstance(column, Column) and column.name == column_name:
-                    value = getattr(self, key)
-                    return None if value is column else value
-        raise KeyError("No such table column '%s'" % column_name)
+        try:
+            position = self.__columnpositions__[column_name]
+        except KeyError:
+            raise KeyError("No such table column '%s'" % column_name)
+        return self.__values__[position]
 
     def __setitem__(self, column_name, value):
         """ Set a value by table column name.
         """
-        for key in dir(self):
-            if not key.startswith("_"):
-                column = getattr(self.__class__, key, None)
-                if isinstance(column, Column) and column.name == column_name:
-                    setattr(self, key, value)
-                    return
-        raise KeyError("No such table column '%s'" % column_name)
+        try:
+            position = self.__columnpositions__[column_name]
+        except KeyError:
+            raise KeyError("No such table column '%s'" % column_name)
+        self.__values__[position] = value
+
+    def __getstate__(self):
+        # Records have no instance dictionary, so can't be pickled without
+        # this.
+        return {name: self.__values__[position]
+                for name, position in self.__columnpositions__.items()}
+
+    def __setstate__(self, state):
+        # Unpickling doesn't necessarily call `__new__`.
+        self.__values__ = [None] * len(self.__columnpositions__)
+        for name, value in state.items():
+            self[name] = value
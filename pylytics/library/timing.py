@@ -0,0 +1,157 @@
+from __future__ import unicode_literals
+from collections import defaultdict
+import json
+import logging
+import threading
+from timeit import default_timer
+
+from settings import settings
+
+
+log = logging.getLogger("pylytics")
+
+
+class _NullStage(object):
+    """ Used in place of a stage when timings are disabled, so timing costs
+    no more than a couple of method calls.
+    """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _NullTimings(object):
+
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+
+class _Stage(object):
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.children = 0.0
+        self.timings._stack().append(self)
+        self.started = default_timer()
+
+    def __exit__(self, *exc_info):
+        elapsed = default_timer() - self.started
+        stack = self.timings._stack()
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        self.timings._add(self.name, elapsed - self.children)
+        return False
+
+
+class Timings(object):
+    """ The time spent in each stage of fetching and inserting the records
+    of a table (such as running the source query, hydrating, building SQL
+    and executing it), accumulated over a run.
+
+    Stages can be nested, in which case time spent in the inner stage isn't
+    counted towards the outer one. Each thread has its own stack of stages,
+    so fetching and inserting can be timed while pipelined.
+
+    If the STAGE_TIMINGS setting is disabled, `get` returns an object whose
+    stages do nothing.
+
+    """
+
+    # Timings which have been created so far, keyed by table class.
+    __timings = {}
+    __lock = threading.Lock()
+
+    _null = _NullTimings()
+
+    def __init__(self, table):
+        self.table = table
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.__local = threading.local()
+
+    @classmethod
+    def get(cls, table):
+        """ Return the timings for a table, creating them the first time
+        they're requested.
+        """
+        if not settings.STAGE_TIMINGS:
+            return cls._null
+        try:
+            return cls.__timings[table]
+        except KeyError:
+            with cls.__lock:
+                return cls.__timings.setdefault(table, cls(table))
+
+    @classmethod
+    def invalidate(cls, table=None):
+        """ Discard the timings for a table (or all timings if no table is
+        given).
+        """
+        with cls.__lock:
+            if table is None:
+                cls.__timings.clear()
+            else:
+                cls.__timings.pop(table, None)
+
+    def _stack(self):
+        try:
+            return self.__local.stack
+        except AttributeError:
+            stack = self.__local.stack = []
+            return stack
+
+    def _add(self, name, seconds):
+        with self.__lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+
+    def stage(self, name):
+        """ Return a context manager which times a stage.
+        """
+        return _Stage(self, name)
+
+    @property
+    def summary(self):
+        """ The total time spent in each stage and the number of times it
+        was entered, as a dictionary which can be written as JSON.
+        """
+        with self.__lock:
+            stages = {name: {"seconds": round(seconds, 6),
+                             "calls": self.calls[name]}
+                      for name, seconds in self.seconds.items()}
+        return {
+            "table": self.table.__tablename__,
+            "stages": stages,
+            "seconds": round(sum(s["seconds"] for s in stages.values()), 6),
+        }
+
+    @classmethod
+    def log_summary(cls, table):
+        """ Log the timings of a table, both readably and as JSON (which is
+        also passed to log handlers as the `timings` attribute of the
+        record), then discard them.
+        """
+        if not settings.STAGE_TIMINGS:
+            return
+        with cls.__lock:
+            timings = cls.__timings.pop(table, None)
+        if timings is None:
+            return
+
+        summary = timings.summary
+        stages = sorted(summary["stages"].items(),
+                        key=lambda item: item[1]["seconds"], reverse=True)
+        log.info("Time spent: %s", ", ".join(
+            "%s %.3fs" % (name, stage["seconds"]) for name, stage in stages),
+            extra={"table": table.__tablename__, "timings": summary})
+        log.debug("Timings: %s", json.dumps(summary, sort_keys=True),
+                  extra={"table": table.__tablename__, "timings": summary})
@@ -1,6 +1,9 @@
 from datetime import date, datetime, time, timedelta
+from Queue import Full, Queue
 import re
 import string
+import sys
+import threading
 
 
 # MySQL minimum timestamps are slightly above the Unix epoch.
@@ -17,6 +20,20 @@ class raw_sql(str):
     pass
 
 
+class bound_sql(object):
+    """ A SQL expression containing %s placeholders, along with the values to
+    substitute for them. These are either bound as parameters or, when
+    dumped, converted to SQL literals.
+    """
+
+    def __init__(self, template, parameters):
+        self.template = template
+        self.parameters = tuple(parameters)
+
+    def __repr__(self):
+        return "bound_sql(%r, %r)" % (self.template, self.parameters)
+
+
 def _camel_to_snake(s):
     """ Convert CamelCase to snake_case.
     """
@@ -48,6 +65,8 @@ def dump(value):
         return "0"
     elif isinstance(value, raw_sql):
         return value
+    elif isinstance(value, bound_sql):
+        return value.template % tuple(map(dump, value.parameters))
     elif isinstance(value, str):
         return "'%s'" % value.encode("utf-8").replace("'", "''")
     elif isinstance(value, unicode):
@@ -67,3 +86,50 @@ class classproperty(object):
 
     def __get__(self, inst, cls):
         return self.func(cls)
+
+
+def pipelined(iterable, size):
+    """ Iterate over an iterable in a separate (producer) thread, yielding
+    its items from a queue holding up to `size` items. The producer only
+    gets that far ahead of the consumer, so it blocks while the queue is
+    full. Any exception raised by the iterable is re-raised in the
+    consumer.
+    """
+    queue = Queue(size)
+    stopped = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            else:
+                return True
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception:
+            put((None, sys.exc_info()))
+        else:
+            put((finished, None))
+
+    producer = threading.Thread(target=produce, name="pipeline-producer")
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error:
+                raise error[0], error[1], error[2]
+            if item is finished:
+                return
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
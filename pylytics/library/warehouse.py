@@ -1,5 +1,6 @@
 from contextlib import closing
 import logging
+import threading
 
 from utils import classproperty
 
@@ -15,47 +16,129 @@ class Warehouse(object):
     """
 
     __connection = None
+    __local = threading.local()
     __version = None
+    __max_allowed_packet = None
+
+    # Catalog metadata, loaded the first time it's needed and then kept up
+    # to date as tables and triggers are created and dropped.
+    __lock = threading.Lock()
+    __table_names = None
+    __triggers = None
+    __trigger_names = None
 
     @classmethod
     def get(cls):
         """ Get the current data warehouse connection, warning if
         none has been defined.
         """
-        if cls.__connection is None:
+        connection = getattr(cls.__local, "connection", None)
+        if connection is None:
+            connection = cls.__connection
+        if connection is None:
             log.warning("No data warehouse connection defined")
-        elif not cls.__connection.is_connected():
-            cls.__connection.reconnect(attempts=5)
+        elif not connection.is_connected():
+            connection.reconnect(attempts=5)
+        return connection
+
+    @classproperty
+    def connection(cls):
+        """ The connection shared by all threads (see `use`), or None. Unlike
+        `get`, this doesn't check that it's still connected.
+        """
         return cls.__connection
 
     @classmethod
-    def use(cls, connection):
+    def use(cls, connection, thread_local=False):
         """ Register a new data warehouse connection for use by all
         table operations.
+
+        If `thread_local` is True, the connection is only used by table
+        operations in the current thread (for example, by a worker running
+        facts in parallel), taking precedence over any shared connection.
+        Passing None removes it again.
         """
-        cls.__connection = connection
-        cls.__version = None
+        if thread_local:
+            cls.__local.connection = connection
+        else:
+            cls.__connection = connection
+            cls.__version = None
+            cls.__max_allowed_packet = None
+            cls.refresh()
+
+    @classmethod
+    def refresh(cls):
+        """ Discard the cached table and trigger names, so they're read from
+        the database again the next time they're needed. This is only
+        necessary if tables or triggers are changed outside pylytics.
+        """
+        with cls.__lock:
+            cls.__table_names = None
+            cls.__triggers = None
+            cls.__trigger_names = None
 
     @classproperty
     def table_names(cls):
-        """ List of names of all the tables (and views) currently
-        defined within the database.
+        """ Frozen set of names of all the tables (and views) currently
+        defined within the database. The same set is returned until the
+        tables change, so checking for a table doesn't copy it.
         """
-        connection = cls.get()
-        with closing(connection.cursor()) as cursor:
-            cursor.execute("SHOW TABLES")
-            return [record[0] for record in cursor]
+        with cls.__lock:
+            if cls.__table_names is None:
+                connection = cls.get()
+                with closing(connection.cursor()) as cursor:
+                    cursor.execute("SHOW TABLES")
+                    cls.__table_names = frozenset(
+                        record[0] for record in cursor)
+            return cls.__table_names
 
     @classproperty
     def trigger_names(cls):
-        """ List of trigger names which exist in the database.
+        """ Frozen set of trigger names which exist in the database.
+        """
+        with cls.__lock:
+            if cls.__triggers is None:
+                connection = cls.get()
+                with closing(connection.cursor()) as cursor:
+                    cursor.execute("""
+                        SELECT trigger_name, event_object_table
+                        FROM information_schema.triggers
+                        """)
+                    cls.__triggers = dict(
+                        (record[0], record[1]) for record in cursor)
+            if cls.__trigger_names is None:
+                cls.__trigger_names = frozenset(cls.__triggers)
+            return cls.__trigger_names
+
+    @classmethod
+    def table_created(cls, table_name):
+        """ Record that a table has been created.
+        """
+        with cls.__lock:
+            if cls.__table_names is not None:
+                cls.__table_names |= frozenset([table_name])
+
+    @classmethod
+    def table_dropped(cls, table_name):
+        """ Record that a table (and so its triggers) has been dropped.
+        """
+        with cls.__lock:
+            if cls.__table_names is not None:
+                cls.__table_names -= frozenset([table_name])
+            if cls.__triggers is not None:
+                for trigger_name, table in cls.__triggers.items():
+                    if table == table_name:
+                        del cls.__triggers[trigger_name]
+                cls.__trigger_names = None
+
+    @classmethod
+    def trigger_created(cls, trigger_name, table_name):
+        """ Record that a trigger has been created on a table.
         """
-        connection = cls.get()
-        with closing(connection.cursor()) as cursor:
-            cursor.execute("""
-                SELECT trigger_name FROM information_schema.triggers
-                """)
-            return [record[0] for record in cursor]
+        with cls.__lock:
+            if cls.__triggers is not None:
+                cls.__triggers[trigger_name] = table_name
+                cls.__trigger_names = None
 
     @classproperty
     def version(cls):
@@ -64,3 +147,15 @@ class Warehouse(object):
             cls.__version = "{}.{}.{}".format(*cls.get().get_server_version())
 
         return cls.__version
+
+    @classproperty
+    def max_allowed_packet(cls):
+        """ Returns the largest packet (and so statement) in bytes which the
+        MySQL server accepts."""
+        if not cls.__max_allowed_packet:
+            connection = cls.get()
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("SELECT @@max_allowed_packet")
+                [(cls.__max_allowed_packet,)] = cursor.fetchall()
+
+        return cls.__max_allowed_packet
@@ -0,0 +1,153 @@
+from __future__ import unicode_literals
+from contextlib import closing
+from datetime import date, datetime
+from decimal import Decimal
+import logging
+import threading
+
+from utils import escaped
+from warehouse import Warehouse
+
+
+log = logging.getLogger("pylytics")
+
+
+def _datetime(value):
+    for format in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError("Invalid watermark timestamp '%s'" % value)
+
+
+def _date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+# Functions for converting each type of watermark back from the text stored
+# in the watermark table, keyed by type name.
+_decoders = {
+    "date": _date,
+    "datetime": _datetime,
+    "decimal": Decimal,
+    "int": int,
+    "unicode": unicode,
+}
+
+
+def _type_name(value):
+    if isinstance(value, datetime):
+        return "datetime"
+    elif isinstance(value, date):
+        return "date"
+    elif isinstance(value, Decimal):
+        return "decimal"
+    elif isinstance(value, (int, long)) and not isinstance(value, bool):
+        return "int"
+    elif isinstance(value, basestring):
+        return "unicode"
+    raise TypeError("Unsupported watermark type '%s'" % type(value).__name__)
+
+
+class Watermark(object):
+    """ The high-water marks of incrementally updated tables, stored in a
+    table in the data warehouse.
+
+    If the source of a table names a `watermark` column, the highest value
+    of that column fetched by a successful update is recorded here. It's
+    then passed to the next update as `since`, so only newer records need
+    to be fetched.
+
+    The table is created once per run (see `invalidate`).
+
+    """
+
+    __tablename__ = "pylytics_watermark"
+
+    __created = False
+    __lock = threading.Lock()
+
+    @classmethod
+    def create_table(cls):
+        """ Create the watermark table if it doesn't exist, unless that's
+        already been done during this run.
+        """
+        with cls.__lock:
+            if not cls.__created:
+                cls.__create_table()
+                cls.__created = True
+
+    @classmethod
+    def invalidate(cls):
+        """ Forget that the table has been created, so it's created again
+        (if need be) the next time it's used.
+        """
+        with cls.__lock:
+            cls.__created = False
+
+    @classmethod
+    def __create_table(cls):
+        sql = """\
+        CREATE TABLE IF NOT EXISTS %s (
+          `table_name` VARCHAR(64) NOT NULL PRIMARY KEY,
+          `value_type` VARCHAR(16) NOT NULL,
+          `value` VARCHAR(255) NOT NULL,
+          `updated` TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB CHARSET=utf8 COLLATE=utf8_bin
+        """ % escaped(cls.__tablename__)
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql)
+
+    @classmethod
+    def get(cls, table):
+        """ Return the watermark recorded for a table, or None if there
+        isn't one.
+        """
+        cls.create_table()
+        sql = "SELECT `value_type`, `value` FROM %s WHERE `table_name` = %%s" % (
+            escaped(cls.__tablename__))
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql, (table.__tablename__,))
+            rows = cursor.fetchall()
+
+        if not rows:
+            return None
+        [(value_type, value)] = rows
+        return _decoders[value_type](value)
+
+    @classmethod
+    def set(cls, table, value):
+        """ Record a new watermark for a table.
+        """
+        cls.create_table()
+        sql = "REPLACE INTO %s (`table_name`, `value_type`, `value`) " \
+              "VALUES (%%s, %%s, %%s)" % escaped(cls.__tablename__)
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql, (table.__tablename__, _type_name(value),
+                                 unicode(value)))
+        connection.commit()
+        log.debug("Watermark set to %s", value,
+                  extra={"table": table.__tablename__})
+
+    @classmethod
+    def reset(cls, table):
+        """ Discard the watermark for a table, so that all of its records
+        are fetched by the next update.
+        """
+        cls.create_table()
+        sql = "DELETE FROM %s WHERE `table_name` = %%s" % (
+            escaped(cls.__tablename__))
+
+        connection = Warehouse.get()
+        with closing(connection.cursor()) as cursor:
+            cursor.execute(sql, (table.__tablename__,))
+        connection.commit()
+        log.info("Watermark reset", extra={"table": table.__tablename__})
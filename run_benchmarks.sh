@@ -0,0 +1,4 @@
+#!/usr/bin/env bash
+
+export PYLYTICS_TEST=1
+python -m test.benchmark.microbenchmarks $*
@@ -0,0 +1,362 @@
+"""
+Offline microbenchmarks for the code which turns records into SQL.
+
+No database is needed - inserts are executed against a connection which
+throws the statements away, so only the work done by pylytics is measured.
+The records are generated from a fixed seed, so runs are comparable.
+
+Run from the root of the repository (run_benchmarks.sh does this)::
+
+    PYLYTICS_TEST=1 python -m test.benchmark.microbenchmarks \
+        --output benchmarks.json
+
+Results are printed, and written as JSON if --output is given. Passing a
+previous results file as --baseline compares against it, exiting with a
+non-zero status if anything is more than --tolerance slower.
+
+"""
+
+from __future__ import unicode_literals
+import argparse
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+import json
+import logging
+import platform
+import random
+import sys
+from timeit import default_timer
+
+from pylytics.library.column import Column, NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.insert import ENGINES
+from pylytics.library.resolver import DimensionIndex
+from pylytics.library.source import hydrated
+from pylytics.library.utils import dump, escaped
+from pylytics.library.warehouse import Warehouse
+from test.dummy_project import Product, Sales, Store
+
+
+SEED = 1
+
+# The number of records or values each benchmark works through per call.
+SIZE = 2000
+
+# The numbers of records inserted at once, and of columns in the wide
+# dimensions generated.
+BATCH_SIZES = (10, 100, 1000)
+COLUMN_COUNTS = (5, 20, 50)
+
+# The number of natural key values which exist in each dimension index.
+DIMENSION_ROWS = 100
+
+
+class NullCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def execute(self, sql, parameters=None):
+        self.rows = []
+        for dimension, rows in self.connection.dimension_rows.items():
+            if sql.startswith("SELECT") and escaped(
+                    dimension.__tablename__) in sql:
+                self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        pass
+
+
+class NullConnection(object):
+    """ Stands in for the data warehouse, discarding everything executed
+    apart from reads of dimension rows (for the dimension key index).
+    """
+
+    connection_id = 1
+
+    def __init__(self, dimension_rows=None):
+        self.dimension_rows = dimension_rows or {}
+
+    def cursor(self, prepared=False):
+        return NullCursor(self)
+
+    def is_connected(self):
+        return True
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def wide_dimension(columns):
+    """ Create a dimension with a natural key and `columns` - 1 others.
+    """
+    attributes = {"__source__": None,
+                  "code": NaturalKey("code", int, size=10)}
+    for number in xrange(1, columns):
+        name = "column_%s" % number
+        attributes[name] = Column(name, basestring, size=100)
+    return type(str("Wide%s" % columns), (Dimension,), attributes)
+
+
+def _text(rng, length=20):
+    return "".join(rng.choice("abcdefghij 'O\"\\") for _ in xrange(length))
+
+
+def _wide_rows(rng, dimension, count):
+    names = [column.name for column in dimension.__insertcolumns__
+             if column.name != "code"]
+    return [dict([("code", rng.randint(1, 10 ** 6))] +
+                 [(name, _text(rng)) for name in names])
+            for _ in xrange(count)]
+
+
+def _stores(rng, count):
+    return [hydrated(Store, {"store_id": rng.randint(1, 10 ** 6),
+                             "manager": _text(rng)})
+            for _ in xrange(count)]
+
+
+def _sales(rng, count, known=True):
+    """ Generate sales referring to dimension rows which are in the index if
+    `known`, otherwise ones which need resolving by a subquery.
+    """
+    offset = 0 if known else DIMENSION_ROWS
+    return [hydrated(Sales, {
+        "product": rng.randint(1, DIMENSION_ROWS) + offset,
+        "store": rng.randint(1, DIMENSION_ROWS) + offset})
+        for _ in xrange(count)]
+
+
+def _dimension_rows():
+    applicable_from = datetime(2000, 1, 1)
+    return {dimension: [(value, applicable_from, value)
+                        for value in xrange(1, DIMENSION_ROWS + 1)]
+            for dimension in (Product, Store)}
+
+
+def _values(rng, kind):
+    generate = {
+        "int": lambda: rng.randint(-10 ** 9, 10 ** 9),
+        "float": lambda: rng.random() * 1000,
+        "decimal": lambda: Decimal(rng.randint(0, 10 ** 6)) / 100,
+        "unicode": lambda: _text(rng),
+        "bytes": lambda: _text(rng).encode("utf-8"),
+        "date": lambda: date(2000, 1, 1) + timedelta(rng.randint(0, 9999)),
+        "datetime": lambda: (datetime(2000, 1, 1) +
+                             timedelta(seconds=rng.randint(0, 10 ** 9))),
+        "none": lambda: None,
+    }[kind]
+    return [generate() for _ in xrange(SIZE)]
+
+
+def benchmarks():
+    """ Yield the name of each benchmark, along with the number of items it
+    processes and a function which processes them.
+    """
+    rng = random.Random(SEED)
+
+    for kind in ("int", "float", "decimal", "unicode", "bytes", "date",
+                 "datetime", "none"):
+        values = _values(rng, kind)
+        yield "dump.%s" % kind, len(values), lambda v=values: map(dump, v)
+
+    names = [_text(rng, 12) + "`" for _ in xrange(SIZE)]
+    yield "escaped", len(names), lambda: map(escaped, names)
+
+    for columns in COLUMN_COUNTS:
+        dimension = wide_dimension(columns)
+        rows = _wide_rows(rng, dimension, SIZE // columns)
+        instances = [hydrated(dimension, row) for row in rows]
+        names = [column.name for column in dimension.__insertcolumns__
+                 if column.name in rows[0]]
+        count = len(rows) * columns
+
+        yield ("hydrated.columns_%s" % columns, count,
+               lambda d=dimension, r=rows: [hydrated(d, row) for row in r])
+
+        def getitem(instances=instances, names=names):
+            for instance in instances:
+                for name in names:
+                    instance[name]
+        yield "getitem.columns_%s" % columns, count, getitem
+
+        def setitem(instances=instances, names=names):
+            for instance in instances:
+                for name in names:
+                    instance[name] = 1
+        yield "setitem.columns_%s" % columns, count, setitem
+
+    values = [rng.randint(1, 10 ** 6) for _ in xrange(SIZE)]
+    timestamp = datetime(2015, 1, 1)
+    yield ("subquery.literal", len(values),
+           lambda: [Product.__subquery__(v, timestamp) for v in values])
+    yield ("subquery.bound", len(values),
+           lambda: [Product.__subquery__(v, timestamp, bound=True)
+                    for v in values])
+
+    for batch_size in BATCH_SIZES:
+        tables = [("store", Store, _stores(rng, batch_size))]
+        for columns in COLUMN_COUNTS:
+            dimension = wide_dimension(columns)
+            tables.append((
+                "wide_%s" % columns, dimension,
+                [hydrated(dimension, row)
+                 for row in _wide_rows(rng, dimension, batch_size)]))
+        tables.append(("sales_resolved", Sales, _sales(rng, batch_size)))
+        tables.append(("sales_subquery", Sales,
+                       _sales(rng, batch_size, known=False)))
+
+        for name, table, instances in tables:
+            for engine in sorted(ENGINES):
+                try:
+                    ENGINES[engine](table)
+                except ValueError:
+                    # The engine doesn't support this table.
+                    continue
+                yield ("insert.%s.%s.batch_%s" % (name, engine, batch_size),
+                       len(instances),
+                       lambda t=table, e=engine, i=instances: _insert(t, e, i))
+
+
+def _insert(table, engine, instances):
+    original = table.__dict__.get("INSERT_ENGINE")
+    table.INSERT_ENGINE = engine
+    try:
+        table.insert(*instances)
+    finally:
+        if original is None:
+            del table.INSERT_ENGINE
+        else:
+            table.INSERT_ENGINE = original
+
+
+def measure(function, repeat):
+    """ Return the shortest time taken by a number of calls to a function,
+    which is the least affected by anything else running at the time.
+    """
+    times = []
+    for _ in xrange(repeat):
+        started = default_timer()
+        function()
+        times.append(default_timer() - started)
+    return min(times)
+
+
+def run(repeat=5, only=None):
+    """ Run the benchmarks (those whose names start with `only`, if given)
+    and return the results. The warehouse connection in use beforehand is
+    restored afterwards.
+    """
+    previous = Warehouse.connection
+    Warehouse.use(NullConnection(_dimension_rows()))
+    DimensionIndex.invalidate()
+    results = {}
+    try:
+        for name, count, function in benchmarks():
+            if only and not name.startswith(only):
+                continue
+            seconds = measure(function, repeat)
+            results[name] = {
+                "count": count,
+                "seconds": seconds,
+                "per_item_us": seconds / count * 10 ** 6,
+            }
+    finally:
+        DimensionIndex.invalidate()
+        Warehouse.use(previous)
+    return {
+        "python": platform.python_version(),
+        "seed": SEED,
+        "repeat": repeat,
+        "benchmarks": results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Compare results with a baseline.
+
+    Returns:
+        A list of (name, baseline per item, current per item, ratio) for
+        every benchmark in both, and a list of the names of those which are
+        more than `tolerance` (a fraction) slower than the baseline.
+
+    """
+    rows = []
+    regressions = []
+    for name, result in sorted(results["benchmarks"].items()):
+        try:
+            before = baseline["benchmarks"][name]["per_item_us"]
+        except KeyError:
+            continue
+        after = result["per_item_us"]
+        ratio = after / before if before else float("inf")
+        rows.append((name, before, after, ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the SQL generation in pylytics.")
+    parser.add_argument("--output", help="Write the results as JSON here.")
+    parser.add_argument("--baseline",
+                        help="Compare with results written by an earlier "
+                             "run.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How much slower (as a fraction) a benchmark "
+                             "can be than the baseline before it's "
+                             "reported as a regression.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="The number of times to run each benchmark.")
+    parser.add_argument("--only",
+                        help="Only run benchmarks whose names start with "
+                             "this.")
+    args = parser.parse_args(argv)
+
+    # Errors are logged when inserts fail, but debug output would swamp
+    # the timings.
+    logging.getLogger("pylytics").setLevel(logging.WARNING)
+
+    results = run(args.repeat, args.only)
+    for name, result in sorted(results["benchmarks"].items()):
+        print "%-50s %12.3f us" % (name, result["per_item_us"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        rows, regressions = compare(results, baseline, args.tolerance)
+        print
+        print "%-50s %12s %12s %8s" % ("Compared with " + args.baseline,
+                                        "before", "after", "ratio")
+        for name, before, after, ratio in rows:
+            print "%-50s %12.3f %12.3f %7.2fx%s" % (
+                name, before, after, ratio,
+                " *" if name in regressions else "")
+        if regressions:
+            print
+            print "%s benchmark%s slower than the baseline" % (
+                len(regressions), "" if len(regressions) == 1 else "s")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
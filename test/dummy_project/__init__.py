@@ -36,6 +36,15 @@ class Store(Dimension):
     manager = Column('manager', str, size=100)
 
 
+def make_store(store_id, manager='Mr Smith'):
+    """ Return a Store record, as it would be hydrated from a source.
+    """
+    store = Store()
+    store['store_id'] = store_id
+    store['manager'] = manager
+    return store
+
+
 class Product(Dimension):
 
     __source__ = CallableSource.define(
@@ -0,0 +1,38 @@
+from mock import MagicMock
+
+from pylytics.library.warehouse import Warehouse
+from test.benchmark.microbenchmarks import compare, run
+
+
+def _results(**timings):
+    return {'benchmarks': {name: {'per_item_us': value}
+                           for name, value in timings.items()}}
+
+
+def test_run():
+    results = run(repeat=1, only='insert.sales_resolved.statement')
+    assert sorted(results['benchmarks']) == [
+        'insert.sales_resolved.statement.batch_10',
+        'insert.sales_resolved.statement.batch_100',
+        'insert.sales_resolved.statement.batch_1000',
+    ]
+    assert results['seed'] == 1
+
+
+def test_restores_connection():
+    connection = MagicMock()
+    Warehouse.use(connection)
+    try:
+        run(repeat=1, only='insert.sales_resolved.statement.batch_10')
+        assert Warehouse.connection is connection
+    finally:
+        Warehouse.use(None)
+
+
+def test_compare():
+    rows, regressions = compare(
+        _results(fast=1.0, same=2.0, slow=4.0, new=1.0),
+        _results(fast=2.0, same=2.0, slow=2.0, old=1.0),
+        tolerance=0.25)
+    assert [row[0] for row in rows] == ['fast', 'same', 'slow']
+    assert regressions == ['slow']
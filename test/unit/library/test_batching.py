@@ -0,0 +1,77 @@
+from mock import patch
+
+from pylytics.library.batching import BatchSizer, DIMENSION_KEY_BYTES
+from pylytics.library.serializer import RowSerializer
+from test.dummy_project import Sales, Store, make_store
+
+
+def _sizer(max_bytes=10000, target_seconds=1.0, initial_rows=100,
+           max_rows=1000):
+    return BatchSizer(Store, max_bytes, target_seconds, initial_rows,
+                      max_rows)
+
+
+class TestBatchSizer(object):
+
+    def test_byte_budget(self):
+        sizer = _sizer()
+        stores = [make_store(i, 'x' * 100) for i in xrange(200)]
+        batches = list(sizer.batches(stores))
+        # Each row is roughly 160 bytes as SQL.
+        assert 40 < len(batches[0]) < 80
+        assert sum(len(batch) for batch in batches) == 200
+
+    def test_wide_rows_within_budget(self):
+        sizer = _sizer(max_bytes=2000)
+        stores = ([make_store(i, 'x') for i in xrange(10)] +
+                  [make_store(i, 'x' * 500) for i in xrange(10, 20)])
+        batches = list(sizer.batches(stores))
+        for batch in batches:
+            assert sum(sizer._estimate(store) for store in batch) <= 2000
+        assert sum(len(batch) for batch in batches) == 20
+
+    def test_estimate_from_raw_values(self):
+        """ Rows aren't serialized to estimate their size.
+        """
+        sizer = _sizer()
+        with patch.object(RowSerializer, 'values') as values:
+            short = sizer._estimate(make_store(1, 'x'))
+            long = sizer._estimate(make_store(1, 'x' * 100))
+        assert not values.called
+        assert long - short == 99
+
+    def test_estimate_dimension_keys(self):
+        sizer = BatchSizer(Sales, 10000, 1.0, 100, 1000)
+        sale = Sales()
+        sale['store'] = 1
+        with patch('pylytics.library.fact.DimensionIndex') as index:
+            assert sizer._estimate(sale) > DIMENSION_KEY_BYTES
+        assert not index.method_calls
+
+    def test_row_over_budget(self):
+        sizer = _sizer(max_bytes=100)
+        stores = [make_store(i, 'x' * 100) for i in xrange(3)]
+        batches = list(sizer.batches(stores))
+        assert [len(batch) for batch in batches] == [1, 1, 1]
+
+    def test_grows_when_fast(self):
+        sizer = _sizer(max_bytes=10 ** 9)
+        sizer.record(100, 10000, 0.01)
+        assert sizer.rows == 200
+
+    def test_shrinks_when_slow(self):
+        sizer = _sizer(max_bytes=10 ** 9)
+        sizer.record(100, 10000, 4.0)
+        assert sizer.rows == 25
+
+    def test_learns_row_size(self):
+        sizer = _sizer(max_bytes=10000)
+        sizer.record(10, 10000, 0.01)
+        assert sizer.rows == 10
+
+    def test_limits(self):
+        sizer = _sizer(max_bytes=10 ** 9, max_rows=150)
+        sizer.record(100, 100, 0.0)
+        assert sizer.rows == 150
+        sizer.record(150, 100, 1000.0)
+        assert sizer.rows == 1
@@ -0,0 +1,109 @@
+from datetime import date, datetime
+from decimal import Decimal
+import random
+
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.benchmark import (Benchmark, EPOCH, SyntheticSource,
+                                        benchmark, dimension_row, fact_row,
+                                        key_value, percentile, random_value,
+                                        report)
+from pylytics.library.column import Column, Metric, NaturalKey
+from test.dummy_project import Product, Sales, Store
+
+
+class TestValues(object):
+
+    @pytest.mark.parametrize('column', [
+        NaturalKey('number', int), NaturalKey('name', basestring, size=8),
+        NaturalKey('day', date), NaturalKey('code', bytearray)])
+    def test_keys_distinct(self, column):
+        values = [key_value(column, index) for index in xrange(1000)]
+        assert len(set(map(bytes, values) if column.type is bytearray
+                       else values)) == 1000
+
+    def test_key_fits_size(self):
+        column = NaturalKey('name', basestring, size=8)
+        assert len(key_value(column, 123456)) <= 8
+
+    @pytest.mark.parametrize('column, check', [
+        (Metric('count', int), lambda v: isinstance(v, int)),
+        (Metric('price', Decimal, size=(4, 2)), lambda v: v < 100),
+        (Column('name', basestring, size=5), lambda v: 1 <= len(v) <= 5),
+        (Column('colour', ('red', 'blue')), lambda v: v in ('red', 'blue')),
+        (Column('when', datetime), lambda v: v >= EPOCH)])
+    def test_random_value(self, column, check):
+        rng = random.Random(1)
+        assert all(check(random_value(column, rng)) for _ in xrange(100))
+
+    def test_optional(self):
+        rng = random.Random(1)
+        column = Metric('count', int, optional=True)
+        values = [random_value(column, rng) for _ in xrange(1000)]
+        assert None in values
+
+
+class TestRows(object):
+
+    def test_dimension_row(self):
+        row = dimension_row(Store, 4, random.Random(1))
+        assert row['store_id'] == 5
+        assert row['applicable_from'] == EPOCH
+        assert 'hash_key' not in row and 'id' not in row
+
+    def test_fact_row(self):
+        rng = random.Random(1)
+        rows = [fact_row(Sales, 10, rng) for _ in xrange(100)]
+        assert set(row['store'] for row in rows) == set(range(1, 11))
+
+    def test_source_repeatable(self):
+        source = SyntheticSource.define(table=Product, rows=5)
+        first = list(source.select(Product))
+        second = list(source.select(Product))
+        assert [p['product_name'] for p in first] == \
+            [p['product_name'] for p in second]
+        assert [p['product_id'] for p in first] == [1, 2, 3, 4, 5]
+
+
+def test_percentile():
+    values = range(1, 101)
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([3], 0.9) == 3
+    assert percentile([], 0.5) is None
+
+
+@patch('pylytics.library.benchmark.settings', ALLOW_BENCHMARK=False)
+def test_not_allowed(settings):
+    with pytest.raises(RuntimeError):
+        Benchmark(Sales, 10, 10).run()
+
+
+@patch('pylytics.library.benchmark.log')
+@patch.object(Benchmark, 'run', return_value=[])
+def test_benchmark(run, log):
+    assert benchmark(Sales, rows=10, engines=['statement']) == []
+    run.assert_called_once_with(['statement'])
+    assert log.info.called
+
+
+@patch('pylytics.library.benchmark._count', return_value=2)
+@patch('pylytics.library.benchmark.current_rss')
+def test_rss_growth(current_rss, count):
+    # Only the growth during this engine's run is reported, not the
+    # memory used before it started.
+    def run():
+        fact = MagicMock()
+        fact.batch.return_value = [[1], [2]]
+        return Benchmark(fact, 2, 1)._run_engine('statement')
+
+    current_rss.side_effect = [500.0, 520.0, 510.0]
+    result = run()
+    assert result['rss_growth_mb'] == 20.0
+    assert 'n/a' not in report([result])
+
+    current_rss.side_effect = [None, None, None]
+    result = run()
+    assert result['rss_growth_mb'] is None
+    assert 'n/a' in report([result])
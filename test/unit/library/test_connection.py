@@ -0,0 +1,84 @@
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.connection import ConnectionPool, NamedConnection
+
+
+@pytest.yield_fixture
+def connect():
+    with patch('pylytics.library.connection.get_named_connection') as connect:
+        connect.side_effect = lambda name: MagicMock()
+        yield connect
+
+
+@pytest.fixture
+def pool(connect):
+    return ConnectionPool('platform', size=2, recycle=3600)
+
+
+class TestConnectionPool(object):
+
+    def test_reuses_released_connections(self, pool, connect):
+        connection = pool.acquire()
+        pool.release(connection)
+        assert pool.acquire() is connection
+        assert connect.call_count == 1
+
+    def test_size(self, pool, connect):
+        connections = [pool.acquire() for _ in xrange(3)]
+        for connection in connections:
+            pool.release(connection)
+        assert connections[2].close.called
+        assert not connections[0].close.called
+
+    @patch('pylytics.library.connection.time')
+    def test_recycle(self, time, pool, connect):
+        time.time.return_value = 0
+        connection = pool.acquire()
+        pool.release(connection)
+        time.time.return_value = 3601
+        assert pool.acquire() is not connection
+        assert connection.close.called
+
+    @patch('pylytics.library.connection.time')
+    def test_ping_after_idle(self, time, pool, connect):
+        time.time.return_value = 0
+        connection = pool.acquire()
+        pool.release(connection)
+        connection.is_connected.return_value = False
+        time.time.return_value = ConnectionPool.PING_AFTER + 1
+        assert pool.acquire() is not connection
+
+    def test_unusable_connection(self, pool):
+        connection = pool.acquire()
+        connection.rollback.side_effect = Exception('Unread result found')
+        pool.release(connection)
+        assert connection.close.called
+        assert pool.acquire() is not connection
+
+    def test_clear(self, pool):
+        connection = pool.acquire()
+        pool.release(connection)
+        pool.clear()
+        assert connection.close.called
+
+
+class TestNamedConnection(object):
+
+    def test_returns_connection_to_pool(self, pool):
+        with patch.object(ConnectionPool, 'get', return_value=pool):
+            with NamedConnection('platform') as first:
+                pass
+            with NamedConnection('platform') as second:
+                pass
+        assert first is second
+
+    def test_discards_connection_on_error(self, pool):
+        with patch.object(ConnectionPool, 'get', return_value=pool):
+            with pytest.raises(ValueError):
+                with NamedConnection('platform') as first:
+                    raise ValueError
+            with NamedConnection('platform') as second:
+                pass
+        assert first.close.called
+        assert first is not second
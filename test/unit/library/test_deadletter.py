@@ -0,0 +1,101 @@
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+import os
+
+from mock import patch
+import pytest
+
+from pylytics.library.deadletter import _decode, _encode, DeadLetters
+from test.dummy_project import Store, make_store
+
+
+@pytest.yield_fixture
+def directory(tmpdir):
+    path = str(tmpdir.join('dead_letters'))
+    with patch('pylytics.library.deadletter.settings',
+               DEAD_LETTER_DIRECTORY=path):
+        yield path
+
+
+class TestEncoding(object):
+
+    @pytest.mark.parametrize('value', [
+        None, 1, 1.5, u'caf\xe9', datetime(2015, 1, 2, 3, 4, 5, 6),
+        datetime(2015, 1, 2, 3, 4, 5), date(2015, 1, 2), time(3, 4, 5),
+        timedelta(hours=1, seconds=2), Decimal('1.10'),
+        bytearray(b'\x00\xff'), b'\xff\xfe'])
+    def test_round_trip(self, value):
+        assert _decode(_encode(value)) == value
+
+
+class TestDeadLetters(object):
+
+    def test_write_and_read(self, directory):
+        DeadLetters.write(Store, [make_store(1), make_store(2, None)],
+                          ValueError('bad'))
+        path = DeadLetters.path(Store)
+        assert os.path.dirname(path) == directory
+        stores = list(DeadLetters.read(path, Store))
+        assert [(s['store_id'], s['manager']) for s in stores] == \
+            [(1, 'Mr Smith'), (2, None)]
+
+    def test_write_rejected(self, directory):
+        DeadLetters.write_rejected(Store, [
+            (make_store(1), ValueError('bad')),
+            (make_store(2), ValueError('worse'))])
+        path = DeadLetters.path(Store)
+        stores = list(DeadLetters.read(path, Store))
+        assert [s['store_id'] for s in stores] == [1, 2]
+
+    def test_appends(self, directory):
+        DeadLetters.write(Store, [make_store(1)], ValueError('bad'))
+        DeadLetters.write(Store, [make_store(2)], ValueError('bad'))
+        path = DeadLetters.path(Store)
+        assert len(list(DeadLetters.read(path, Store))) == 2
+
+    def test_replay(self, directory):
+        DeadLetters.write(Store, [make_store(1), make_store(2)],
+                          ValueError('bad'))
+        with patch.object(Store, 'insert') as insert:
+            assert DeadLetters.replay(Store) == 2
+        stores = insert.call_args[0]
+        assert [s['store_id'] for s in stores] == [1, 2]
+        assert os.listdir(directory) == []
+
+    def test_replay_nothing(self, directory):
+        with patch.object(Store, 'insert') as insert:
+            assert DeadLetters.replay(Store) == 0
+        assert not insert.called
+
+    def test_replay_failure_restores_file(self, directory):
+        DeadLetters.write(Store, [make_store(1)], ValueError('bad'))
+
+        def insert(*instances):
+            # Records failing again during the replay are written too.
+            DeadLetters.write(Store, [make_store(2)], ValueError('bad'))
+            raise ValueError('no engine')
+
+        with patch.object(Store, 'insert', side_effect=insert):
+            with pytest.raises(ValueError):
+                DeadLetters.replay(Store)
+        assert os.listdir(directory) == ['store_dimension.jsonl']
+        stores = DeadLetters.read(DeadLetters.path(Store), Store)
+        assert [s['store_id'] for s in stores] == [1, 2]
+
+    def test_replay_incomplete_restores_file(self, directory):
+        DeadLetters.write(Store, [make_store(1)], ValueError('bad'))
+        with patch.object(Store, 'insert', return_value=False):
+            assert DeadLetters.replay(Store) == 0
+        assert os.listdir(directory) == ['store_dimension.jsonl']
+        stores = DeadLetters.read(DeadLetters.path(Store), Store)
+        assert [s['store_id'] for s in stores] == [1]
+
+    def test_replay_resumes_interrupted(self, directory):
+        DeadLetters.write(Store, [make_store(1)], ValueError('bad'))
+        path = DeadLetters.path(Store)
+        os.rename(path, path + '.replaying')
+        DeadLetters.write(Store, [make_store(2)], ValueError('bad'))
+        with patch.object(Store, 'insert') as insert:
+            assert DeadLetters.replay(Store) == 2
+        assert [s['store_id'] for s in insert.call_args[0]] == [1, 2]
+        assert os.listdir(directory) == []
@@ -0,0 +1,74 @@
+from hashlib import sha1
+
+from mock import patch
+import pytest
+
+from pylytics.library.dedupe import BloomFilter, Deduplicator
+from test.dummy_project import StockReplace, Store, make_store
+
+
+def _digests(count):
+    return [sha1(str(i)).digest() for i in xrange(count)]
+
+
+class TestBloomFilter(object):
+
+    def test_no_false_negatives(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+        digests = _digests(1000)
+        for digest in digests:
+            bloom_filter.add(digest)
+        assert all(digest in bloom_filter for digest in digests)
+
+    def test_false_positive_rate(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+        digests = _digests(11000)
+        for digest in digests[:1000]:
+            bloom_filter.add(digest)
+        false_positives = sum(digest in bloom_filter
+                              for digest in digests[1000:])
+        assert false_positives < 300
+
+
+@pytest.yield_fixture
+def deduplicator():
+    existing = BloomFilter(10, 0.01)
+    existing.add(make_store(1).digest())
+    deduplicator = Deduplicator(Store)
+    with patch.object(Deduplicator, 'load', return_value=existing):
+        yield deduplicator
+
+
+class TestDeduplicator(object):
+
+    def test_within_batch(self, deduplicator):
+        with patch.object(Deduplicator, '_confirm', return_value=set()):
+            kept = deduplicator.filter(
+                [make_store(2), make_store(3), make_store(2)])
+        assert [store['store_id'] for store in kept] == [2, 3]
+        assert deduplicator.skipped == 1
+
+    def test_across_batches(self, deduplicator):
+        with patch.object(Deduplicator, '_confirm', return_value=set()):
+            deduplicator.inserted(deduplicator.filter([make_store(2)]))
+            kept = deduplicator.filter([make_store(2), make_store(3)])
+        assert [store['store_id'] for store in kept] == [3]
+
+    def test_existing_records(self, deduplicator):
+        digest = make_store(1).digest()
+        with patch.object(Deduplicator, '_confirm',
+                          return_value={digest}) as confirm:
+            kept = deduplicator.filter([make_store(1), make_store(2)])
+        confirm.assert_called_once_with({digest})
+        assert [store['store_id'] for store in kept] == [2]
+
+    def test_false_positive(self, deduplicator):
+        with patch.object(Deduplicator, '_confirm', return_value=set()):
+            kept = deduplicator.filter([make_store(1)])
+        assert len(kept) == 1
+        assert deduplicator.skipped == 0
+
+    @patch('pylytics.library.dedupe.settings', DEDUPLICATE=True)
+    def test_applies_to(self, settings):
+        assert Deduplicator.applies_to(Store)
+        assert not Deduplicator.applies_to(StockReplace)
@@ -1,7 +1,9 @@
 from contextlib import closing
 
+import mock
 import pytest
 
+from pylytics.library.context import RunContext
 from pylytics.library.dimension import Dimension
 from pylytics.library.column import Column, NaturalKey
 from pylytics.library.warehouse import Warehouse
@@ -122,3 +124,32 @@ def test_can_drop_dimension(empty_warehouse):
     Store.create_table()
     Store.drop_table()
     assert not Store.table_exists
+
+
+@mock.patch('pylytics.library.table.Table.update')
+class TestRunContext(object):
+
+    def test_updated_once_per_run(self, update):
+        with RunContext():
+            Store.update()
+            Store.update()
+        assert update.call_count == 1
+
+    def test_different_arguments(self, update):
+        with RunContext():
+            Store.update()
+            Store.update(historical=True)
+        assert update.call_count == 2
+
+    def test_failed_update_repeated(self, update):
+        update.side_effect = [ValueError, None]
+        with RunContext():
+            with pytest.raises(ValueError):
+                Store.update()
+            Store.update()
+        assert update.call_count == 2
+
+    def test_outside_run(self, update):
+        Store.update()
+        Store.update()
+        assert update.call_count == 2
@@ -0,0 +1,107 @@
+import threading
+
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.executor import ParallelExecutor, run_task
+from pylytics.library.warehouse import Warehouse
+from test.dummy_project import Product, Sales, Stock, Store
+
+
+@pytest.yield_fixture
+def tasks():
+    """ Replace run_task, recording the order tasks are run in and
+    failing any tasks for tables in `tasks.failing`.
+    """
+    tasks = MagicMock()
+    tasks.calls = []
+    tasks.failing = set()
+    lock = threading.Lock()
+
+    def run_task(table, method, kwargs):
+        with lock:
+            tasks.calls.append((table, method, kwargs))
+        if table in tasks.failing:
+            return "Exception: failed"
+
+    with patch('pylytics.library.executor.run_task', side_effect=run_task):
+        yield tasks
+
+
+class TestParallelExecutor(object):
+
+    def test_dimensions_run_once_before_facts(self, tasks):
+        errors = ParallelExecutor('update', [Sales, Stock], 2).run()
+        assert errors == {}
+        tables = [table for table, _, _ in tasks.calls]
+        assert sorted(tables) == sorted([Product, Store, Sales, Stock])
+        assert tables.index(Sales) > max(tables.index(Product),
+                                         tables.index(Store))
+        assert tables.index(Stock) > tables.index(Product)
+        assert (Sales, 'update', {'dimensions': False}) in tasks.calls
+
+    def test_historical(self, tasks):
+        ParallelExecutor('historical', [Stock], 2).run()
+        assert tasks.calls == [
+            (Product, 'update', {'historical': True}),
+            (Stock, 'update', {'historical': True, 'dimensions': False}),
+        ]
+
+    def test_failed_dimension(self, tasks):
+        tasks.failing.add(Store)
+        errors = ParallelExecutor('update', [Sales, Stock], 2).run()
+        assert sorted(errors) == ['Sales', 'Store']
+        assert Sales not in [table for table, _, _ in tasks.calls]
+        assert Stock in [table for table, _, _ in tasks.calls]
+
+    @patch('pylytics.library.executor.connection')
+    def test_connection_failure(self, connection):
+        pool = connection.ConnectionPool.get.return_value
+        pool.acquire.side_effect = ValueError('no connections')
+        errors = ParallelExecutor('update', [Stock], 2).run()
+        assert errors == {'Product': 'ValueError: no connections',
+                          'Stock': 'Product failed'}
+
+    def test_unsupported_command(self):
+        with pytest.raises(ValueError):
+            ParallelExecutor('template', [Sales], 2)
+
+
+class TestRunTask(object):
+
+    @patch('pylytics.library.executor.connection')
+    def test_own_connection(self, connection):
+        shared = MagicMock()
+        Warehouse.use(shared)
+        used = []
+        table = MagicMock()
+        table.update.side_effect = lambda: used.append(Warehouse.get())
+
+        thread = threading.Thread(target=run_task,
+                                  args=(table, 'update', {}))
+        thread.start()
+        thread.join()
+
+        pool = connection.ConnectionPool.get.return_value
+        worker_connection = pool.acquire.return_value
+        assert used == [worker_connection]
+        pool.release.assert_called_once_with(worker_connection)
+        assert Warehouse.get() is shared
+
+    @patch('pylytics.library.executor.connection')
+    def test_error(self, connection):
+        table = MagicMock()
+        table.update.side_effect = ValueError('bad')
+        assert run_task(table, 'update', {}) == 'ValueError: bad'
+        pool = connection.ConnectionPool.get.return_value
+        pool.discard.assert_called_once_with(pool.acquire.return_value)
+
+    @patch('pylytics.library.executor.connection')
+    def test_acquire_failure(self, connection):
+        pool = connection.ConnectionPool.get.return_value
+        pool.acquire.side_effect = ValueError('no connections')
+        table = MagicMock()
+        assert run_task(table, 'update', {}) == 'ValueError: no connections'
+        assert not table.update.called
+        assert not pool.release.called
+        assert not pool.discard.called
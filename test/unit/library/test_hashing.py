@@ -0,0 +1,57 @@
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from hashlib import sha1
+
+from pylytics.library.column import Column
+from pylytics.library.hashing import digest, encode
+from pylytics.library.utils import raw_sql
+
+
+class TestEncode(object):
+
+    def test_null(self):
+        assert encode(Column('a', int, optional=True), None) == b'NULL'
+        # MySQL may store something else in a NOT NULL column.
+        assert encode(Column('a', int), None) is None
+
+    def test_integer(self):
+        assert encode(Column('a', int), 42) == b'42'
+        assert encode(Column('a', int), True) == b'1'
+        assert encode(Column('a', int), 2 ** 31) is None
+
+    def test_decimal(self):
+        column = Column('a', Decimal, size=(6, 2))
+        assert encode(column, Decimal('1.005')) == b'1.01'
+        assert encode(column, 3) == b'3.00'
+        assert encode(column, Decimal('-0')) == b'0.00'
+        assert encode(column, Decimal('12345')) is None
+
+    def test_string(self):
+        assert encode(Column('a', basestring), u'caf\xe9') == b'caf\xc3\xa9'
+        assert encode(Column('a', basestring, size=3), u'long') is None
+        assert encode(Column('a', basestring), u'\U0001f600') is None
+
+    def test_dates_and_times(self):
+        assert encode(Column('a', date), date(2014, 1, 2)) == b'2014-01-02'
+        assert encode(Column('a', datetime), datetime(2014, 1, 2, 3, 4, 5)) \
+            == b'2014-01-02 03:04:05'
+        assert encode(Column('a', datetime),
+                      datetime(2014, 1, 2, 3, 4, 5, 6)) is None
+        assert encode(Column('a', time), time(1, 2, 3)) == b'01:02:03'
+        assert encode(Column('a', timedelta),
+                      timedelta(hours=-25)) == b'-25:00:00'
+
+    def test_unencodable(self):
+        assert encode(Column('a', float), 1.5) is None
+        assert encode(Column('a', int), raw_sql('NOW()')) is None
+
+
+class TestDigest(object):
+
+    def test_matches_concat_ws(self):
+        columns = [Column('a', int), Column('b', basestring, optional=True)]
+        assert digest(columns, [1, None]) == sha1(b'1,NULL').digest()
+
+    def test_falls_back_to_server(self):
+        columns = [Column('a', int), Column('b', float)]
+        assert digest(columns, [1, 1.5]) is None
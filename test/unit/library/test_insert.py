@@ -0,0 +1,277 @@
+from binascii import hexlify
+from datetime import datetime
+
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.exceptions import SubqueryRowsError
+from pylytics.library.hashing import digest
+from pylytics.library.insert import (ExecuteManyInsert, LoadDataInsert,
+                                     PreparedInsert, StagingInsert,
+                                     StatementInsert, get_engine)
+from pylytics.library.resolver import DimensionIndex
+from pylytics.library.utils import raw_sql
+from test.dummy_project import Stock, StockReplace, Store, make_store
+
+
+@pytest.fixture
+def connection():
+    connection = MagicMock()
+    connection.connection_id = 1
+    return connection
+
+
+def _executed(connection):
+    cursor = connection.cursor.return_value
+    return [call[0] for call in cursor.execute.call_args_list]
+
+
+def _digest(table, *values):
+    return hexlify(digest(table.__compositekey__, values))
+
+
+def _stock(product, quantity):
+    stock = Stock()
+    stock['product'] = product
+    stock['quantity'] = quantity
+    return stock
+
+
+@pytest.fixture
+def product_index():
+    return DimensionIndex(Stock.product.dimension,
+                          [(1, datetime(2014, 1, 1), 10)])
+
+
+class TestGetEngine(object):
+
+    def test_default(self):
+        assert isinstance(get_engine(Store), StatementInsert)
+
+    @patch.object(Store, 'INSERT_ENGINE', 'prepared')
+    def test_table_setting(self):
+        assert isinstance(get_engine(Store), PreparedInsert)
+
+    @patch.object(Store, 'INSERT_ENGINE', 'bogus')
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            get_engine(Store)
+
+
+class TestStatementInsert(object):
+
+    def test_literal_values(self, connection):
+        StatementInsert(Store).execute(
+            connection, [make_store(1, "Mr O'Brien"), make_store(2, None)])
+        [(statement,)] = _executed(connection)
+        assert statement.startswith(
+            "INSERT IGNORE INTO `store_dimension` (\n  `store_id`,")
+        assert "VALUES (\n  1,\n  'Mr O''Brien',\n  UNHEX(" in statement
+        assert "), (\n  2,\n  NULL,\n  UNHEX(" in statement
+
+    def test_dimension_subquery(self, connection):
+        with patch.object(DimensionIndex, 'get') as get:
+            get.return_value.lookup.return_value = None
+            StatementInsert(Stock).execute(connection, [_stock(1, 5)])
+        [(statement,)] = _executed(connection)
+        assert "(SELECT `id` FROM `product_dimension` WHERE `product_id` = 1" \
+            in statement
+
+
+class TestExecuteManyInsert(object):
+
+    def test_bound_values(self, connection):
+        ExecuteManyInsert(Store).execute(
+            connection, [make_store(1, "Mr O'Brien"), make_store(2, 'Dr No')])
+        [(statement, parameters)] = _executed(connection)
+        assert statement.count("(%s, %s, UNHEX(%s), %s)") == 2
+        assert parameters == [1, "Mr O'Brien", _digest(Store, 1, "Mr O'Brien"),
+                              None, 2, 'Dr No', _digest(Store, 2, 'Dr No'),
+                              None]
+
+    def test_null_in_required_column(self, connection):
+        # MySQL may store something other than NULL in a NOT NULL column,
+        # so the hash key is left to the server.
+        ExecuteManyInsert(Store).execute(connection, [make_store(2, None)])
+        [(statement, parameters)] = _executed(connection)
+        assert "IFNULL(`manager`,'NULL')" in statement
+        assert parameters == [2, None, None]
+
+    def test_raw_sql_not_escaped(self, connection):
+        # mysql-connector doesn't turn `%%` back into `%`, so any `%` in
+        # a SQL expression must reach it unchanged.
+        expression = raw_sql("DATE_FORMAT(NOW(), '%Y')")
+        with patch.object(Store, '_values', return_value=[1, expression]):
+            placeholders, _ = next(
+                ExecuteManyInsert(Store)._rows([make_store(1, 'a')]))
+        assert placeholders == ("%s", "DATE_FORMAT(NOW(), '%Y')")
+
+    def test_resolved_dimension_keys(self, connection, product_index):
+        with patch.object(DimensionIndex, 'get', return_value=product_index):
+            ExecuteManyInsert(Stock).execute(
+                connection, [_stock(1, 5), _stock(1, 6)])
+        [(statement, parameters)] = _executed(connection)
+        assert "SELECT" not in statement
+        assert parameters == [10, 5, _digest(Stock, 10), 10, 6,
+                              _digest(Stock, 10)]
+
+    def test_unresolved_dimension_keys(self, connection, product_index):
+        with patch.object(DimensionIndex, 'get', return_value=product_index):
+            ExecuteManyInsert(Stock).execute(
+                connection, [_stock(1, 5), _stock(2, 6), _stock(1, 7)])
+        executed = _executed(connection)
+        assert len(executed) == 3
+        statement, parameters = executed[1]
+        assert "WHERE `product_id` = %s" in statement
+        assert parameters[:2] == [2, 2]
+        assert parameters[3] == 6
+
+
+class TestPreparedInsert(object):
+
+    def test_reuses_cursor(self, connection):
+        engine = PreparedInsert(Store)
+        engine.execute(connection, [make_store(1, 'a')])
+        engine.execute(connection, [make_store(2, 'b')])
+        assert connection.cursor.call_count == 1
+        connection.cursor.assert_called_with(prepared=True)
+
+    def test_new_cursor_after_reconnect(self, connection):
+        engine = PreparedInsert(Store)
+        engine.execute(connection, [make_store(1, 'a')])
+        connection.connection_id = 2
+        engine.execute(connection, [make_store(2, 'b')])
+        assert connection.cursor.call_count == 2
+
+    def test_reuses_statement(self, connection):
+        # mysql-connector only skips preparing a statement again if it's
+        # the same object as the last one executed.
+        engine = PreparedInsert(Store)
+        engine.execute(connection, [make_store(1, 'a')])
+        engine.execute(connection, [make_store(2, 'b')])
+        first, second = _executed(connection)
+        assert first[0] is second[0]
+
+    @patch('pylytics.library.insert.MAX_PREPARED_PARAMETERS', 8)
+    def test_parameter_limit(self, connection):
+        PreparedInsert(Store).execute(
+            connection, [make_store(i, 'a') for i in xrange(5)])
+        assert [len(params) for _, params in _executed(connection)] == \
+            [8, 8, 4]
+
+
+class TestLoadDataInsert(object):
+
+    def _load(self, connection, table, batch):
+        files = []
+
+        def execute(statement):
+            path = statement.split("'")[1]
+            with open(path) as f:
+                files.append(f.read().decode('utf-8'))
+
+        cursor = connection.cursor.return_value
+        cursor.execute.side_effect = execute
+        LoadDataInsert(table).execute(connection, batch)
+        statements = [call[0][0] for call in cursor.execute.call_args_list]
+        return statements, files
+
+    def test_escaped_fields(self, connection):
+        statements, files = self._load(
+            connection, Store,
+            [make_store(1, 'Tab\there'), make_store(2, '')])
+        assert files == ['1\tTab\\there\t%s\t\\N\n2\t\t%s\t\\N\n' % (
+            _digest(Store, 1, 'Tab\there'), _digest(Store, 2, ''))]
+        [statement] = statements
+        assert " IGNORE INTO TABLE `store_dimension` " in statement
+        assert "(`store_id`, `manager`, @v2_0, `applicable_from`) " \
+            "SET `hash_key` = UNHEX(@v2_0)" in statement
+
+    def test_expression_unchanged(self):
+        # SQL expressions are no longer escaped for mysql-connector, so
+        # mustn't be unescaped either.
+        statement = LoadDataInsert(Store)._load_statement(
+            '/tmp/rows.tsv', ("%s", "LIKE('100%%', %s)"))
+        assert "SET `manager` = LIKE('100%%', @v1_0)" in statement
+
+    def test_replace(self, connection):
+        with patch.object(DimensionIndex, 'get') as get:
+            get.return_value.lookup.return_value = 10
+            statements, _ = self._load(connection, StockReplace,
+                                       [_stock(1, 5)])
+        assert " REPLACE INTO TABLE `stock_replace` " in statements[0]
+
+    def test_dimension_subquery_variables(self, connection, product_index):
+        with patch.object(DimensionIndex, 'get', return_value=product_index):
+            statements, files = self._load(connection, Stock,
+                                           [_stock(1, 5), _stock(2, 6)])
+        resolved, unresolved = statements
+        assert "(`product`, `quantity`, @v2_0)" in resolved
+        assert "(@v0_0, @v0_1, @v0_2, `quantity`)" in unresolved
+        assert "SET `product` = (SELECT `id` FROM `product_dimension` " \
+            "WHERE `product_id` = @v0_0" in unresolved
+        assert files[0] == '10\t5\t%s\n' % _digest(Stock, 10)
+        assert files[1].startswith('2\t2\t')
+
+    @patch.object(Store, 'INSERT', 'INSERT DELAYED')
+    def test_unsupported_insert(self):
+        with pytest.raises(ValueError):
+            LoadDataInsert(Store)
+
+
+class TestStagingInsert(object):
+
+    def test_staging_table(self):
+        statement = StagingInsert(Stock).create_statement
+        assert statement.startswith(
+            "CREATE TEMPORARY TABLE IF NOT EXISTS `staging_stock` (")
+        assert "`product` INT NULL,\n  `product__at` DATETIME NULL,\n  " \
+            "`quantity` INT NULL\n)" in statement
+        assert "hash_key" not in statement
+
+    def test_select(self):
+        statement = StagingInsert(Stock).select_statement
+        assert statement.startswith("INSERT IGNORE INTO `stock` (")
+        assert "SELECT\n  d0.`id`,\n  s.`quantity`,\n  " \
+            "UNHEX(SHA1(CONCAT_WS(',', IFNULL(d0.`id`,'NULL'))))\n" \
+            in statement
+        assert "LEFT JOIN `product_dimension` AS d0 ON " \
+            "(d0.`product_id` = s.`product`) AND " \
+            "d0.`applicable_from` <= s.`product__at`" in statement
+        assert "WHERE n0.`id` IS NULL" in statement
+
+    def test_execute(self, connection):
+        connection.cursor.return_value.fetchall.return_value = []
+        StagingInsert(Stock).execute(connection, [_stock(1, 5), _stock(2, 6)])
+        executed = _executed(connection)
+        assert len(executed) == 5
+        statement, parameters = executed[2]
+        assert statement.startswith("INSERT INTO `staging_stock` VALUES")
+        assert parameters[0:2] == [0, 1]
+        assert parameters[3:6] == [5, 1, 2]
+        assert parameters[7] == 6
+        assert executed[4] == (StagingInsert(Stock).select_statement,)
+
+    def test_ambiguous_dimension_rows(self, connection):
+        # Two product rows applicable from the same time both match the
+        # first row, which the subquery used by other engines rejects.
+        connection.cursor.return_value.fetchall.return_value = [(0,)]
+        engine = StagingInsert(Stock)
+        with pytest.raises(SubqueryRowsError):
+            engine.execute(connection, [_stock(1, 5), _stock(2, 6)])
+        statement, = _executed(connection)[3]
+        assert statement == engine.ambiguous_statement
+        assert "GROUP BY s.`_position`\nHAVING COUNT(*) > 1" in statement
+        assert "WHERE n0.`id` IS NULL" in statement
+        assert engine.select_statement not in [
+            call[0] for call in _executed(connection)]
+
+    def test_mismatched_dimension_key(self, connection):
+        stock = _stock(1, 5)
+        stock['product'] = 'one'
+        with pytest.raises(ValueError):
+            StagingInsert(Stock).execute(connection, [stock])
+
+    def test_facts_only(self):
+        with pytest.raises(ValueError):
+            StagingInsert(Store)
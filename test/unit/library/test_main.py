@@ -64,3 +64,16 @@ def test_isolation(get_all_fact_classes):
     commander = Commander()
     commander.run('update', 'FirstFact', 'SecondFact')
     assert SecondFact.update.called
+
+
+@patch('pylytics.library.main.Warehouse')
+@patch('pylytics.library.main.connection')
+@patch('pylytics.library.main.get_all_fact_classes', return_value=[Sales])
+def test_function_command(get_all_fact_classes, connection, warehouse):
+    """ Commands which aren't fact methods are called with each fact.
+    """
+    benchmark = Mock()
+    with patch.dict('pylytics.library.main.FUNCTIONS',
+                    {'benchmark': benchmark}):
+        Commander().run('benchmark', 'Sales', rows=10)
+    benchmark.assert_called_once_with(Sales, rows=10)
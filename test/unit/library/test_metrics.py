@@ -0,0 +1,100 @@
+import socket
+
+from mock import patch
+import pytest
+
+from pylytics.library.metrics import Metrics
+from test.dummy_project import Product, Store
+
+
+@pytest.yield_fixture
+def sink(tmpdir):
+    path = str(tmpdir.join('pylytics.prom'))
+    with patch('pylytics.library.metrics.settings', METRICS_SINK='prometheus',
+               METRICS_PREFIX='pylytics', METRICS_TEXTFILE=path) as settings:
+        Metrics.invalidate()
+        yield settings
+        Metrics.invalidate()
+
+
+def test_disabled():
+    with patch('pylytics.library.metrics.settings', METRICS_SINK=None):
+        Metrics.increment(Store, 'batches')
+        Metrics.observe(Store, 'batch', 1.0)
+    assert Metrics.collect() == ({}, {})
+
+
+class TestMetrics(object):
+
+    def test_collect(self, sink):
+        Metrics.increment(Store, 'rows_inserted', 10)
+        Metrics.increment(Store, 'rows_inserted', 5)
+        Metrics.increment(Store, 'rows_rejected', 0)
+        Metrics.observe(Product, 'batch', 0.5)
+        counters, durations = Metrics.collect()
+        assert counters == {('store_dimension', 'rows_inserted'): 15}
+        assert durations == {('product_dimension', 'batch'): [0.5]}
+        assert Metrics.collect() == ({}, {})
+
+    def test_merge(self, sink):
+        Metrics.increment(Store, 'batches')
+        Metrics.merge(({('store_dimension', 'batches'): 2},
+                       {('store_dimension', 'batch'): [1.0]}))
+        counters, durations = Metrics.collect()
+        assert counters[('store_dimension', 'batches')] == 3
+        assert durations[('store_dimension', 'batch')] == [1.0]
+
+    def test_textfile(self, sink):
+        text = Metrics.textfile(
+            {('sales', 'rows_fetched'): 100},
+            {('sales', 'batch'): [0.02, 0.3, 7.0]}, now=1000)
+        lines = text.splitlines()
+        assert '# TYPE pylytics_last_run_rows_fetched gauge' in lines
+        assert 'pylytics_last_run_rows_fetched{table="sales"} 100' in lines
+        assert '# TYPE pylytics_last_run_batch_seconds_sum gauge' in lines
+        assert 'pylytics_last_run_batch_seconds_sum{table="sales"} 7.32' \
+            in lines
+        assert 'pylytics_last_run_batch_seconds_max{table="sales"} 7.0' \
+            in lines
+        assert 'pylytics_last_run_batch_count{table="sales"} 3' in lines
+        assert not any(line.endswith((' counter', ' histogram'))
+                       for line in lines)
+        assert lines[-1] == 'pylytics_last_run_timestamp_seconds 1000'
+
+    def test_flush_textfile(self, sink):
+        Metrics.increment(Store, 'rows_fetched', 2)
+        Metrics.flush()
+        with open(sink.METRICS_TEXTFILE) as f:
+            assert ('pylytics_last_run_rows_fetched{table="store_dimension"} '
+                    '2') in f.read()
+        assert Metrics.collect() == ({}, {})
+
+    def test_flush_statsd(self, sink):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        sink.METRICS_SINK = 'statsd'
+        sink.STATSD_HOST, sink.STATSD_PORT = server.getsockname()
+        try:
+            Metrics.increment(Store, 'batches', 3)
+            Metrics.observe(Store, 'batch', 0.25)
+            Metrics.flush()
+            packet = server.recv(512)
+        finally:
+            server.close()
+        assert packet.splitlines() == [
+            'pylytics.store_dimension.batches:3|c',
+            'pylytics.store_dimension.batch:250.000|ms',
+        ]
+
+    def test_statsd_packets(self, sink):
+        counters = {('table_%s' % i, 'rows_inserted'): i for i in range(100)}
+        lines = Metrics.statsd_lines(counters, {})
+        assert len(lines) == 100
+        sent = []
+        with patch('pylytics.library.metrics.socket') as sock:
+            sock.socket.return_value.sendto.side_effect = \
+                lambda packet, address: sent.append(packet)
+            Metrics._send_statsd(counters, {}, 'localhost', 8125)
+        assert all(len(packet) <= Metrics.PACKET_SIZE for packet in sent)
+        assert sum(len(packet.splitlines()) for packet in sent) == 100
@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import pytest
+
+from pylytics.library.column import NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.resolver import DimensionIndex
+from test.dummy_project import Store
+
+
+class Shop(Dimension):
+    shop_id = NaturalKey('shop_id', int)
+    shortcode = NaturalKey('shortcode', basestring)
+
+
+JANUARY = datetime(2014, 1, 1)
+FEBRUARY = datetime(2014, 2, 1)
+MARCH = datetime(2014, 3, 1)
+
+
+@pytest.fixture
+def store_index():
+    return DimensionIndex(Store, [
+        (2, FEBRUARY, 3),
+        (1, JANUARY, 1),
+        (1, MARCH, 4),
+        (2, JANUARY, 2),
+    ])
+
+
+class TestDimensionIndex(object):
+
+    def test_latest_applicable_row(self, store_index):
+        assert store_index.lookup(1, datetime(2014, 2, 15)) == 1
+        assert store_index.lookup(1, MARCH) == 4
+        assert store_index.lookup(2, datetime(2015, 1, 1)) == 3
+
+    def test_no_applicable_row(self, store_index):
+        assert store_index.lookup(1, datetime(2013, 1, 1)) is None
+        assert store_index.lookup(3, MARCH) is None
+
+    def test_hits_and_misses(self, store_index):
+        store_index.lookup(1, MARCH)
+        store_index.lookup(2, MARCH)
+        store_index.lookup(3, MARCH)
+        assert store_index.hits == 2
+        assert store_index.misses == 1
+
+    def test_mismatched_type(self, store_index):
+        with pytest.raises(ValueError):
+            store_index.lookup(1.5, MARCH)
+
+    def test_ambiguous_rows(self):
+        index = DimensionIndex(Store, [(1, JANUARY, 1), (1, JANUARY, 2)])
+        assert index.lookup(1, MARCH) is None
+
+    def test_only_matching_natural_keys(self):
+        index = DimensionIndex(Shop, [
+            (1, 'LON1', JANUARY, 1),
+            (2, '1', FEBRUARY, 2),
+        ])
+        assert index.lookup(1, MARCH) == 1
+        assert index.lookup('1', MARCH) == 2
+        assert index.lookup('LON1', MARCH) == 1
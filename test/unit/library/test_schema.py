@@ -0,0 +1,37 @@
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.schema import SchemaRegistry
+from pylytics.library.warehouse import Warehouse
+from test.dummy_project import Store
+
+
+@pytest.yield_fixture
+def connection():
+    connection = MagicMock()
+    cursor = connection.cursor.return_value
+    cursor.fetchall.return_value = [
+        ('store_dimension', Store.schema_fingerprint)]
+    Warehouse.use(connection)
+    SchemaRegistry.invalidate()
+    yield connection
+    SchemaRegistry.invalidate()
+
+
+class TestSchemaRegistry(object):
+
+    @patch.object(Warehouse, 'table_names', ['store_dimension'])
+    def test_current(self, connection):
+        assert SchemaRegistry.is_current(Store)
+
+    @patch.object(Warehouse, 'table_names', [])
+    def test_table_missing(self, connection):
+        assert not SchemaRegistry.is_current(Store)
+
+    @patch.object(Warehouse, 'table_names', ['store_dimension'])
+    def test_fingerprint_changed(self, connection):
+        connection.cursor.return_value.fetchall.return_value = [
+            ('store_dimension', '0' * 40)]
+        assert not SchemaRegistry.is_current(Store)
+        SchemaRegistry.record(Store)
+        assert SchemaRegistry.is_current(Store)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+
+from mock import patch
+import pytest
+
+from pylytics.library.column import Column, Metric
+from pylytics.library.resolver import DimensionIndex
+from pylytics.library.serializer import literal_encoder
+from pylytics.library.utils import bound_sql, dump, raw_sql
+from test.dummy_project import Product, Stock, Store, make_store
+
+
+VALUES = [None, True, False, 0, 12, 2 ** 40, -1.5, Decimal('1.20'),
+          u"O'Brien", u'caf\xe9', b"O'Brien", bytearray(b'abc'),
+          date(2015, 1, 2), datetime(2015, 1, 2, 3, 4, 5),
+          time(3, 4, 5), timedelta(hours=1), raw_sql('NOW()'),
+          bound_sql('UNHEX(%s)', ['ab'])]
+
+
+@pytest.mark.parametrize('kind', [
+    bool, int, long, float, Decimal, date, datetime, time, timedelta,
+    basestring, unicode, str, bytearray, ('a', 'b')])
+def test_encoders_match_dump(kind):
+    encode = literal_encoder(Column('column', kind))
+    for value in VALUES:
+        assert encode(value) == dump(value)
+
+
+def _stock(product, quantity):
+    stock = Stock()
+    stock['product'] = product
+    stock['quantity'] = quantity
+    return stock
+
+
+class TestRowSerializer(object):
+
+    def test_created_once(self):
+        assert Store.__serializer__ is Store.__serializer__
+        assert Store.__serializer__ is not Product.__serializer__
+
+    def test_values(self):
+        store = make_store(1, u"O'Brien")
+        values = Store.__serializer__.values(store)
+        assert values[:2] == [1, u"O'Brien"]
+        assert map(dump, values) == map(dump, Store._values(store))
+        assert Store._value(store, Store.manager) == u"O'Brien"
+
+    def test_unset_values(self):
+        values = Store.__serializer__.values(Store())
+        assert values[:2] == [None, None]
+
+    def test_literals(self):
+        store = make_store(1, u"O'Brien")
+        assert Store.__serializer__.literals(store) == \
+            map(dump, Store._values(store))
+
+    def test_dimension_subquery(self):
+        stock = _stock(1, 5)
+        with patch.object(DimensionIndex, 'get') as get:
+            get.return_value.lookup.return_value = None
+            value = Stock._value(stock, Stock.product)
+        timestamp = value.parameters[-1]
+        subquery, parameters = Product.__subquery__(1, timestamp, bound=True)
+        assert value.template == "(%s)" % subquery
+        assert value.parameters == parameters
+
+    def test_resolved_dimension_key(self):
+        stock = _stock(1, 5)
+        with patch.object(DimensionIndex, 'get') as get:
+            get.return_value.lookup.return_value = 7
+            assert Stock._value(stock, Stock.product) == 7
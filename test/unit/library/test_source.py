@@ -1,8 +1,14 @@
 from contextlib import closing
+import threading
+
+from mock import MagicMock, patch
+from mysql.connector.errors import InterfaceError
+import pytest
 
 from pylytics.library.column import NaturalKey
 from pylytics.library.dimension import Dimension
-from pylytics.library.source import CallableSource
+from pylytics.library.source import (CachedExpansion, CallableSource,
+                                     DatabaseSource)
 from pylytics.library.warehouse import Warehouse
 
 ################################################################################
@@ -44,3 +50,232 @@ class TestExpansions(object):
         assert ('Fred Flintstone' in names and
                 'Wilma Flintstone' in names and
                 'Pebbles Flintstone' in names)
+
+
+class TestStreaming(object):
+
+    def _connection(self, *results):
+        """ Mock NamedConnection, where each connection made returns the
+        next list of chunks from `results` (raising any exceptions in them).
+        """
+        results = list(results)
+        statements = []
+
+        def connect(database):
+            chunks = list(results.pop(0)) + [[]]
+
+            def fetchmany(size):
+                chunk = chunks.pop(0)
+                if isinstance(chunk, Exception):
+                    raise chunk
+                return chunk
+
+            cursor = MagicMock()
+            cursor.execute.side_effect = statements.append
+            cursor.fetchmany.side_effect = fetchmany
+            named_connection = MagicMock()
+            named_connection.__enter__.return_value.cursor.return_value = \
+                cursor
+            return named_connection
+
+        return connect, statements
+
+    def test_streams_chunks(self):
+        connect, statements = self._connection(
+            [[{'id': 1}, {'id': 2}], [{'id': 3}]])
+        source = DatabaseSource.define(database='test', query='SELECT id',
+                                       stream=True)
+        with patch('pylytics.library.source.NamedConnection', connect):
+            rows = list(source.execute())
+        assert rows == [{'id': 1}, {'id': 2}, {'id': 3}]
+        assert statements == ['SELECT id']
+
+    def test_resumes_after_lost_connection(self):
+        lost = InterfaceError(errno=2013)
+        connect, statements = self._connection(
+            [[{'id': 1}, {'id': 2}], lost],
+            [[{'id': 1}, {'id': 2}], [{'id': 3}]])
+        source = DatabaseSource.define(database='test', query='SELECT id',
+                                       stream=True, stream_key='id')
+        with patch('pylytics.library.source.NamedConnection', connect):
+            rows = list(source.execute())
+        assert [row['id'] for row in rows] == [1, 2, 3]
+        # The query isn't wrapped in a derived table, which MySQL would
+        # sort in full before returning anything.
+        assert statements == ['SELECT id ORDER BY `id`'] * 2
+
+    def test_lost_connection_without_key(self):
+        connect, _ = self._connection([[{'id': 1}], InterfaceError(errno=2013)])
+        source = DatabaseSource.define(database='test', query='SELECT id',
+                                       stream=True)
+        with patch('pylytics.library.source.NamedConnection', connect):
+            with pytest.raises(InterfaceError):
+                list(source.execute())
+
+
+class Employee(Dimension):
+    name = NaturalKey('name', basestring)
+    department = NaturalKey('department', basestring)
+
+
+DEPARTMENTS = {1: 'Sales', 2: 'Accounts'}
+
+
+class TestBatchedExpansions(object):
+
+    def _source(self, expansion, count=5):
+        return CallableSource.define(
+            _callable=staticmethod(lambda: [
+                {'name': 'Person %s' % i, 'department_id': i % 3}
+                for i in xrange(count)]),
+            expansions=[expansion],
+        )
+
+    def _execute(self, queries):
+        def execute(query):
+            queries.append(query)
+            ids = [int(i) for i in query.split('(')[1].rstrip(')').split(',')]
+            return [{'department_id': i, 'department': DEPARTMENTS[i]}
+                    for i in ids if i in DEPARTMENTS]
+        return execute
+
+    def test_one_query_per_batch(self):
+        queries = []
+        expansion = DatabaseSource.define(
+            database='test',
+            batch_query='SELECT * FROM department WHERE id IN {department_id}',
+            batch_key='department_id',
+        )
+        source = self._source(expansion)
+        with patch.object(expansion, '_execute',
+                          staticmethod(self._execute(queries))):
+            employees = list(source.select(Employee))
+        assert queries == ['SELECT * FROM department WHERE id IN (0, 1, 2)']
+        assert [employee['department'] for employee in employees] == [
+            None, 'Sales', 'Accounts', None, 'Sales']
+
+    def test_batch_size(self):
+        queries = []
+        expansion = DatabaseSource.define(
+            database='test',
+            batch_query='SELECT * FROM department WHERE id IN {department_id}',
+            batch_key='department_id',
+        )
+        source = self._source(expansion)
+        source.expansion_batch_size = 2
+        with patch.object(expansion, '_execute',
+                          staticmethod(self._execute(queries))):
+            list(source.select(Employee))
+        assert len(queries) == 3
+
+    def test_per_row_expansion(self):
+        expansion = DatabaseSource.define(
+            database='test',
+            query='SELECT name AS department FROM department '
+                  'WHERE id = {department_id}',
+        )
+        source = self._source(expansion, count=2)
+        with patch.object(expansion, '_execute',
+                          return_value=[{'department': 'Sales'}]) as execute:
+            employees = list(source.select(Employee))
+        assert execute.call_args_list[1][0][0].endswith('WHERE id = 1')
+        assert employees[1]['department'] == 'Sales'
+
+
+class TestCachedExpansion(object):
+
+    def test_callable(self):
+        calls = []
+
+        def lookup(data):
+            calls.append(data['code'])
+            data['name'] = data['code'].lower()
+            del data['code']
+
+        expansion = CachedExpansion(lookup, key=['code'])
+        rows = [{'code': 'GBP'}, {'code': 'USD'}, {'code': 'GBP'}]
+        for row in rows:
+            expansion(row)
+        assert calls == ['GBP', 'USD']
+        assert rows[2] == {'name': 'gbp'}
+        assert (expansion.hits, expansion.lookups) == (1, 3)
+
+    def test_caches_unchanged_values(self):
+        """ A value the expansion sets is reapplied to later rows, even if
+        the row it was looked up for already had it.
+        """
+        def lookup(data):
+            data['rate'] = 1
+
+        expansion = CachedExpansion(lookup, key=['code'])
+        expansion({'code': 'GBP', 'rate': 1})
+        row = {'code': 'GBP', 'rate': 2}
+        expansion(row)
+        assert expansion.hits == 1
+        assert row == {'code': 'GBP', 'rate': 1}
+
+    def test_threads(self):
+        expansion = CachedExpansion(
+            lambda data: data.update(name=data['code'].lower()),
+            key=['code'], size=5)
+        errors = []
+
+        def expand():
+            try:
+                for i in xrange(1000):
+                    row = {'code': 'C%s' % (i % 10)}
+                    expansion(row)
+                    assert row['name'] == 'c%s' % (i % 10)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=expand) for _ in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert expansion.lookups == 4000
+
+    def test_database_source(self):
+        source = DatabaseSource.define(
+            database='test', query='SELECT {code} AS name')
+        expansion = CachedExpansion(source, key=lambda data: data['code'])
+        with patch.object(source, '_execute',
+                          return_value=[{'name': 'Pound'}]) as execute:
+            for row in [{'code': 'GBP'}, {'code': 'GBP'}]:
+                expansion(row)
+        assert execute.call_count == 1
+        assert row == {'code': 'GBP', 'name': 'Pound'}
+
+    def test_lru_eviction(self):
+        calls = []
+        expansion = CachedExpansion(lambda data: calls.append(data['code']),
+                                    key=['code'], size=2)
+        for code in ['a', 'b', 'a', 'c', 'a', 'b']:
+            expansion({'code': code})
+        assert calls == ['a', 'b', 'c', 'b']
+
+    @patch('pylytics.library.source.time')
+    def test_ttl(self, time):
+        calls = []
+        expansion = CachedExpansion(lambda data: calls.append(data['code']),
+                                    key=['code'], ttl=60)
+        time.time.return_value = 0
+        expansion({'code': 'a'})
+        time.time.return_value = 59
+        expansion({'code': 'a'})
+        time.time.return_value = 61
+        expansion({'code': 'a'})
+        assert calls == ['a', 'a']
+
+    def test_statistics_reset_after_fetch(self):
+        expansion = CachedExpansion(add_surname, key=['name'])
+        source = CallableSource.define(
+            _callable=staticmethod(lambda: [{'name': 'Fred'}] * 3),
+            expansions=[expansion])
+        with patch.object(Person, '__source__', source):
+            people = list(Person.fetch())
+        assert [person['name'] for person in people] == \
+            ['Fred Flintstone'] * 3
+        assert expansion.lookups == 0
@@ -0,0 +1,407 @@
+import pickle
+
+from mock import MagicMock, patch
+from mysql.connector.errors import (DataError, OperationalError,
+                                    ProgrammingError)
+import pytest
+
+from pylytics.library.column import Metric, NaturalKey
+from pylytics.library.dimension import Dimension
+from pylytics.library.source import CallableSource
+from test.dummy_project import Stock
+
+
+def _names(count):
+    for i in xrange(count):
+        yield {'name': 'Name %s' % i}
+
+
+class Name(Dimension):
+    __source__ = CallableSource.define(
+        _callable=staticmethod(lambda: _names(25))
+    )
+    name = NaturalKey('name', basestring)
+
+
+class TestBatch(object):
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10)
+    def test_batches_any_iterable(self, settings):
+        batches = list(Name.batch(xrange(25)))
+        assert [len(batch) for batch in batches] == [10, 10, 5]
+        assert batches[-1] == range(20, 25)
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10)
+    def test_batches_lazily(self, settings):
+        consumed = []
+
+        def numbers():
+            for i in xrange(25):
+                consumed.append(i)
+                yield i
+
+        batches = Name.batch(numbers())
+        next(batches)
+        assert len(consumed) == 10
+
+
+class TestUpdate(object):
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10, PIPELINE=False,
+           ADAPTIVE_BATCHING=False)
+    @patch.object(Name, 'insert')
+    def test_inserts_each_batch(self, insert, settings):
+        Name.update()
+        assert [len(call[0]) for call in insert.call_args_list] == [10, 10, 5]
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10, PIPELINE=True,
+           PIPELINE_QUEUE_SIZE=1, ADAPTIVE_BATCHING=False)
+    @patch.object(Name, 'insert')
+    def test_pipelined(self, insert, settings):
+        Name.update()
+        assert [len(call[0]) for call in insert.call_args_list] == [10, 10, 5]
+
+
+
+class Numbered(Dimension):
+    __source__ = CallableSource.define(
+        _callable=staticmethod(
+            lambda: ({'name': 'Name %s' % i, 'number': i} for i in xrange(25))),
+        watermark='number'
+    )
+    name = NaturalKey('name', basestring)
+    number = Metric('number', int)
+
+
+@patch.object(Numbered, 'insert')
+@patch('pylytics.library.table.Watermark')
+class TestWatermark(object):
+
+    def test_records_high_water_mark(self, watermark, insert):
+        watermark.get.return_value = None
+        Numbered.update()
+        watermark.set.assert_called_once_with(Numbered, 24)
+
+    def test_passes_watermark_as_since(self, watermark, insert):
+        watermark.get.return_value = 10
+        with patch.object(Numbered.__source__, 'select',
+                          return_value=iter([])) as select:
+            Numbered.update()
+        select.assert_called_once_with(Numbered, since=10)
+
+    def test_no_new_records(self, watermark, insert):
+        watermark.get.return_value = 24
+        Numbered.update()
+        assert not watermark.set.called
+
+    def test_incomplete_insert(self, watermark, insert):
+        """ The watermark isn't advanced past records which were lost.
+        """
+        watermark.get.return_value = None
+        insert.return_value = False
+        Numbered.update()
+        assert not watermark.set.called
+
+    def test_historical(self, watermark, insert):
+        Numbered.update(historical=True)
+        assert not watermark.get.called
+        assert not watermark.set.called
+
+
+class Renamed(Dimension):
+    name = NaturalKey('name', basestring, size=100)
+
+
+class Aliased(Name):
+    title = Metric('title_text', basestring)
+
+
+class TestColumnAccess(object):
+
+    def test_get_and_set(self):
+        record = Aliased()
+        record['name'] = 'Ada'
+        record['title_text'] = 'Countess'
+        assert record['name'] == 'Ada'
+        assert record['title_text'] == 'Countess'
+
+    def test_unset_is_none(self):
+        assert Aliased()['name'] is None
+
+    def test_unknown_column(self):
+        record = Aliased()
+        with pytest.raises(KeyError):
+            record['title']
+        with pytest.raises(KeyError):
+            record['title'] = 'Countess'
+
+    def test_attribute_access(self):
+        record = Aliased()
+        assert record.title is None
+        assert isinstance(Aliased.title, Metric)
+        record['title_text'] = 'Countess'
+        assert record.title == 'Countess'
+        record.name = 'Ada'
+        assert record['name'] == 'Ada'
+
+    def test_multiple_inheritance(self):
+
+        class Combined(Aliased, Numbered):
+            pass
+
+        record = Combined()
+        record['title_text'] = 'Countess'
+        record['number'] = 1
+        record.name = 'Ada'
+        assert (record['name'], record['title_text'], record.number) == \
+            ('Ada', 'Countess', 1)
+
+    def test_no_instance_dictionary(self):
+        assert not hasattr(Aliased(), '__dict__')
+        with pytest.raises(AttributeError):
+            Aliased().colour = 'red'
+
+    def test_values_are_per_instance(self):
+        first, second = Name(), Name()
+        first['name'] = 'Ada'
+        assert second['name'] is None
+
+    @pytest.mark.parametrize('protocol', [0, pickle.HIGHEST_PROTOCOL])
+    def test_pickle(self, protocol):
+        record = Aliased()
+        record['name'] = 'Ada'
+        copy = pickle.loads(pickle.dumps(record, protocol))
+        assert copy['name'] == 'Ada'
+        assert copy['title_text'] is None
+
+    def test_serializer_reads_values(self):
+        record = Aliased()
+        record['title_text'] = 'Countess'
+        assert Aliased._value(record, Aliased.title) == 'Countess'
+
+
+class TestSchemaFingerprint(object):
+
+    def test_stable(self):
+        assert Name.schema_fingerprint == Name.schema_fingerprint
+
+    def test_changes_with_columns(self):
+        assert Name.schema_fingerprint != Renamed.schema_fingerprint
+
+    def test_changes_with_table_args(self):
+        fingerprint = Name.schema_fingerprint
+        with patch.object(Name, '__tableargs__', {'ENGINE': 'MyISAM'}):
+            assert Name.schema_fingerprint != fingerprint
+
+
+@patch.object(Name, 'create_trigger')
+@patch.object(Name, 'create_table')
+@patch('pylytics.library.table.SchemaRegistry')
+class TestBuild(object):
+
+    def test_skipped_when_unchanged(self, registry, create_table,
+                                   create_trigger):
+        registry.is_current.return_value = True
+        Name.build()
+        assert not create_table.called
+        assert not registry.record.called
+
+    def test_built_when_changed(self, registry, create_table, create_trigger):
+        registry.is_current.return_value = False
+        create_table.return_value = True
+        Name.build()
+        assert create_table.called and create_trigger.called
+        registry.record.assert_called_once_with(Name)
+
+    @patch('pylytics.library.table.log')
+    def test_not_recorded_when_not_created(self, log, registry, create_table,
+                                           create_trigger):
+        registry.is_current.return_value = False
+        registry.fingerprints.return_value = {'name_dimension': 'old'}
+        create_table.return_value = False
+        Name.build()
+        assert not registry.record.called
+        assert log.warning.called
+
+    @patch('pylytics.library.table.log')
+    def test_baseline_recorded(self, log, registry, create_table,
+                               create_trigger):
+        """ A table built before fingerprints were recorded gets one,
+        without a warning.
+        """
+        registry.is_current.return_value = False
+        registry.fingerprints.return_value = {}
+        create_table.return_value = False
+        Name.build()
+        registry.record.assert_called_once_with(Name)
+        assert not log.warning.called
+
+
+class FailingEngine(object):
+    """ Fails to insert any batch containing a name in `bad`.
+    """
+
+    def __init__(self, bad):
+        self.bad = bad
+        self.inserted = []
+
+    def execute(self, connection, batch):
+        names = [inst['name'] for inst in batch]
+        if self.bad.intersection(names):
+            raise DataError(msg='bad name', errno=1406)
+        self.inserted.extend(names)
+
+    def close(self):
+        pass
+
+
+@patch('pylytics.library.table.Warehouse')
+@patch('pylytics.library.table.DeadLetters')
+class TestBisect(object):
+
+    def _batch(self):
+        return list(Name.fetch())[:8]
+
+    def test_isolates_bad_rows(self, dead_letters, warehouse):
+        batch = self._batch()
+        engine = FailingEngine({'Name 2', 'Name 5'})
+        rejected = Name._bisect(
+            engine, batch, DataError(msg='bad name', errno=1406))
+        assert [inst['name'] for inst, _ in rejected] == ['Name 2', 'Name 5']
+        assert all(isinstance(error, DataError) for _, error in rejected)
+        assert sorted(engine.inserted) == sorted(
+            'Name %s' % i for i in (0, 1, 3, 4, 6, 7))
+        assert not dead_letters.write_rejected.called
+
+    def test_connection_error(self, dead_letters, warehouse):
+        from pylytics.library.exceptions import DatabaseGoneAwayError
+        batch = self._batch()
+        engine = FailingEngine(set())
+        error = DatabaseGoneAwayError(2006)
+        rejected = Name._bisect(engine, batch, error)
+        assert rejected == [(instance, error) for instance in batch]
+        assert engine.inserted == []
+
+    def test_statement_error(self, dead_letters, warehouse):
+        """ An error which isn't caused by the values of the rows, like a
+        missing table, fails the whole batch without splitting it.
+        """
+        batch = self._batch()
+        engine = FailingEngine(set())
+        error = ProgrammingError(msg="Table doesn't exist", errno=1146)
+        rejected = Name._bisect(engine, batch, error)
+        assert [instance for instance, _ in rejected] == batch
+        assert engine.inserted == []
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10,
+           ADAPTIVE_BATCHING=False)
+    def test_writes_once_per_batch(self, settings, dead_letters, warehouse):
+        engine = FailingEngine({'Name 2', 'Name 5'})
+        with patch('pylytics.library.table.get_engine', return_value=engine):
+            Name.insert(*self._batch())
+        assert dead_letters.write_rejected.call_count == 1
+        table, rejected = dead_letters.write_rejected.call_args[0]
+        assert table is Name
+        assert [inst['name'] for inst, _ in rejected] == ['Name 2', 'Name 5']
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10,
+           ADAPTIVE_BATCHING=False)
+    @patch('pylytics.library.metrics.settings', METRICS_SINK='statsd')
+    def test_metrics(self, metrics_settings, settings, dead_letters,
+                     warehouse):
+        from pylytics.library.metrics import Metrics
+        Metrics.invalidate()
+        engine = FailingEngine({'Name 2'})
+        with patch('pylytics.library.table.get_engine', return_value=engine):
+            Name.insert(*self._batch())
+        counters, durations = Metrics.collect()
+        assert counters[('name_dimension', 'batches')] == 1
+        assert counters[('name_dimension', 'rows_inserted')] == 7
+        assert counters[('name_dimension', 'rows_rejected')] == 1
+        assert counters[('name_dimension', 'retries')] == 6
+        assert len(durations[('name_dimension', 'batch')]) == 1
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10,
+           ADAPTIVE_BATCHING=False)
+    def test_rolls_back_before_bisecting(self, settings, dead_letters,
+                                         warehouse):
+        connection = warehouse.get.return_value
+        calls = []
+        connection.rollback.side_effect = lambda: calls.append('rollback')
+        engine = FailingEngine({'Name 2'})
+        with patch('pylytics.library.table.get_engine', return_value=engine):
+            with patch.object(Name, '_bisect', staticmethod(
+                    lambda *args: calls.append('bisect') or [])):
+                Name.insert(*self._batch())
+        assert calls == ['rollback', 'bisect']
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10,
+           ADAPTIVE_BATCHING=False)
+    def test_complete(self, settings, dead_letters, warehouse):
+        engine = FailingEngine({'Name 2'})
+        with patch('pylytics.library.table.get_engine', return_value=engine):
+            assert Name.insert(*self._batch()) is True
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10,
+           ADAPTIVE_BATCHING=False)
+    def test_dead_letters_lost(self, settings, dead_letters, warehouse):
+        dead_letters.write_rejected.side_effect = IOError('disk full')
+        engine = FailingEngine({'Name 2'})
+        with patch('pylytics.library.table.get_engine', return_value=engine):
+            assert Name.insert(*self._batch()) is False
+        assert len(engine.inserted) == 7
+
+
+class FlakyEngine(FailingEngine):
+    """ Loses the connection the first time a batch is executed.
+    """
+
+    statement = 'INSERT ...'
+
+    def __init__(self):
+        super(FlakyEngine, self).__init__(set())
+        self.calls = 0
+
+    def execute(self, connection, batch):
+        self.calls += 1
+        if self.calls == 1:
+            raise OperationalError(errno=2055)
+        self.inserted.extend(inst['quantity'] for inst in batch)
+
+
+@patch('pylytics.library.table.Warehouse')
+@patch('pylytics.library.table.DeadLetters')
+@patch('pylytics.library.table.settings', BATCH_SIZE=10,
+       ADAPTIVE_BATCHING=False)
+@patch('pylytics.library.fact.settings', RESOLVE_DIMENSION_KEYS=False)
+class TestFactInsert(object):
+    """ Facts are inserted by the same loop as dimensions.
+    """
+
+    def _stocks(self):
+        stocks = []
+        for quantity in (5, 6):
+            stock = Stock()
+            stock['product'] = 1
+            stock['quantity'] = quantity
+            stocks.append(stock)
+        return stocks
+
+    def test_retries_broken_pipe(self, fact_settings, settings, dead_letters,
+                                 warehouse):
+        engine = FlakyEngine()
+        with patch('pylytics.library.table.get_engine', return_value=engine):
+            Stock.insert(*self._stocks())
+        assert engine.inserted == [5, 6]
+        assert warehouse.get.return_value.close.called
+        assert not dead_letters.write.called
+
+    @patch('pylytics.library.fact.log')
+    def test_logs_statement(self, log, fact_settings, settings, dead_letters,
+                            warehouse):
+        engine = FailingEngine(set())
+        engine.statement = 'INSERT ...'
+        engine.execute = MagicMock(side_effect=ValueError('bad'))
+        with patch('pylytics.library.table.get_engine', return_value=engine):
+            Stock.insert(*self._stocks())
+        log.error.assert_called_with('INSERT ...')
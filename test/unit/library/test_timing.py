@@ -0,0 +1,75 @@
+import time
+
+from mock import patch
+import pytest
+
+from pylytics.library.timing import Timings
+from test.dummy_project import Product, Store
+
+
+@pytest.yield_fixture
+def enabled():
+    with patch('pylytics.library.timing.settings', STAGE_TIMINGS=True):
+        Timings.invalidate()
+        yield
+        Timings.invalidate()
+
+
+def test_disabled():
+    with patch('pylytics.library.timing.settings', STAGE_TIMINGS=False):
+        timings = Timings.get(Store)
+        with timings.stage('build'):
+            pass
+        assert not isinstance(timings, Timings)
+
+
+class TestTimings(object):
+
+    def test_accumulates(self, enabled):
+        timings = Timings.get(Store)
+        for _ in range(3):
+            with timings.stage('build'):
+                pass
+        assert Timings.get(Store) is timings
+        assert Timings.get(Product) is not timings
+        summary = timings.summary
+        assert summary['table'] == 'store_dimension'
+        assert summary['stages']['build']['calls'] == 3
+
+    def test_nested_stages_excluded(self, enabled):
+        timings = Timings.get(Store)
+        with timings.stage('build'):
+            with timings.stage('execute'):
+                time.sleep(0.05)
+        assert timings.seconds['execute'] >= 0.05
+        assert timings.seconds['build'] < 0.05
+
+    def test_exception(self, enabled):
+        timings = Timings.get(Store)
+        with pytest.raises(ValueError):
+            with timings.stage('execute'):
+                raise ValueError
+        with timings.stage('build'):
+            pass
+        assert timings.calls == {'execute': 1, 'build': 1}
+
+    def test_log_summary(self, enabled):
+        with Timings.get(Store).stage('hydrate'):
+            pass
+        with patch('pylytics.library.timing.log') as log:
+            Timings.log_summary(Store)
+        extra = log.info.call_args[1]['extra']
+        assert extra['table'] == 'store_dimension'
+        assert 'hydrate' in extra['timings']['stages']
+        # The timings are discarded once logged.
+        assert Timings.get(Store).calls == {}
+
+    @patch('pylytics.library.table.settings', BATCH_SIZE=10, PIPELINE=False,
+           ADAPTIVE_BATCHING=False)
+    @patch.object(Store, 'insert')
+    def test_update(self, insert, settings, enabled):
+        with patch('pylytics.library.timing.log') as log:
+            Store.update()
+        stages = log.info.call_args[1]['extra']['timings']['stages']
+        assert stages['source']['calls'] >= 2
+        assert stages['hydrate']['calls'] == 2
@@ -1,4 +1,9 @@
-from pylytics.library.utils import _camel_to_snake, _camel_to_title_case
+import time
+
+import pytest
+
+from pylytics.library.utils import (_camel_to_snake, _camel_to_title_case,
+                                    pipelined)
 
 
 def test_camel_to_snake():
@@ -7,3 +12,34 @@ def test_camel_to_snake():
 
 def test_camel_to_title_case():
     assert _camel_to_title_case('HelloWorld') == 'Hello World'
+
+
+class TestPipelined(object):
+
+    def test_yields_items_in_order(self):
+        assert list(pipelined(xrange(100), 5)) == range(100)
+
+    def test_reraises_errors(self):
+        def failing():
+            yield 1
+            raise ValueError('bad')
+
+        items = pipelined(failing(), 5)
+        assert next(items) == 1
+        with pytest.raises(ValueError):
+            next(items)
+
+    def test_backpressure(self):
+        produced = []
+
+        def numbers():
+            for i in xrange(100):
+                produced.append(i)
+                yield i
+
+        items = pipelined(numbers(), 3)
+        next(items)
+        time.sleep(0.2)
+        # One item consumed, three queued and one waiting to be queued.
+        assert len(produced) <= 5
+        items.close()
@@ -0,0 +1,56 @@
+from mock import MagicMock
+import pytest
+
+from pylytics.library.warehouse import Warehouse
+
+
+@pytest.fixture
+def connection():
+    connection = MagicMock()
+    cursor = connection.cursor.return_value
+
+    def execute(sql):
+        if sql == "SHOW TABLES":
+            rows = [('store_dimension',), ('sales',)]
+        else:
+            rows = [('created_timestamp_sales', 'sales')]
+        cursor.__iter__.return_value = iter(rows)
+
+    cursor.execute.side_effect = execute
+    Warehouse.use(connection)
+    return connection
+
+
+def _queries(connection):
+    return connection.cursor.return_value.execute.call_count
+
+
+class TestMetadataCache(object):
+
+    def test_loaded_once(self, connection):
+        assert Warehouse.table_names == {'sales', 'store_dimension'}
+        assert Warehouse.table_names is Warehouse.table_names
+        assert Warehouse.trigger_names == {'created_timestamp_sales'}
+        assert Warehouse.trigger_names is Warehouse.trigger_names
+        assert _queries(connection) == 2
+
+    def test_updated_by_changes(self, connection):
+        Warehouse.table_names, Warehouse.trigger_names
+        Warehouse.table_created('stock')
+        Warehouse.trigger_created('created_timestamp_stock', 'stock')
+        Warehouse.table_dropped('sales')
+        assert Warehouse.table_names == {'stock', 'store_dimension'}
+        assert Warehouse.trigger_names == {'created_timestamp_stock'}
+        assert _queries(connection) == 2
+
+    def test_refresh(self, connection):
+        Warehouse.table_names
+        Warehouse.refresh()
+        Warehouse.table_names
+        assert _queries(connection) == 2
+
+    def test_new_connection(self, connection):
+        Warehouse.table_names
+        Warehouse.use(connection)
+        Warehouse.table_names
+        assert _queries(connection) == 2
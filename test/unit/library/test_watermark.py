@@ -0,0 +1,74 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from mock import MagicMock, patch
+import pytest
+
+from pylytics.library.watermark import Watermark
+from test.dummy_project import Store
+
+
+class Rows(dict):
+    """ The rows of the watermark table, and the cursor used to query it.
+    """
+
+
+@pytest.yield_fixture
+def warehouse():
+    rows = Rows()
+    cursor = MagicMock()
+
+    def execute(sql, params=()):
+        if sql.startswith("REPLACE"):
+            table_name, value_type, value = params
+            rows[table_name] = (value_type, value)
+            cursor.fetchall.return_value = []
+        elif sql.startswith("SELECT"):
+            cursor.fetchall.return_value = (
+                [rows[params[0]]] if params[0] in rows else [])
+        elif sql.startswith("DELETE"):
+            rows.pop(params[0], None)
+
+    cursor.execute.side_effect = execute
+    Watermark.invalidate()
+    with patch('pylytics.library.watermark.Warehouse') as warehouse:
+        warehouse.get.return_value.cursor.return_value = cursor
+        rows.cursor = cursor
+        yield rows
+
+
+class TestWatermark(object):
+
+    @pytest.mark.parametrize('value', [
+        42, Decimal('1.50'), u'abc', date(2014, 1, 2),
+        datetime(2014, 1, 2, 3, 4, 5), datetime(2014, 1, 2, 3, 4, 5, 6),
+    ])
+    def test_round_trip(self, warehouse, value):
+        Watermark.set(Store, value)
+        assert Watermark.get(Store) == value
+        assert type(Watermark.get(Store)) == type(value)
+
+    def test_reset(self, warehouse):
+        Watermark.set(Store, 42)
+        Watermark.reset(Store)
+        assert Watermark.get(Store) is None
+
+    def test_unsupported_type(self, warehouse):
+        with pytest.raises(TypeError):
+            Watermark.set(Store, 1.5)
+
+    def test_creates_table_once(self, warehouse):
+        Watermark.set(Store, 42)
+        Watermark.get(Store)
+        Watermark.reset(Store)
+        creates = [call for call in warehouse.cursor.execute.call_args_list
+                   if call[0][0].lstrip().startswith('CREATE')]
+        assert len(creates) == 1
+
+    def test_invalidate(self, warehouse):
+        Watermark.get(Store)
+        Watermark.invalidate()
+        Watermark.get(Store)
+        creates = [call for call in warehouse.cursor.execute.call_args_list
+                   if call[0][0].lstrip().startswith('CREATE')]
+        assert len(creates) == 2